@@ -1,17 +1,49 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_sock import Sock
-from queues import process_queues, QUEUES
-from tasks import convert_to_numpy
+from queues import process_queues, send, QUEUES, WORKERS
+from tasks import (
+    TRANSCRIPTION_FLOW,
+    STREAMING_TRANSCRIPTION_FLOW,
+    TWO_PASS_TRANSCRIPTION_FLOW,
+    TWO_PASS_STREAMING_TRANSCRIPTION_FLOW,
+)
+from storage import getFilePath
+from cache import RESULTS
+from storage import ARTIFACTS
+from flow import FLOWS, finished_progress, recover_flows
+from metrics import METRICS, queue_gauges, model_gauges
+from outbox import OUTBOX
+from live import LIVE
 import threading
+import os
 from models import logger, AIModels
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 from task import Task, partial
 from simple_websocket.ws import Server as WSServer
 
 
 app = Flask(__name__)
+# idle websockets are pinged, dead clients are noticed and their connection freed
+WS_PING_INTERVAL_S = float(os.environ.get("WS_PING_INTERVAL_S", 25))
+app.config["SOCK_SERVER_OPTIONS"] = {"ping_interval": WS_PING_INTERVAL_S or None}
 webSocket = Sock(app)
-connections: Dict[str, WSServer] = {}
+STREAMING_DECODE = os.environ.get("STREAMING_DECODE", "0") == "1"
+# drafts from WHISPER_DRAFT_MODEL first, refined by the main model afterwards
+TWO_PASS = os.environ.get("TWO_PASS", "0") == "1"
+# by (streaming, two_pass)
+TRANSCRIPTION_FLOWS = {
+    (False, False): TRANSCRIPTION_FLOW,
+    (True, False): STREAMING_TRANSCRIPTION_FLOW,
+    (False, True): TWO_PASS_TRANSCRIPTION_FLOW,
+    (True, True): TWO_PASS_STREAMING_TRANSCRIPTION_FLOW,
+}
+# websocket of a node with models (python3 app.py), where the clients of nodes
+# without them start their live sessions, see docker-compose.yaml
+LIVE_URL = os.environ.get("LIVE_URL", "")
+# flows of a user whose websocket is gone for this long are cancelled, < 0 never
+CANCEL_AFTER_DISCONNECT_S = float(os.environ.get("CANCEL_AFTER_DISCONNECT_S", 300))
+abandoned: Dict[str, threading.Timer] = {}
+abandoned_lock = threading.Lock()
 
 
 @app.route("/", methods=["GET"])
@@ -19,49 +51,222 @@ def hello():
     return "hello world!"
 
 
+# liveness, the process is up and serving http
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    return jsonify({"status": "alive"}), 200
+
+
+# readiness, the models are loaded and warmed up
+@app.route("/ready", methods=["GET"])
+def ready():
+    if WORKERS <= 0:
+        # the models are in the worker.py processes
+        return jsonify({"ready": True, "workers": 0}), 200
+    report = AIModels.startup_report()
+    return jsonify(report), 200 if report["ready"] else 503
+
+
 @app.route("/dispatch", methods=["GET"])
 def dispatch():
     user = request.args["user"]
     flow_id = request.args["task"]
-    task = Task(
+    # decoding speed/quality trade-off, see AIModels.asr_profiles
+    profile = request.args.get("profile") or None
+    try:
+        AIModels.get_asr_options(profile)
+    except ValueError as e:
+        return jsonify({"status": "failed to enqueue", "error": str(e)}), 400
+    if WORKERS > 0 and AIModels.startup_error is not None:
+        # nothing would ever run the flow, see /ready
+        error = "The models failed to load"
+        return jsonify({"status": "failed to enqueue", "error": error}), 503
+    two_pass = request.args.get("two_pass", "1" if TWO_PASS else "0") == "1"
+    if two_pass and not AIModels.has_draft():
+        error = "Two pass transcription needs WHISPER_DRAFT_MODEL"
+        return jsonify({"status": "failed to enqueue", "error": error}), 400
+    if not getFilePath(flow_id, "upload", ext="").is_file():
+        error = f"No upload for task {flow_id}"
+        return jsonify({"status": "failed to enqueue", "error": error}), 404
+
+    # long files start transcribing while they are still being decoded. The
+    # streaming stage emits into its flow and only runs on the node that
+    # started it, which needs workers of its own.
+    default = "1" if STREAMING_DECODE and WORKERS > 0 else "0"
+    streaming = request.args.get("stream", default) == "1"
+    if streaming and WORKERS <= 0:
+        error = "Streaming decode needs workers on this node, see gunicorn.conf.py"
+        return jsonify({"status": "failed to enqueue", "error": error}), 400
+    flow = TRANSCRIPTION_FLOWS[(streaming, two_pass)]
+    run = flow.run(
         flow_id,
-        partial(convert_to_numpy),
         QUEUES[user],
-        metadata={"user": user},
+        metadata={
+            "user": user,
+            "profile": profile,
+            "two_pass": two_pass,
+        },
     )
-    if task.enqueue():
+    if run.start():
         return jsonify({"status": "enqueued"}), 200
     else:
         return jsonify({"status": "failed to enqueue"}), 500
 
 
+@app.route("/cancel", methods=["POST"])
+def cancel():
+    flow_id = request.args["task"]
+    run = FLOWS.get(flow_id)
+    if run is None or not run.cancel("requested"):
+        return jsonify({"flow_id": flow_id, "error": "unknown or finished flow"}), 404
+    return jsonify({"flow_id": flow_id, "status": "cancelled"}), 200
+
+
+def cancel_user_flows(user: str):
+    with abandoned_lock:
+        abandoned.pop(user, None)
+    if OUTBOX.connected(user):
+        return
+    for run in list(FLOWS.values()):
+        if run.metadata.get("user") == user:
+            run.cancel("user disconnected")
+
+
+@app.route("/queues", methods=["GET"])
+def queues():
+    return jsonify(QUEUES.stats()), 200
+
+
+@app.route("/artifacts", methods=["GET"])
+def artifacts():
+    return jsonify({**ARTIFACTS.stats(), "results": RESULTS.stats()}), 200
+
+
+@app.route("/models", methods=["GET"])
+def model_stats():
+    return jsonify(AIModels.stats()), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    gauges = [*queue_gauges(QUEUES.stats()), *model_gauges(AIModels.stats())]
+    text = METRICS.render(gauges)
+    return Response(text, mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/outbox", methods=["GET"])
+def outbox():
+    return jsonify(OUTBOX.stats()), 200
+
+
+@app.route("/live", methods=["GET"])
+def live():
+    return jsonify(LIVE.stats()), 200
+
+
+def start_live(conn: WSServer, user: str, command: Dict[str, Any]):
+    if WORKERS <= 0 or not AIModels.ready.is_set():
+        message = {
+            "task_type": "live_error",
+            "task_id": command.get("session"),
+            "error": "The models are not loaded on this node",
+        }
+        if WORKERS <= 0 and LIVE_URL:
+            # the client reconnects there for its live session
+            message["url"] = LIVE_URL
+        send(user, message)
+        return
+    LIVE.start(conn, user, command, send)
+
+
 @app.route("/status", methods=["GET"])
 def status():
     flow_id = request.args["task"]
+    run = FLOWS.get(flow_id)
+    if run is not None:
+        return jsonify(run.progress()), 200
+    progress = finished_progress(flow_id)
+    if progress is not None:
+        return jsonify(progress), 200
+    return jsonify({"flow_id": flow_id, "error": "unknown flow"}), 404
 
 
 @webSocket.route("/ws")
 def websocket(conn: WSServer):
     user = request.args["user"]
-    connections[user] = conn
+    # the client resumes after the last message it got, missed ones are replayed
+    last_seq = request.args.get("last_seq", type=int)
+    encoding = request.args.get("encoding", "json")
+    OUTBOX.attach(user, conn, last_seq, encoding)
+    QUEUES.connected(user)
+    with abandoned_lock:
+        timer = abandoned.pop(user, None)
+    if timer is not None:
+        timer.cancel()
 
     try:
         while True:
-            # Keep reading to prevent disconnect
             msg = conn.receive()
             if msg is None:
                 break
+            # binary frames are the pcm of a live session
+            if isinstance(msg, bytes):
+                LIVE.feed(conn, msg)
+                continue
+            command = LIVE.command(msg)
+            if command is None:
+                OUTBOX.receive(user, msg)
+            elif command["live"] == "start":
+                start_live(conn, user, command)
+            else:
+                LIVE.stop(conn)
     finally:
-        conn = connections.pop(user)
+        LIVE.stop(conn)
+        OUTBOX.detach(user, conn)
         conn.close()
+        # the other tabs of the user may still be connected
+        if not OUTBOX.connected(user):
+            QUEUES.disconnected(user)
+        if CANCEL_AFTER_DISCONNECT_S >= 0 and not OUTBOX.connected(user):
+            timer = threading.Timer(
+                CANCEL_AFTER_DISCONNECT_S, cancel_user_flows, args=[user]
+            )
+            timer.daemon = True
+            with abandoned_lock:
+                previous = abandoned.pop(user, None)
+                abandoned[user] = timer
+            if previous is not None:
+                previous.cancel()
+            timer.start()
 
 
-if __name__ == "__main__":
-    models = AIModels()
-    models.load_models()  # just to ensure
+# background work of a serving process, also called by gunicorn.conf.py
+def start(workers: int = WORKERS) -> Optional[threading.Thread]:
+    # flows interrupted by the last restart wait in the queues for the workers
+    recover_flows(QUEUES)
+    if workers <= 0:
+        return None
+    # the server answers right away, workers start once the models are ready
+    AIModels.start()
     worker_thread = threading.Thread(
-        target=process_queues, args=[connections], daemon=True
+        target=process_queues,
+        kwargs={
+            "workers": workers,
+            "ready": AIModels.ready,
+            "done": AIModels.startup_done,
+        },
+        daemon=True,
     )
     worker_thread.start()
-    app.run(debug=True, host="0.0.0.0", port=8000)
-    worker_thread.join()
+    return worker_thread
+
+
+# development server, see gunicorn.conf.py to serve many clients
+if __name__ == "__main__":
+    worker_thread = start()
+    debug = os.environ.get("FLASK_DEBUG", "0") == "1"
+    # the reloader would run a second process loading the models again
+    port = int(os.environ.get("PORT", 8000))
+    app.run(debug=debug, use_reloader=False, host="0.0.0.0", port=port)
+    if worker_thread is not None:
+        worker_thread.join()
@@ -0,0 +1,160 @@
+from concurrent.futures import Future, TimeoutError
+from cancellation import FlowCancelled, is_cancelled
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Tuple
+import threading
+import time
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+MAX_BATCH_SIZE = int(os.environ.get("TRANSCRIBE_MAX_BATCH_SIZE", 8))
+MAX_WAIT_S = float(os.environ.get("TRANSCRIBE_MAX_WAIT_MS", 50)) / 1000
+# how often a caller waiting on its batch checks if its flow was cancelled
+CANCEL_POLL_S = float(os.environ.get("CANCEL_POLL_MS", 200)) / 1000
+
+
+# Collects single inference requests coming from any flow and runs them in
+# groups that share the same key (language, decoding options...)
+class Batcher:
+    def __init__(
+        self,
+        run_batch: Callable[[Hashable, List[Any]], List[Any]],
+        max_batch_size: int = MAX_BATCH_SIZE,
+        max_wait_s: float = MAX_WAIT_S,
+        name: str = "batcher",
+        concurrency: int = 1,
+    ):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait_s = max(0.0, max_wait_s)
+        self.name = name
+        # batches run at once, for models that can serve parallel calls
+        self.concurrency = max(1, concurrency)
+
+        # key -> list of (arrival time, item, future, urgent), oldest key first
+        self._pending: "OrderedDict[Hashable, List[Tuple[float, Any, Future, bool]]]" = (
+            OrderedDict()
+        )
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+
+        # stats
+        self.batches = 0
+        self.items = 0
+        self.running = 0
+        self.urgent = 0
+
+    # urgent items (live audio) do not wait for their batch to fill and their
+    # batch goes before the others
+    def submit(self, key: Hashable, item: Any, urgent: bool = False) -> Future:
+        future = Future()
+        with self._cond:
+            self._ensure_threads()
+            entry = (time.monotonic(), item, future, urgent)
+            if urgent:
+                self.urgent += 1
+                entries = self._pending.setdefault(key, [])
+                # ahead of the other items of the key, behind older urgent ones
+                position = sum(1 for e in entries if e[3])
+                entries.insert(position, entry)
+            else:
+                self._pending.setdefault(key, []).append(entry)
+            self._cond.notify()
+        return future
+
+    def __call__(self, key: Hashable, item: Any, urgent: bool = False):
+        future = self.submit(key, item, urgent)
+        while True:
+            try:
+                return future.result(timeout=CANCEL_POLL_S)
+            except TimeoutError:
+                # only items still waiting for a batch can be taken back
+                if is_cancelled() and future.cancel():
+                    raise FlowCancelled(f"Cancelled while waiting on {self.name}")
+
+    def _ensure_threads(self):
+        self._threads = [t for t in self._threads if t.is_alive()]
+        while len(self._threads) < self.concurrency:
+            thread = threading.Thread(
+                target=self._loop,
+                name=f"{self.name}_{len(self._threads)}",
+                daemon=True,
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                if not self._pending:
+                    self._cond.wait()
+                    continue
+                key, entries = next(
+                    ((k, v) for k, v in self._pending.items() if v[0][3]),
+                    next(iter(self._pending.items())),
+                )
+                deadline = entries[0][0] + self.max_wait_s
+                now = time.monotonic()
+                urgent = entries[0][3]
+                if len(entries) < self.max_batch_size and now < deadline and not urgent:
+                    self._cond.wait(deadline - now)
+                    continue
+                batch = entries[: self.max_batch_size]
+                rest = entries[self.max_batch_size :]
+                del self._pending[key]
+                if rest:
+                    self._pending[key] = rest
+                    self._cond.notify()  # another thread can take the rest
+                return key, batch
+
+    def _loop(self):
+        logger.info("Spinning up %s thread", self.name)
+        while True:
+            key, batch = self._next_batch()
+            # the items of cancelled flows are dropped from the batch
+            batch = [e for e in batch if e[2].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            futures = [f for _, _, f, _ in batch]
+            with self._cond:
+                self.running += 1
+            try:
+                results = self.run_batch(key, [item for _, item, _, _ in batch])
+                if len(results) != len(batch):
+                    raise ValueError(
+                        f"{self.name} expected {len(batch)} results got {len(results)}"
+                    )
+            except Exception as e:
+                logger.exception(e)
+                for f in futures:
+                    f.set_exception(e)
+                continue
+            finally:
+                with self._cond:
+                    self.running -= 1
+            with self._cond:
+                self.batches += 1
+                self.items += len(batch)
+            logger.info(
+                "%s ran batch of size %d for key %s", self.name, len(batch), key
+            )
+            for f, r in zip(futures, results):
+                f.set_result(r)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            pending = sum(len(v) for v in self._pending.values())
+            running = self.running
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "pending": pending,
+            "running": running,
+            "concurrency": self.concurrency,
+            "urgent": self.urgent,
+            "mean_batch_size": self.items / self.batches if self.batches else 0,
+        }
@@ -0,0 +1,424 @@
+# Offline benchmark of the task pipeline. AIModels is replaced by stub models
+# that sleep for a configurable time, so the scheduling, storage and decoding
+# costs of the flows can be measured without the model weights:
+#
+#   python3 benchmark.py --users 4 --jobs 3 --lengths 60,600 --density 0.5
+#
+# Every user uploads its jobs one after the other through /dispatch, the
+# report has the throughput, per stage latency and queue wait percentiles and
+# the peak RSS of the process. With --live, clients streaming audio in real
+# time run next to the batch load and the latency of their segments is added.
+# With --two-pass the flows send drafts from a faster stub model first, the
+# time to the first text of every flow shows what the user waits for.
+from typing import Any, Dict, List, Tuple
+from collections import defaultdict
+import argparse
+import tempfile
+import resource
+import threading
+import json
+import time
+import wave
+import os
+
+import numpy as np
+
+import storage
+import cache
+import tasks
+import app
+import live
+from batching import Batcher
+from queues import parse_assignments, process_queues, WORKERS
+from flow import FLOWS, FlowRun
+from outbox import OUTBOX
+from whisperx.audio import SAMPLE_RATE, CHUNK_LENGTH
+
+# seconds per call, plus seconds per second of audio
+DEFAULT_LATENCY = (
+    "vad=0.05,language=0.2,transcription=0.3,alignment=0.05,diarization=1,"
+    "draft_language=0.05,draft=0.05"
+)
+DEFAULT_RTF = "vad=0.002,transcription=0.02,alignment=0.01,diarization=0.02,draft=0.004"
+
+
+# Same interface as AIModels as used by the stage functions, with
+# deterministic results and sleeps instead of inference
+class StubModels:
+    latency: Dict[str, float] = {}
+    rtf: Dict[str, float] = {}
+    transcription_batcher: Batcher = None
+    draft_batcher: Batcher = None
+    transcription_concurrency = 1
+    startup_error: str = None
+    calls: Dict[str, int] = defaultdict(int)
+
+    @classmethod
+    def _work(cls, name: str, audio_s: float = 0.0, count: int = 1):
+        cls.calls[name] += count
+        time.sleep(cls.latency.get(name, 0.0) + cls.rtf.get(name, 0.0) * audio_s)
+
+    @classmethod
+    def fingerprint(cls, lang: str = None, profile: str = None, tier="final") -> str:
+        return f"stub-{lang}-{profile}-{tier}"
+
+    @classmethod
+    def has_draft(cls) -> bool:
+        return True
+
+    @classmethod
+    def get_asr_options(cls, profile: str = None):
+        return profile
+
+    @classmethod
+    def get_voice_segments(cls, audio: np.ndarray):
+        cls._work("vad", len(audio) / SAMPLE_RATE)
+        return detect_bursts(audio)
+
+    @classmethod
+    def get_language(cls, audio: np.ndarray, encoder_key=None, tier="final"):
+        cls._work("language" if tier == "final" else f"{tier}_language")
+        return "en"
+
+    @classmethod
+    def pop_encoder_output(cls, key):
+        return None
+
+    @classmethod
+    def _transcribe_batch(cls, key, items: List[float]):
+        _, _, tier = key
+        name = "transcription" if tier == "final" else tier
+        cls._work(name, sum(items), len(items))
+        return [f"{seconds:.2f} seconds of speech" for seconds in items]
+
+    @classmethod
+    def get_transcription(
+        cls, audio, lang, encoder_key=None, profile=None, urgent=False, tier="final"
+    ):
+        if cls.transcription_batcher is None:
+            cls.transcription_batcher = Batcher(
+                cls._transcribe_batch,
+                name="stub",
+                concurrency=cls.transcription_concurrency,
+            )
+            cls.draft_batcher = Batcher(cls._transcribe_batch, name="stub_draft")
+        batcher = cls.transcription_batcher if tier == "final" else cls.draft_batcher
+        seconds = len(audio) / SAMPLE_RATE
+        return [batcher((lang, profile, tier), seconds, urgent)]
+
+    @classmethod
+    def get_aligment(cls, segment, audio, lang, char_level=False):
+        start, end = segment["start"], segment["end"]
+        cls._work("alignment", end - start)
+        words = segment["text"].split()
+        step = (end - start) / max(len(words), 1)
+        return {
+            "segments": [
+                {
+                    **segment,
+                    "words": [
+                        {
+                            "word": word,
+                            "start": start + k * step,
+                            "end": start + (k + 1) * step,
+                            "score": 1.0,
+                        }
+                        for k, word in enumerate(words)
+                    ],
+                }
+            ]
+        }
+
+    @classmethod
+    def get_speaker_turns(cls, audio: np.ndarray):
+        cls._work("diarization", len(audio) / SAMPLE_RATE)
+        return [(0.0, len(audio) / SAMPLE_RATE, "SPEAKER_00")]
+
+    @classmethod
+    def assign_speakers(cls, segments, speaker_data):
+        return {"segments": [{**s, "speaker": "SPEAKER_00"} for s in segments]}
+
+
+# energy based stand in for the vad, bursts merged up to whisper's chunk length
+def detect_bursts(audio: np.ndarray, frame_s: float = 0.1) -> List[Dict[str, Any]]:
+    frame = int(frame_s * SAMPLE_RATE)
+    frames = len(audio) // frame
+    energy = np.abs(audio[: frames * frame]).reshape(frames, frame).mean(axis=1)
+    active = np.flatnonzero(energy > 0.02)
+    chunks: List[Dict[str, Any]] = []
+    for k in active:
+        start, end = k * frame_s, (k + 1) * frame_s
+        if chunks and start - chunks[-1]["end"] < 2 * frame_s:
+            if end - chunks[-1]["start"] <= CHUNK_LENGTH:
+                chunks[-1]["end"] = end
+                continue
+        chunks.append({"start": start, "end": end, "segments": []})
+    return chunks
+
+
+# speech bursts of 1 to 8 seconds over a quiet floor, density is the share of
+# the audio covered by speech
+def synthetic_audio(seconds: float, density: float, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    audio = 0.005 * rng.standard_normal(int(seconds * SAMPLE_RATE))
+    t = 0.0
+    while t < seconds:
+        burst = rng.uniform(1, 8)
+        gap = burst * (1 - density) / max(density, 1e-3) * rng.uniform(0.5, 1.5)
+        start, end = int(t * SAMPLE_RATE), int(min(t + burst, seconds) * SAMPLE_RATE)
+        tone = np.sin(
+            2 * np.pi * rng.uniform(120, 300) * np.arange(end - start) / SAMPLE_RATE
+        )
+        audio[start:end] += 0.2 * tone
+        t += burst + gap
+    return np.clip(audio, -1, 1).astype(np.float32)
+
+
+def write_upload(flow_id: str, audio: np.ndarray):
+    path = storage.getFilePath(flow_id, "upload", ext="")
+    with wave.open(str(path), "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(SAMPLE_RATE)
+        f.writeframes((audio * 32767).astype(np.int16).tobytes())
+
+
+# stands for the websocket of a user
+class Connection:
+    def __init__(self):
+        self.messages: List[Dict[str, Any]] = []
+        # flow -> when its first transcription (draft or not) arrived
+        self.first_text: Dict[str, float] = {}
+
+    def send(self, frame: str):
+        message = json.loads(frame)
+        messages = message.get("messages", [message])
+        self.messages.extend(messages)
+        for m in messages:
+            if m["task_type"] == "transcribe_segment":
+                self.first_text.setdefault(m["task_id"], time.monotonic())
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {
+        "count": len(values),
+        "p50": float(p50),
+        "p90": float(p90),
+        "p99": float(p99),
+        "max": float(max(values)),
+    }
+
+
+def run_user(
+    client,
+    user: str,
+    jobs: List[Tuple[str, float]],
+    args: argparse.Namespace,
+    connection: Connection,
+    runs: List[Tuple[FlowRun, float, float, float]],
+):
+    for flow_id, seconds in jobs:
+        start = time.monotonic()
+        params = {
+            "user": user,
+            "task": flow_id,
+            "stream": "1" if args.stream else "0",
+            "two_pass": "1" if args.two_pass else "0",
+        }
+        if args.profile:
+            params["profile"] = args.profile
+        response = client.get("/dispatch", query_string=params)
+        if response.status_code != 200:
+            raise RuntimeError(f"Dispatch of {flow_id} failed: {response.get_json()}")
+        run = FLOWS.get(flow_id)
+        while run is not None and not run.finished:
+            if time.monotonic() - start > args.timeout:
+                raise TimeoutError(f"Flow {flow_id} did not finish in time")
+            time.sleep(0.01)
+        # the messages are sent by the outbox thread, shortly after the end
+        time.sleep(2 * OUTBOX.coalesce_s)
+        first_text = connection.first_text.get(flow_id)
+        runs.append(
+            (
+                run,
+                seconds,
+                time.monotonic() - start,
+                None if first_text is None else first_text - start,
+            )
+        )
+
+
+# streams the audio in frames of 100ms at the pace of a microphone
+def run_live(session_id: str, audio: np.ndarray, latencies: List[float]):
+    session = live.LiveSession("live", session_id, lambda user, message: None, "en")
+    session.start()
+    frame = SAMPLE_RATE // 10
+    start = time.monotonic()
+    for k, i in enumerate(range(0, len(audio), frame)):
+        session.feed((audio[i : i + frame] * 32767).astype(np.int16).tobytes())
+        time.sleep(max(0.0, start + (k + 1) / 10 - time.monotonic()))
+    session.stop()
+    session.thread.join()
+    latencies.extend(session.latencies)
+
+
+def report(
+    runs: List[Tuple[FlowRun, float, float, float]],
+    wall: float,
+    live_latencies: List[float] = (),
+) -> Dict[str, Any]:
+    stage_latency: Dict[str, List[float]] = defaultdict(list)
+    stage_wait: Dict[str, List[float]] = defaultdict(list)
+    for run, _, _, _ in runs:
+        if run is None:  # served from the result cache
+            continue
+        for stage, stage_tasks in run.tasks.items():
+            for task in stage_tasks:
+                if task.started_at is None or task.finished_at is None:
+                    continue  # never ran, its flow failed
+                stage_latency[stage].append(task.finished_at - task.started_at)
+                stage_wait[stage].append(task.started_at - task.enqueued_at)
+    audio_s = sum(seconds for _, seconds, _, _ in runs)
+    return {
+        "flows": len(runs),
+        "failed": sum(1 for run, _, _, _ in runs if run is not None and run.failed),
+        "wall_s": wall,
+        "audio_s": audio_s,
+        "audio_s_per_s": audio_s / wall if wall else 0.0,
+        "flows_per_min": 60 * len(runs) / wall if wall else 0.0,
+        "flow_latency_s": percentiles([latency for _, _, latency, _ in runs]),
+        "first_text_s": percentiles(
+            [first for _, _, _, first in runs if first is not None]
+        ),
+        "stage_latency_s": {s: percentiles(v) for s, v in stage_latency.items()},
+        "queue_wait_s": {s: percentiles(v) for s, v in stage_wait.items()},
+        "live_latency_s": percentiles(live_latencies),
+        "model_calls": dict(StubModels.calls),
+        # kilobytes on linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def print_report(result: Dict[str, Any]):
+    print(
+        f"{result['flows']} flows, {result['audio_s']:.0f}s of audio in "
+        f"{result['wall_s']:.1f}s: {result['audio_s_per_s']:.1f} audio s/s, "
+        f"{result['flows_per_min']:.1f} flows/min, "
+        f"peak rss {result['peak_rss_mb']:.0f}MB"
+    )
+    if result["failed"]:
+        print(f"{result['failed']} flows failed, see the log")
+    latency = result["flow_latency_s"]
+    print(f"flow latency p50 {latency['p50']:.2f}s p90 {latency['p90']:.2f}s")
+    first_text = result["first_text_s"]
+    if first_text:
+        print(f"first text p50 {first_text['p50']:.2f}s p90 {first_text['p90']:.2f}s")
+    live_latency = result["live_latency_s"]
+    if live_latency:
+        print(
+            f"live segment latency p50 {live_latency['p50']:.2f}s "
+            f"p90 {live_latency['p90']:.2f}s max {live_latency['max']:.2f}s "
+            f"({live_latency['count']} segments)"
+        )
+    print(
+        f"{'stage':<24}{'n':>6}{'p50':>9}{'p90':>9}{'p99':>9}{'wait p50':>10}{'wait p99':>10}"
+    )
+    for stage, stats in sorted(result["stage_latency_s"].items()):
+        wait = result["queue_wait_s"][stage]
+        print(
+            f"{stage:<24}{stats['count']:>6}{stats['p50']:>9.3f}{stats['p90']:>9.3f}"
+            f"{stats['p99']:>9.3f}{wait['p50']:>10.3f}{wait['p99']:>10.3f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--jobs", type=int, default=2, help="flows per user")
+    parser.add_argument(
+        "--lengths", default="60,300", help="audio seconds, cycled over the jobs"
+    )
+    parser.add_argument("--density", type=float, default=0.6, help="speech share")
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--latency", default=DEFAULT_LATENCY)
+    parser.add_argument("--rtf", default=DEFAULT_RTF)
+    parser.add_argument("--stream", action="store_true", help="streaming decode")
+    parser.add_argument("--profile", default=None)
+    parser.add_argument(
+        "--two-pass", action="store_true", help="drafts first, refined later"
+    )
+    parser.add_argument(
+        "--whisper-workers", type=int, default=1, help="transcription batches at once"
+    )
+    parser.add_argument(
+        "--live", type=int, default=0, help="clients streaming audio in real time"
+    )
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--json", action="store_true", help="print the raw report")
+    args = parser.parse_args()
+
+    StubModels.latency = parse_assignments(args.latency, float)
+    StubModels.rtf = parse_assignments(args.rtf, float)
+    StubModels.transcription_concurrency = args.whisper_workers
+    tasks.AIModels = StubModels
+    app.AIModels = StubModels
+    live.AIModels = StubModels
+
+    root = tempfile.mkdtemp(prefix="speech2text-bench-")
+    storage.DATA = root
+    # every upload is different, nothing comes from a previous run
+    cache.RESULTS.root = os.path.join(root, ".cache")
+    OUTBOX.root = os.path.join(root, ".outbox")
+
+    lengths = [float(length) for length in args.lengths.split(",")]
+    jobs: Dict[str, List[Tuple[str, float]]] = defaultdict(list)
+    connections: Dict[str, Connection] = {}
+    for u in range(args.users):
+        for j in range(args.jobs):
+            seconds = lengths[(u * args.jobs + j) % len(lengths)]
+            flow_id = f"bench-{u}-{j}"
+            write_upload(
+                flow_id, synthetic_audio(seconds, args.density, seed=u * 1000 + j)
+            )
+            jobs[f"user{u}"].append((flow_id, seconds))
+        connections[f"user{u}"] = Connection()
+        OUTBOX.attach(f"user{u}", connections[f"user{u}"])
+
+    threading.Thread(target=process_queues, args=[args.workers], daemon=True).start()
+
+    client = app.app.test_client()
+    runs: List[Tuple[FlowRun, float, float, float]] = []
+    start = time.monotonic()
+    users = [
+        threading.Thread(
+            target=run_user,
+            args=[client, user, user_jobs, args, connections[user], runs],
+        )
+        for user, user_jobs in jobs.items()
+    ]
+    live_latencies: List[float] = []
+    # as long as the shortest batch job
+    live_audio = synthetic_audio(min(lengths), args.density, seed=args.users * 1000)
+    users += [
+        threading.Thread(
+            target=run_live, args=[f"live-{k}", live_audio, live_latencies]
+        )
+        for k in range(args.live)
+    ]
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    result = report(runs, time.monotonic() - start, live_latencies)
+
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+
+
+if __name__ == "__main__":
+    main()
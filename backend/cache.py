@@ -0,0 +1,129 @@
+from typing import Any, Dict, List, Optional
+from log import logger
+from storage import DATA
+import numpy as np
+import hashlib
+import threading
+import json
+import os
+
+
+def hash_bytes(*parts: Any) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        elif isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part)
+        digest.update(part)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def hash_file(path: str, block_size: int = 2**20) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Results stored on disk by the hash of their inputs (audio content, language,
+# models and options fingerprint), the least recently used entries are
+# removed once the cache goes over its size limit
+class ResultCache:
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._sizes: Dict[str, int] = None
+        self.used_bytes = 0
+
+        # stats
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.json")
+
+    def _load_index(self):
+        if self._sizes is not None:
+            return
+        self._sizes = {}
+        for folder, _, files in os.walk(self.root):
+            for name in files:
+                if name.endswith(".json"):
+                    path = os.path.join(folder, name)
+                    self._sizes[name[: -len(".json")]] = os.path.getsize(path)
+        self.used_bytes = sum(self._sizes.values())
+
+    def get(self, key: str) -> Optional[Any]:
+        path = self._path(key)
+        with self._lock:
+            self._load_index()
+            try:
+                with open(path) as f:
+                    value = json.load(f)
+                os.utime(path)  # mtime is the recency used for eviction
+            except (FileNotFoundError, json.JSONDecodeError):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: Any):
+        path = self._path(key)
+        try:
+            data = json.dumps(value)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp, "w") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except Exception as e:
+            # a result that can't be cached is still a good result
+            logger.exception(e)
+            return
+        with self._lock:
+            self._load_index()
+            self.used_bytes += len(data) - self._sizes.get(key, 0)
+            self._sizes[key] = len(data)
+            if self.used_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        by_age = []
+        for key in self._sizes:
+            try:
+                by_age.append((os.path.getmtime(self._path(key)), key))
+            except FileNotFoundError:
+                by_age.append((0.0, key))
+        for _, key in sorted(by_age):
+            if self.used_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            self.used_bytes -= self._sizes.pop(key)
+            self.evictions += 1
+        logger.info("Result cache evicted down to %d bytes", self.used_bytes)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            self._load_index()
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._sizes),
+                "used_bytes": self.used_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+RESULTS = ResultCache(
+    os.environ.get("RESULT_CACHE_PATH", os.path.join(DATA, ".cache")),
+    int(os.environ.get("RESULT_CACHE_MB", 512)) * 2**20,
+)
@@ -0,0 +1,59 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterator, Optional
+import threading
+import os
+
+
+CANCELLED_FLOWS_KEPT = int(os.environ.get("CANCELLED_FLOWS_KEPT", 1024))
+
+
+class FlowCancelled(Exception):
+    pass
+
+
+_lock = threading.Lock()
+_cancelled: "OrderedDict[str, None]" = OrderedDict()
+_local = threading.local()
+
+
+def cancel(flow_id: str):
+    with _lock:
+        _cancelled[flow_id] = None
+        _cancelled.move_to_end(flow_id)
+        while len(_cancelled) > CANCELLED_FLOWS_KEPT:
+            _cancelled.popitem(last=False)
+
+
+def forget(flow_id: str):
+    with _lock:
+        _cancelled.pop(flow_id, None)
+
+
+def is_cancelled(flow_id: Optional[str] = None) -> bool:
+    if flow_id is None:
+        flow_id = current()
+    with _lock:
+        return flow_id in _cancelled
+
+
+# the flow of the task the current thread runs, so code deep in the models
+# (e.g. waiting on a batch) can give up once the flow is cancelled
+@contextmanager
+def running(flow_id: str) -> Iterator[None]:
+    previous = getattr(_local, "flow_id", None)
+    _local.flow_id = flow_id
+    try:
+        yield
+    finally:
+        _local.flow_id = previous
+
+
+def current() -> Optional[str]:
+    return getattr(_local, "flow_id", None)
+
+
+# called by long stages between segments/blocks
+def check(flow_id: Optional[str] = None):
+    if is_cancelled(flow_id):
+        raise FlowCancelled(f"Flow {flow_id or current()} was cancelled")
@@ -0,0 +1,105 @@
+from typing import Dict, Hashable, List, Sequence, Tuple
+import numpy as np
+
+
+Turn = Tuple[float, float, Hashable]  # start, end and speaker
+
+
+# (start, end) in samples of overlapping windows covering the audio, the last
+# one is extended instead of leaving a window shorter than the overlap
+def windows(n_samples: int, window: int, overlap: int) -> List[Tuple[int, int]]:
+    if overlap >= window:
+        raise ValueError("The diarization overlap must be shorter than the window")
+    step = window - overlap
+    bounds = []
+    start = 0
+    while True:
+        end = min(start + window, n_samples)
+        if n_samples - end <= overlap:
+            bounds.append((start, n_samples))
+            return bounds
+        bounds.append((start, end))
+        start += step
+
+
+# part of the timeline each window is trusted for: up to the middle of the
+# overlap with its neighbours
+def owned_spans(bounds: Sequence[Tuple[float, float]]) -> List[Tuple[float, float]]:
+    spans = []
+    for k, (start, end) in enumerate(bounds):
+        if k > 0:
+            start = (start + bounds[k - 1][1]) / 2
+        if k + 1 < len(bounds):
+            end = (end + bounds[k + 1][0]) / 2
+        spans.append((start, end))
+    return spans
+
+
+# pyannote returns NaN for speakers with too little speech to embed and zero
+# pads the embeddings of speakers it could not find a slot for, neither has a
+# direction to compare
+def embeddable(embedding: np.ndarray) -> bool:
+    norm = np.linalg.norm(embedding)
+    return bool(np.isfinite(norm) and norm > 0)
+
+
+# Average linkage clustering of the speaker embeddings found in every window,
+# two speakers of the same window are never merged (the window already told
+# them apart). Merging stops when the closest clusters are further than the
+# cosine distance threshold. Returns a cluster per embedding, numbered by
+# first appearance. Embeddings that are not embeddable stay clusters of their own.
+def cluster_speakers(
+    embeddings: np.ndarray, groups: Sequence[int], threshold: float
+) -> List[int]:
+    n = len(embeddings)
+    if n == 0:
+        return []
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    usable = np.array([embeddable(e) for e in embeddings])
+    norms = np.linalg.norm(np.where(usable[:, None], embeddings, 1), axis=1)
+    x = np.where(usable[:, None], embeddings, 0) / norms[:, None]
+    # the mean similarity between two clusters of unit vectors is the dot
+    # product of their sums over the product of their sizes
+    sums = x.astype(np.float64)
+    counts = np.ones(n)
+    alive = np.ones(n, dtype=bool)
+    groups = np.asarray(groups)
+    conflict = np.equal.outer(groups, groups)
+    conflict[~usable] = True
+    conflict[:, ~usable] = True
+    label = np.arange(n)
+    while alive.sum() > 1:
+        similarity = sums @ sums.T / np.outer(counts, counts)
+        blocked = conflict | ~alive[:, None] | ~alive[None, :]
+        similarity[blocked] = -np.inf
+        a, b = np.unravel_index(np.argmax(similarity), similarity.shape)
+        if not np.isfinite(similarity[a, b]) or 1 - similarity[a, b] > threshold:
+            break
+        sums[a] += sums[b]
+        counts[a] += counts[b]
+        alive[b] = False
+        conflict[a] |= conflict[b]
+        conflict[:, a] |= conflict[:, b]
+        label[label == b] = a
+
+    numbering: Dict[int, int] = {}
+    return [numbering.setdefault(int(c), len(numbering)) for c in label]
+
+
+# turns of every window (relative to its start) on the global timeline, each
+# window only contributes the span it owns
+def stitch(
+    window_turns: Sequence[Sequence[Turn]],
+    bounds: Sequence[Tuple[float, float]],
+    speakers: Dict[Tuple[int, Hashable], Hashable],
+) -> List[Turn]:
+    turns: List[Turn] = []
+    for k, ((offset, _), (own_start, own_end)) in enumerate(
+        zip(bounds, owned_spans(bounds))
+    ):
+        for start, end, local in window_turns[k]:
+            start, end = max(start + offset, own_start), min(end + offset, own_end)
+            if end > start:
+                turns.append((start, end, speakers[(k, local)]))
+    turns.sort(key=lambda turn: turn[0])
+    return turns
@@ -0,0 +1,322 @@
+from typing import Any, Dict, List, Optional, Tuple
+from collections import defaultdict, OrderedDict
+from task import Task
+from log import logger
+import itertools
+import threading
+import heapq
+import time
+import os
+
+
+# users whose wait stats are kept, the least recently served are dropped
+USER_STATS_KEPT = int(os.environ.get("USER_STATS_KEPT", 1000))
+
+
+# queue.Queue look alike handed to the tasks of a user, Task only needs put
+# and task_done, everything else is answered by the dispatcher
+class UserQueue:
+    def __init__(self, dispatcher: "Dispatcher", user: str):
+        self.dispatcher = dispatcher
+        self.user = user
+
+    def put(self, task: Task, block: bool = True, timeout: Optional[float] = None):
+        self.dispatcher.put(self.user, task)
+
+    def task_done(self):
+        self.dispatcher.task_done(self.user)
+
+    def cancel(self, flow_id: str) -> int:
+        return self.dispatcher.cancel(self.user, flow_id)
+
+    def qsize(self) -> int:
+        return self.dispatcher.depth(self.user)
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    @property
+    def unfinished_tasks(self) -> int:
+        return self.dispatcher.unfinished(self.user)
+
+
+class _UserState:
+    def __init__(self, weight: float, vtime: float):
+        self.ready: List[Tuple[Any, ...]] = []  # heap of (key..., seq, task)
+        self.weight = weight
+        self.vtime = vtime  # seconds of service received scaled by the weight
+        self.running = 0
+        self.unfinished = 0
+
+    @property
+    def idle(self):
+        return not self.ready and not self.running and not self.unfinished
+
+
+class _WaitStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, wait: float):
+        self.count += 1
+        self.total += wait
+        self.max = max(self.max, wait)
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "mean_s": self.total / self.count if self.count else 0.0,
+            "max_s": self.max,
+        }
+
+
+# Ready queue shared by every worker. Users are served by start time fair
+# queuing (the active user with least weighted service goes next), a task is
+# charged the observed run time of its stage when it starts and corrected by
+# its own once it finishes. Inside a user the tasks of a higher stage priority
+# go first, then the ones of the shortest flow when shortest_job_first is set,
+# then the ones on the critical path of their flow. Priorities never take a
+# turn from another user.
+# Stage limits are enforced here so a worker never picks a task it can't run.
+class Dispatcher:
+    COST_SMOOTHING = 0.2
+
+    def __init__(
+        self,
+        stage_limits: Dict[str, int] = {},
+        weights: Dict[str, float] = {},
+        shortest_job_first: bool = True,
+        default_weight: float = 1.0,
+    ):
+        self.stage_limits = dict(stage_limits)
+        self.weights = dict(weights)
+        self.default_weight = default_weight
+        self.shortest_job_first = shortest_job_first
+
+        self._cond = threading.Condition()
+        self._users: Dict[str, _UserState] = {}
+        self._running_stages: Dict[str, int] = defaultdict(int)
+        self._vclock = 0.0
+        self._seq = itertools.count()
+        self._stage_costs: Dict[str, float] = {}  # seconds a task takes
+        self._charged: Dict[Task, float] = {}  # running task -> estimate charged
+
+        self._stage_waits: Dict[str, _WaitStats] = defaultdict(_WaitStats)
+        self._user_waits: "OrderedDict[str, _WaitStats]" = OrderedDict()
+
+    def __getitem__(self, user: str) -> UserQueue:
+        return UserQueue(self, user)
+
+    def _state(self, user: str) -> _UserState:
+        state = self._users.get(user)
+        if state is None:
+            # new or returning users start at the current virtual time, they
+            # don't get credit for the time they were away
+            state = _UserState(
+                self.weights.get(user, self.default_weight), self._vclock
+            )
+            self._users[user] = state
+        return state
+
+    def _sort_key(self, task: Task) -> Tuple[Any, ...]:
+        duration = task.metadata.get("duration", 0.0) or 0.0
+        # longest estimated path to the end of the flow first
+        critical_path = task.metadata.get("critical_path", 0.0) or 0.0
+        return (
+            -task.metadata.get("priority", 0),
+            duration if self.shortest_job_first else 0.0,
+            -critical_path,
+        )
+
+    def put(self, user: str, task: Task):
+        with self._cond:
+            state = self._state(user)
+            task.enqueued_at = time.monotonic()
+            heapq.heappush(state.ready, (*self._sort_key(task), next(self._seq), task))
+            state.unfinished += 1
+            self._cond.notify()
+
+    def task_done(self, user: str):
+        with self._cond:
+            state = self._users.get(user)
+            if state is None or state.unfinished <= 0:
+                raise ValueError(f"task_done() called too many times for {user}")
+            state.unfinished -= 1
+            self._forget_if_idle(user)
+
+    # drops the ready tasks of a flow, returns how many
+    def cancel(self, user: str, flow_id: str) -> int:
+        with self._cond:
+            state = self._users.get(user)
+            if state is None:
+                return 0
+            kept = [e for e in state.ready if e[-1].metadata["flow_id"] != flow_id]
+            removed = len(state.ready) - len(kept)
+            if removed:
+                state.ready = kept
+                heapq.heapify(state.ready)
+                state.unfinished -= removed
+                self._forget_if_idle(user)
+            return removed
+
+    def _forget_if_idle(self, user: str):
+        state = self._users.get(user)
+        if state is not None and state.idle:
+            logger.info(f"Removing queue for user {user} due to lack of task")
+            self._users.pop(user)
+
+    def _has_capacity(self, task: Task) -> bool:
+        stage = task.metadata["task_type"]
+        limit = self.stage_limits.get(stage)
+        return limit is None or self._running_stages[stage] < limit
+
+    # best task of the user a worker can run now, tasks of full stages are
+    # set aside and put back
+    def _pop(self, state: _UserState) -> Optional[Task]:
+        blocked = []
+        task = None
+        while state.ready:
+            entry = heapq.heappop(state.ready)
+            if self._has_capacity(entry[-1]):
+                task = entry[-1]
+                break
+            blocked.append(entry)
+        for entry in blocked:
+            heapq.heappush(state.ready, entry)
+        return task
+
+    def _pick(self) -> Optional[Task]:
+        candidates = [
+            (state.vtime, user) for user, state in self._users.items() if state.ready
+        ]
+        heapq.heapify(candidates)
+        while candidates:
+            _, user = heapq.heappop(candidates)
+            state = self._users[user]
+            task = self._pop(state)
+            if task is None:
+                continue
+            stage = task.metadata["task_type"]
+
+            self._vclock = max(self._vclock, state.vtime)
+            estimate = self._stage_costs.get(stage, 1.0)
+            self._charged[task] = estimate
+            state.vtime += estimate / state.weight
+            state.running += 1
+            self._running_stages[stage] += 1
+
+            wait = time.monotonic() - task.enqueued_at
+            self._stage_waits[stage].add(wait)
+            self._user_wait(user).add(wait)
+            return task
+        return None
+
+    def _user_wait(self, user: str) -> _WaitStats:
+        stats = self._user_waits.pop(user, None) or _WaitStats()
+        self._user_waits[user] = stats
+        while len(self._user_waits) > USER_STATS_KEPT:
+            self._user_waits.popitem(last=False)
+        return stats
+
+    # the estimate charged when the task started is replaced by its run time
+    def _charge(self, state: Optional[_UserState], task: Task):
+        estimate = self._charged.pop(task, None)
+        if estimate is None:
+            return
+        run_s = 0.0  # cancelled before it started
+        if task.started_at is not None:
+            stage = task.metadata["task_type"]
+            run_s = (task.finished_at or time.monotonic()) - task.started_at
+            cost = self._stage_costs.get(stage)
+            self._stage_costs[stage] = (
+                run_s if cost is None else cost + self.COST_SMOOTHING * (run_s - cost)
+            )
+        if state is not None:
+            state.vtime += (run_s - estimate) / state.weight
+
+    def get(
+        self, block: bool = True, timeout: Optional[float] = None
+    ) -> Optional[Task]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                task = self._pick()
+                if task is not None or not block:
+                    return task
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+    # must be called by the worker once it is done with a task returned by get
+    def finish(self, task: Task):
+        user = task.metadata["user"]
+        with self._cond:
+            self._running_stages[task.metadata["task_type"]] -= 1
+            state = self._users.get(user)
+            self._charge(state, task)
+            if state is not None:
+                state.running -= 1
+                if not task.done:
+                    # failed tasks never reach their task_done call
+                    state.unfinished -= 1
+                self._forget_if_idle(user)
+            # a stage slot got free, tasks skipped because of it can go now
+            self._cond.notify_all()
+
+    def depth(self, user: Optional[str] = None) -> int:
+        with self._cond:
+            if user is not None:
+                state = self._users.get(user)
+                return len(state.ready) if state else 0
+            return sum(len(state.ready) for state in self._users.values())
+
+    def unfinished(self, user: str) -> int:
+        with self._cond:
+            state = self._users.get(user)
+            return state.unfinished if state else 0
+
+    # a single process holds every websocket, there is nowhere to forward to
+    def forward(self, user: str, message: Dict[str, Any]) -> bool:
+        return False
+
+    def connected(self, user: str):
+        pass
+
+    def disconnected(self, user: str):
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            stage_depth: Dict[str, int] = defaultdict(int)
+            for state in self._users.values():
+                for entry in state.ready:
+                    stage_depth[entry[-1].metadata["task_type"]] += 1
+            return {
+                "depth": sum(stage_depth.values()),
+                "users": {
+                    user: {
+                        "depth": len(state.ready),
+                        "running": state.running,
+                        "weight": state.weight,
+                        "virtual_time": state.vtime,
+                    }
+                    for user, state in self._users.items()
+                },
+                "stages": {
+                    stage: {
+                        "depth": stage_depth.get(stage, 0),
+                        "running": self._running_stages.get(stage, 0),
+                        "limit": self.stage_limits.get(stage),
+                        "wait": self._stage_waits[stage].as_dict(),
+                    }
+                    for stage in set(stage_depth)
+                    | set(self._running_stages)
+                    | set(self._stage_waits)
+                },
+                "user_waits": {
+                    user: stats.as_dict() for user, stats in self._user_waits.items()
+                },
+            }
@@ -0,0 +1,593 @@
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Union
+from collections import OrderedDict
+from task import Task, partial
+from log import logger
+from journal import FlowJournal, FLOW_JOURNAL, FLOW_MAX_RECOVERIES
+from storage import getFilePath
+import cancellation
+import threading
+import time
+import os
+
+
+StageRef = Union[str, Callable[..., object]]
+
+
+class Stage:
+    def __init__(
+        self,
+        fn: Callable[..., Dict[str, Any]],
+        name: str,
+        after: List[str],
+        each: Optional[str],
+        first_of: Optional[str],
+        fan_out: Optional[Callable[[Dict[str, Any]], List[Dict[str, Any]]]],
+        streams: bool,
+        annotate: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]],
+        ends_flow: Optional[Callable[[Dict[str, Any]], bool]],
+        notify: bool,
+        cost: float,
+        size: Optional[Callable[[Dict[str, Any]], float]],
+        outputs: List[str],
+        priority: int,
+        message_type: Optional[str],
+    ):
+        self.fn = fn
+        self.name = name
+        self.after = after
+        self.each = each  # fan-out stage this one runs once per item of
+        self.first_of = first_of  # fan-out stage this one runs on the first item of
+        self.fan_out = fan_out  # turns the result into the items of the fan-out
+        self.streams = streams  # items are emitted while running, not at the end
+        self.annotate = annotate  # result -> metadata for the rest of the flow
+        # result -> True when the stages not started yet have nothing to do
+        self.ends_flow = ends_flow
+        self.notify = notify
+        self.cost = cost  # estimated seconds per task, refined while running
+        self.size = size  # item -> seconds of audio, for the metrics
+        self.outputs = outputs  # artifacts written, needed to reuse a result
+        # tasks of higher priority stages run first, among those of the user
+        self.priority = priority
+        # task_type of its messages to the user, defaults to the stage name
+        self.message_type = message_type
+
+    @property
+    def source(self) -> Optional[str]:
+        return self.each or self.first_of
+
+    @property
+    def fans_out(self) -> bool:
+        return self.fan_out is not None or self.streams
+
+
+# flows by name, to rebuild the interrupted ones from their journal
+DEFINITIONS: Dict[str, "Flow"] = {}
+
+
+# Declarative description of a pipeline: a DAG of stages where a stage can
+# fan out over the items found by a previous stage (e.g. voice segments) and
+# a later stage can join all of them back. Flows are compiled once and
+# instantiated with run() for every upload.
+class Flow:
+    COST_SMOOTHING = 0.2
+
+    def __init__(self, name: str, on_finish: Callable[["FlowRun"], None] = None):
+        self.name = name
+        self.on_finish = on_finish
+        self.stages: Dict[str, Stage] = {}
+        self.order: List[str] = []
+        self.children: Dict[str, List[str]] = {}
+        self.compiled = False
+        self._lock = threading.Lock()
+        DEFINITIONS[name] = self
+
+    @staticmethod
+    def stage_name(ref: StageRef) -> str:
+        return ref if isinstance(ref, str) else Task.get_on_call_name(ref)
+
+    def stage(
+        self,
+        fn: Callable[..., Dict[str, Any]],
+        after: Iterable[StageRef] = (),
+        each: Optional[StageRef] = None,
+        first_of: Optional[StageRef] = None,
+        fan_out: Optional[Callable[[Dict[str, Any]], List[Dict[str, Any]]]] = None,
+        streams: bool = False,
+        annotate: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+        ends_flow: Optional[Callable[[Dict[str, Any]], bool]] = None,
+        notify: bool = True,
+        cost: float = 1.0,
+        size: Optional[Callable[[Dict[str, Any]], float]] = None,
+        outputs: Iterable[str] = (),
+        name: Optional[str] = None,
+        priority: int = 0,
+        message_type: Optional[str] = None,
+    ) -> "Flow":
+        name = name or self.stage_name(fn)
+        if name in self.stages:
+            raise ValueError(f"Stage {name} already defined in flow {self.name}")
+        if each is not None and first_of is not None:
+            raise ValueError(f"Stage {name} can't set both each and first_of")
+        self.stages[name] = Stage(
+            fn,
+            name,
+            [self.stage_name(a) for a in after],
+            self.stage_name(each) if each is not None else None,
+            self.stage_name(first_of) if first_of is not None else None,
+            fan_out,
+            streams,
+            annotate,
+            ends_flow,
+            notify,
+            cost,
+            size,
+            list(outputs),
+            priority,
+            message_type,
+        )
+        self.compiled = False
+        return self
+
+    def compile(self) -> "Flow":
+        for stage in self.stages.values():
+            for dep in stage.after:
+                if dep not in self.stages:
+                    raise ValueError(f"Stage {stage.name} depends on unknown {dep}")
+            if stage.source is not None:
+                source = self.stages.get(stage.source)
+                if source is None or not source.fans_out:
+                    raise ValueError(
+                        f"Stage {stage.name} iterates {stage.source} which does not fan out"
+                    )
+
+        order: List[str] = []
+        state: Dict[str, int] = {}  # 1 visiting, 2 done
+
+        def visit(name: str):
+            if state.get(name) == 2:
+                return
+            if state.get(name) == 1:
+                raise ValueError(f"Flow {self.name} has a cycle through {name}")
+            state[name] = 1
+            stage = self.stages[name]
+            for dep in stage.after + ([stage.source] if stage.source else []):
+                visit(dep)
+            state[name] = 2
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+
+        children: Dict[str, List[str]] = {name: [] for name in self.stages}
+        # fan-out stages whose items a stage depends on
+        sources: Dict[str, Set[str]] = {}
+        for name in order:
+            stage = self.stages[name]
+            parents = set(stage.after) | ({stage.source} if stage.source else set())
+            sources[name] = {stage.source} if stage.source else set()
+            for dep in parents:
+                children[dep].append(name)
+                if dep != stage.source:
+                    sources[name] |= sources[dep]
+            if stage.fans_out and sources[name]:
+                raise ValueError(f"Nested fan-out on {name} is not supported")
+            for dep in stage.after:
+                dep_each = self.stages[dep].each
+                if dep_each is not None and stage.each not in (None, dep_each):
+                    raise ValueError(
+                        f"Stage {name} can't join {dep} while iterating {stage.each}"
+                    )
+
+        self.order = order
+        self.children = children
+        self.compiled = True
+        return self
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            stage = self.stages[name]
+            stage.cost += self.COST_SMOOTHING * (seconds - stage.cost)
+
+    # estimated seconds from the start of a task of this stage to the end of
+    # the flow, following the most expensive chain of dependants
+    def critical_path(self, name: str) -> float:
+        memo: Dict[str, float] = {}
+
+        def rank(n: str) -> float:
+            if n not in memo:
+                memo[n] = self.stages[n].cost + max(
+                    (rank(c) for c in self.children[n]), default=0.0
+                )
+            return memo[n]
+
+        return rank(name)
+
+    def run(
+        self,
+        flow_id: str,
+        queue: Any,
+        metadata: Dict[str, Any] = {},
+        journal: bool = FLOW_JOURNAL,
+    ):
+        if not self.compiled:
+            self.compile()
+        return FlowRun(self, flow_id, queue, metadata, journal)
+
+
+FLOWS: Dict[str, "FlowRun"] = {}
+# progress of the last finished flows, for status queries
+FINISHED_FLOWS_KEPT = int(os.environ.get("FINISHED_FLOWS_KEPT", 256))
+FINISHED: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+# flows end on the worker threads while /status reads
+FINISHED_LOCK = threading.Lock()
+
+
+def finished_progress(flow_id: str) -> Optional[Dict[str, Any]]:
+    with FINISHED_LOCK:
+        return FINISHED.get(flow_id)
+
+
+# A flow being executed, it creates the tasks of every stage as soon as what
+# they depend on exists (items of a fan-out included) and wires them through
+# Task dependencies
+class FlowRun:
+    def __init__(
+        self,
+        flow: Flow,
+        flow_id: str,
+        queue: Any,
+        metadata: Dict[str, Any] = {},
+        journal: bool = FLOW_JOURNAL,
+    ):
+        self.flow = flow
+        self.flow_id = flow_id
+        self.queue = queue
+        self.metadata = {**metadata}
+        self.tasks: Dict[str, List[Task]] = {}
+        self.items: Dict[str, List[Dict[str, Any]]] = {}
+        self.closed: Set[str] = set()  # fan-outs that won't emit more items
+        self.dropped: Set[str] = set()
+        self.finished = False
+        self.cancelled = False
+        self.failed = False
+        self.started_at: float = None
+        self.finished_at: float = None
+        self.journal = FlowJournal(flow_id) if journal else None
+        # (stage, item index) -> result journaled before a restart
+        self.recovered: Dict[Any, Dict[str, Any]] = {}
+        self._positions: Dict[Task, int] = {}  # index of the item of a task
+        self._lock = threading.Lock()
+
+    @property
+    def done(self) -> bool:
+        with self._lock:
+            return self._done()
+
+    def _done(self) -> bool:
+        for name in self.flow.stages:
+            if name not in self.dropped and not self._complete(name):
+                return False
+        return all(t.done for tasks in self.tasks.values() for t in tasks)
+
+    def _finish(self):
+        with self._lock:
+            if self.finished or not self._done():
+                return
+            self.finished = True
+            self.finished_at = time.monotonic()
+        logger.info(f"Flow {self.flow_id} finished")
+        self._end()
+
+    def _end(self):
+        progress = self.progress()
+        with FINISHED_LOCK:
+            FINISHED[self.flow_id] = progress
+            FINISHED.move_to_end(self.flow_id)
+            while len(FINISHED) > FINISHED_FLOWS_KEPT:
+                FINISHED.popitem(last=False)
+        if FLOWS.get(self.flow_id) is self:
+            FLOWS.pop(self.flow_id)
+        if self.journal is not None:
+            self.journal.remove()
+        if self.flow.on_finish:
+            self.flow.on_finish(self)
+
+    def start(self) -> bool:
+        self.started_at = time.monotonic()
+        FLOWS[self.flow_id] = self
+        cancellation.forget(self.flow_id)  # the upload may be run again
+        if self.journal is not None and not self.recovered:
+            self.journal.remove()  # left by an earlier run of the same upload
+            self.journal.write("start", flow=self.flow.name, metadata=self.metadata)
+        with self._lock:
+            created = self._instantiate()
+        return all([task.enqueue() for task in created if not task.dependencies])
+
+    # stops the flow: queued tasks are dropped, running ones stop at their next
+    # cancellation check and nothing new is created or enqueued
+    def cancel(self, reason: str = "cancelled") -> bool:
+        if not self._stop():
+            return False
+        dropped = self.queue.cancel(self.flow_id)
+        logger.info(
+            f"Flow {self.flow_id} cancelled ({reason}), {dropped} tasks dropped"
+        )
+        self._end()
+        return True
+
+    def _stop(self, failed: bool = False) -> bool:
+        with self._lock:
+            if self.finished:
+                return False
+            self.finished = True
+            self.cancelled = not failed
+            self.failed = failed
+            self.finished_at = time.monotonic()
+            for tasks in self.tasks.values():
+                for task in tasks:
+                    if not task.done:
+                        task.cancelled = True
+        cancellation.cancel(self.flow_id)
+        return True
+
+    # takes the results of the tasks finished before the flow was interrupted,
+    # items streamed by a stage only count if the stage finished as well
+    def restore(self, records: List[Dict[str, Any]]):
+        for record in records:
+            if record["event"] == "done":
+                self.recovered[(record["stage"], record["k"])] = record["result"]
+        for name, stage in self.flow.stages.items():
+            if stage.streams and not self._has_outputs(stage):
+                self.recovered.pop((name, None), None)  # streams its items again
+        for record in records:
+            if record["event"] == "emit" and (record["stage"], None) in self.recovered:
+                self.items.setdefault(record["stage"], []).append(record["item"])
+
+    # every task the stage will ever have has been created
+    def _complete(self, name: str) -> bool:
+        stage = self.flow.stages[name]
+        if name not in self.tasks:
+            return False
+        if stage.each is None:
+            return True
+        return stage.each in self.closed and len(self.tasks[name]) == len(
+            self.items[stage.each]
+        )
+
+    def _instantiate(self) -> List[Task]:
+        created: List[Task] = []
+        for name in self.flow.order:
+            if name in self.dropped:
+                continue
+            stage = self.flow.stages[name]
+            deps = [d for d in stage.after if d != stage.source]
+            items = self.items.get(stage.source, [])
+            if any(d in self.dropped for d in deps) or (
+                stage.source in self.closed and not items
+            ):
+                # a fan-out without items ends every branch that needs it
+                self.dropped.add(name)
+                continue
+
+            if stage.each is None:
+                if name in self.tasks:
+                    continue
+                if stage.first_of is not None and not items:
+                    continue
+                if not all(self._complete(d) for d in deps):
+                    continue
+                self.tasks[name] = [self._create(stage, items[0] if items else {})]
+                created.extend(self.tasks[name])
+                continue
+
+            tasks = self.tasks.setdefault(name, [])
+            for k in range(len(tasks), len(items)):
+                if not all(
+                    d in self.tasks
+                    and (self.flow.stages[d].each is None or len(self.tasks[d]) > k)
+                    for d in deps
+                ):
+                    break
+                tasks.append(self._create(stage, items[k], k))
+                created.append(tasks[-1])
+        return created
+
+    def _has_outputs(self, stage: Stage) -> bool:
+        return all(getFilePath(self.flow_id, name).exists() for name in stage.outputs)
+
+    def _create(self, stage: Stage, item: Dict[str, Any], k: int = None) -> Task:
+        metadata = {
+            **self.metadata,
+            "critical_path": self.flow.critical_path(stage.name),
+            "priority": stage.priority,
+        }
+        if stage.message_type is not None:
+            metadata["message_type"] = stage.message_type
+        if stage.size is not None:
+            metadata["input_seconds"] = stage.size(item)
+        deps: List[Task] = []
+        join = False
+        for dep in stage.after:
+            if dep == stage.source:
+                continue  # its result reaches the task through the item
+            dep_tasks = self.tasks[dep]
+            if self.flow.stages[dep].each is None:
+                deps.extend(dep_tasks)
+            elif stage.each is not None:
+                deps.append(dep_tasks[k])
+            else:
+                deps.extend(dep_tasks)
+                join = True
+
+        call = partial(stage.fn, **item)
+        if stage.streams:
+            call = partial(call, emit=partial(self._emit, stage.name))
+        task = Task(
+            self.flow_id,
+            call,
+            self.queue,
+            deps,
+            metadata,
+            name=stage.name,
+            # a join receives a list per argument, even for single tasks
+            unpack_single=not join,
+            notify=stage.notify,
+            on_done=self._on_done,
+            on_failed=self._on_failed,
+        )
+        result = self.recovered.pop((stage.name, k), None)
+        if result is not None and self._has_outputs(stage):
+            task.recovered = result
+        if k is not None:
+            self._positions[task] = k
+        return task
+
+    # what is done and what is left, remaining time is estimated from the
+    # observed stage costs along the longest chain still to run
+    def progress(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            stages = {}
+            remaining_s = 0.0
+            remaining_work_s = 0.0
+            for name in self.flow.order:
+                stage = self.flow.stages[name]
+                tasks = self.tasks.get(name, [])
+                done = sum(t.done for t in tasks)
+                running = sum(t.started and not t.done and not t.error for t in tasks)
+                failed = [t.error for t in tasks if t.error]
+                expected = len(tasks)
+                if stage.each is not None:
+                    expected = len(self.items.get(stage.each, []))
+                elif name not in self.dropped:
+                    expected = max(expected, 1)
+                stages[name] = {
+                    "done": done,
+                    "running": running,
+                    "queued": sum(t.enqueued and not t.started for t in tasks),
+                    "created": len(tasks),
+                    # unknown while the items of its fan-out are being found
+                    "total": (
+                        expected
+                        if stage.each is None or stage.each in self.closed
+                        else None
+                    ),
+                    "dropped": name in self.dropped,
+                    "errors": failed,
+                }
+                left = 0 if name in self.dropped else expected - done
+                if left > 0:
+                    remaining_work_s += left * stage.cost
+                    remaining_s = max(remaining_s, self.flow.critical_path(name))
+            return {
+                "flow_id": self.flow_id,
+                "flow": self.flow.name,
+                "finished": self.finished,
+                "cancelled": self.cancelled,
+                "failed": self.failed,
+                "elapsed_s": (self.finished_at or now) - (self.started_at or now),
+                "remaining_s": 0.0 if self.finished else remaining_s,
+                "remaining_work_s": 0.0 if self.finished else remaining_work_s,
+                "items": {
+                    name: {"found": len(items), "closed": name in self.closed}
+                    for name, items in self.items.items()
+                },
+                "stages": stages,
+            }
+
+    # called by streaming stages for every item they find
+    def _emit(self, name: str, item: Dict[str, Any]):
+        if self.cancelled or self.failed:
+            cancellation.check(self.flow_id)
+        if self.journal is not None:
+            self.journal.write("emit", stage=name, item=item)
+        with self._lock:
+            self.items.setdefault(name, []).append(item)
+            created = self._instantiate()
+        for t in created:
+            t.enqueue()
+
+    # called by the task before its dependants are enqueued
+    def _on_done(self, task: Task):
+        stage = self.flow.stages[task.id[1]]
+        if task.started_at is not None and task.finished_at is not None:
+            self.flow.observe(stage.name, task.finished_at - task.started_at)
+        if self.cancelled or self.failed:
+            return
+        if self.journal is not None and task.recovered is None:
+            self.journal.write(
+                "done",
+                stage=stage.name,
+                k=self._positions.get(task),
+                result=task.result,
+            )
+        with self._lock:
+            if stage.annotate is not None:
+                self.metadata.update(stage.annotate(task.result))
+            if stage.ends_flow is not None and stage.ends_flow(task.result):
+                self._skip_rest()
+            if stage.fans_out:
+                items = self.items.setdefault(stage.name, [])
+                if stage.fan_out is not None:
+                    items.extend(stage.fan_out(task.result))
+                self.closed.add(stage.name)
+                logger.info(
+                    f"Flow {self.flow_id} fans out {len(items)} items from {stage.name}"
+                )
+            created = self._instantiate()
+        # tasks depending on this one are enqueued by it once it is done
+        for t in created:
+            t.enqueue()
+        self._finish()
+
+    # drops the stages none of whose tasks were enqueued yet
+    def _skip_rest(self):
+        for name in self.flow.order:
+            tasks = self.tasks.get(name, [])
+            if any(task.enqueued for task in tasks):
+                continue
+            for task in tasks:
+                task.cancelled = True
+            self.tasks.pop(name, None)
+            self.dropped.add(name)
+
+    # a task raised: what depends on it can't run, the rest of the flow is
+    # stopped like a cancellation so its artifacts and journal are cleaned up
+    def _on_failed(self, task: Task):
+        if not self._stop(failed=True):
+            return
+        dropped = self.queue.cancel(self.flow_id)
+        logger.error(
+            f"Flow {self.flow_id} failed on {task.id[1]}: {task.error},"
+            f" {dropped} tasks dropped"
+        )
+        self._end()
+
+
+# restarts the flows interrupted by a crash or restart of the backend, tasks
+# with a journaled result are not run again
+def recover_flows(queues: Any) -> List[FlowRun]:
+    runs: List[FlowRun] = []
+    for flow_id in FlowJournal.pending():
+        journal = FlowJournal(flow_id)
+        records = journal.read()
+        start = next((r for r in records if r["event"] == "start"), None)
+        recoveries = sum(r["event"] == "recover" for r in records)
+        flow = DEFINITIONS.get(start["flow"]) if start else None
+        if flow_id in FLOWS:
+            continue
+        if flow is None or recoveries >= FLOW_MAX_RECOVERIES:
+            logger.warning(
+                f"Not recovering flow {flow_id} after {recoveries} recoveries"
+            )
+            journal.remove()
+            continue
+        run = flow.run(flow_id, queues[start["metadata"]["user"]], start["metadata"])
+        run.restore(records)
+        journal.write("recover")
+        logger.info(
+            f"Recovering flow {flow_id} with {len(run.recovered)} finished tasks"
+        )
+        if run.start():
+            runs.append(run)
+    return runs
@@ -0,0 +1,29 @@
+# Production server: gevent greenlets hold the requests and websockets, an idle
+# client costs a few KB instead of a couple of threads. The models run in the
+# worker.py processes sharing the sqlite queue, CPU bound work in this process
+# would stall every connection. Streaming decode (stream=1, STREAMING_DECODE)
+# runs in the process of its flow and is turned off here. Live sessions need
+# the models too, LIVE_URL sends their clients to a python3 app.py node.
+#
+#   QUEUE_BACKEND=sqlite gunicorn -c gunicorn.conf.py app:app
+#   QUEUE_BACKEND=sqlite python3 worker.py
+import os
+
+if os.environ.get("QUEUE_BACKEND") != "sqlite":
+    raise SystemExit("gunicorn serves the web tier only, set QUEUE_BACKEND=sqlite")
+# no model workers in the server process
+os.environ["WORKERS"] = "0"
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+worker_class = "gevent"
+# the flows started here (/status, /cancel) live in this process
+workers = 1
+# open requests and websockets
+worker_connections = int(os.environ.get("SERVER_MAX_CONNECTIONS", 10000))
+graceful_timeout = 30
+
+
+def post_worker_init(worker):
+    from app import start
+
+    start()
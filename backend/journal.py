@@ -0,0 +1,71 @@
+from typing import Any, Dict, Iterator, List
+from log import logger
+import storage
+import threading
+import pickle
+import os
+
+
+FLOW_JOURNAL = os.environ.get("FLOW_JOURNAL", "1") == "1"
+# a flow that keeps crashing the backend is dropped after this many restarts
+FLOW_MAX_RECOVERIES = int(os.environ.get("FLOW_MAX_RECOVERIES", 3))
+
+
+# Append only log of a flow kept next to its upload: how it was started, the
+# result of every finished task and the items streamed by its stages. Results
+# are pickled, some (the diarization) are not plain json. It is removed when
+# the flow finishes, what is left on startup belongs to interrupted flows.
+class FlowJournal:
+    NAME = "journal"
+    EXT = "pkl"
+
+    def __init__(self, flow_id: str):
+        self.flow_id = flow_id
+        self.path = storage.getFilePath(flow_id, self.NAME, ext=self.EXT)
+        self._lock = threading.Lock()
+
+    def write(self, event: str, **fields: Any):
+        try:
+            record = pickle.dumps({"event": event, **fields})
+        except Exception as e:
+            # the task runs again after a restart, nothing else is lost
+            logger.warning("Not journaling %s of flow %s: %r", event, self.flow_id, e)
+            return
+        with self._lock:
+            with open(self.path, "ab") as f:
+                f.write(record)
+
+    def read(self) -> List[Dict[str, Any]]:
+        records = []
+        try:
+            with open(self.path, "rb") as f:
+                while True:
+                    try:
+                        records.append(pickle.load(f))
+                    except EOFError:
+                        break
+                    except Exception:
+                        # torn write of the last record when the process died
+                        break
+        except FileNotFoundError:
+            pass
+        return records
+
+    def remove(self):
+        with self._lock:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    # flows with a journal left, their folders are directly under DATA
+    @staticmethod
+    def pending() -> Iterator[str]:
+        name = f"{FlowJournal.NAME}.{FlowJournal.EXT}"
+        try:
+            entries = sorted(os.scandir(storage.DATA), key=lambda e: e.name)
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if entry.is_dir() and os.path.exists(os.path.join(entry.path, name)):
+                yield entry.name
@@ -0,0 +1,350 @@
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+from collections import deque
+from whisperx.audio import SAMPLE_RATE
+from models import logger, AIModels
+from streaming import StreamingVAD
+import numpy as np
+import threading
+import json
+import time
+import uuid
+import os
+
+
+# seconds of audio kept per session, a segment must be transcribed before its
+# samples are overwritten
+LIVE_BUFFER_S = float(os.environ.get("LIVE_BUFFER_S", 60))
+# the vad runs once this much new audio arrived, and closes a segment after
+# this much silence
+LIVE_VAD_STEP_S = float(os.environ.get("LIVE_VAD_STEP_S", 0.5))
+LIVE_VAD_WINDOW_S = float(os.environ.get("LIVE_VAD_WINDOW_S", 2))
+LIVE_VAD_MARGIN_S = float(os.environ.get("LIVE_VAD_MARGIN_S", 0.6))
+# provisional text of the segment being spoken, at most this often
+LIVE_PARTIAL_S = float(os.environ.get("LIVE_PARTIAL_S", 1))
+LIVE_PARTIAL_PROFILE = os.environ.get("LIVE_PARTIAL_PROFILE", "fast")
+LIVE_PROFILE = os.environ.get("LIVE_PROFILE", "balanced")
+# speech needed to detect the language when the client did not give it
+LIVE_LANGUAGE_MIN_S = float(os.environ.get("LIVE_LANGUAGE_MIN_S", 3))
+LIVE_MAX_SESSIONS = int(os.environ.get("LIVE_MAX_SESSIONS", 8))
+
+
+# Fixed size buffer of the last samples of a stream, addressed by absolute
+# sample index
+class RingBuffer:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self._data = np.zeros(capacity, dtype=np.float32)
+        self.end = 0  # samples written since the start of the stream
+
+    @property
+    def start(self) -> int:
+        return max(0, self.end - self.capacity)
+
+    def write(self, samples: np.ndarray):
+        skipped = max(0, len(samples) - self.capacity)
+        self.end += skipped
+        samples = samples[skipped:]
+        head = self.end % self.capacity
+        first = min(len(samples), self.capacity - head)
+        self._data[head : head + first] = samples[:first]
+        self._data[: len(samples) - first] = samples[first:]
+        self.end += len(samples)
+
+    # copy of the samples in [start, end), the overwritten ones are skipped
+    def read(self, start: int, end: int) -> np.ndarray:
+        start, end = max(start, self.start), min(end, self.end)
+        if end <= start:
+            return np.zeros(0, dtype=np.float32)
+        head, tail = start % self.capacity, end % self.capacity
+        if head < tail or tail == 0:
+            return self._data[head : tail or self.capacity].copy()
+        return np.concatenate([self._data[head:], self._data[:tail]])
+
+
+# A client streaming pcm (16kHz mono s16le) over its websocket. Frames are
+# only buffered by the receiving thread, a thread per session runs the vad
+# over the new audio and transcribes every segment as soon as it is closed,
+# with urgent priority in the transcription batcher, so the latency does not
+# depend on the load of the batch flows.
+class LiveSession:
+    def __init__(
+        self,
+        user: str,
+        session_id: str,
+        send: Callable[[str, Dict[str, Any]], None],
+        lang: Optional[str] = None,
+        profile: str = LIVE_PROFILE,
+        partials: bool = False,
+    ):
+        self.user = user
+        self.session_id = session_id
+        self.send = send
+        self.lang = lang
+        self.profile = profile
+        self.partials = partials
+        self.ring = RingBuffer(int(LIVE_BUFFER_S * SAMPLE_RATE))
+        self.vad = StreamingVAD(
+            AIModels.get_voice_segments, LIVE_VAD_WINDOW_S, LIVE_VAD_MARGIN_S
+        )
+        self.step = int(LIVE_VAD_STEP_S * SAMPLE_RATE)
+        self._cond = threading.Condition()
+        self._fed = 0  # samples given to the vad
+        self._stopped = False
+        self._odd = b""  # half sample left by the last frame
+        # (absolute sample, monotonic time it arrived), for the latency
+        self._arrivals: Deque[Tuple[int, float]] = deque()
+        self._last_partial = 0.0
+        self.segments = 0
+        self.latencies: List[float] = []
+        self.thread = threading.Thread(
+            target=self._run, name=f"live_{session_id}", daemon=True
+        )
+
+    def start(self):
+        self._emit("live_started", sample_rate=SAMPLE_RATE, lang=self.lang)
+        self.thread.start()
+
+    def feed(self, frame: bytes):
+        frame = self._odd + frame
+        usable = len(frame) - len(frame) % 2
+        self._odd = frame[usable:]
+        samples = np.frombuffer(frame[:usable], np.int16).astype(np.float32) / 32768.0
+        with self._cond:
+            if self._stopped:
+                return
+            self.ring.write(samples)
+            self._arrivals.append((self.ring.end, time.monotonic()))
+            self._cond.notify()
+
+    # the audio received so far is still transcribed
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def _emit(self, task_type: str, **fields: Any):
+        self.send(
+            self.user, {"task_type": task_type, "task_id": self.session_id, **fields}
+        )
+
+    def _next_audio(self) -> Tuple[np.ndarray, bool]:
+        with self._cond:
+            while not self._stopped and self.ring.end - self._fed < self.step:
+                timeout = None
+                if self.partials and self.vad.open_start is not None:
+                    timeout = LIVE_PARTIAL_S
+                if not self._cond.wait(timeout):
+                    break
+            if self._fed < self.ring.start:
+                logger.warning(
+                    "Live session %s is %.1fs behind, skipping audio",
+                    self.session_id,
+                    (self.ring.start - self._fed) / SAMPLE_RATE,
+                )
+                # what the vad buffered is gone, so are the positions after it
+                self.vad.reset(self.ring.start)
+            audio = self.ring.read(self._fed, self.ring.end)
+            self._fed = self.ring.end
+            return audio, self._stopped
+
+    def _run(self):
+        try:
+            while True:
+                audio, stopped = self._next_audio()
+                if len(audio):
+                    for segment in self.vad.feed(audio):
+                        self._finalize(*segment)
+                if stopped:
+                    for segment in self.vad.flush():
+                        self._finalize(*segment)
+                    break
+                self._partial()
+        except Exception as e:
+            logger.exception(e)
+            self._emit("live_error", error=str(e))
+            return
+        finally:
+            with self._cond:
+                self._stopped = True
+        self._emit(
+            "live_finished",
+            segments=self.segments,
+            audio_s=self.ring.end / SAMPLE_RATE,
+            lang=self.lang,
+        )
+
+    def _language(self, audio: np.ndarray, key: Any) -> str:
+        if self.lang is None:
+            self.lang = AIModels.get_language(audio, key)
+            self._emit("live_language", lang=self.lang)
+        return self.lang
+
+    def _finalize(self, start_s: float, end_s: float):
+        start, end = int(start_s * SAMPLE_RATE), int(end_s * SAMPLE_RATE)
+        audio = self.ring.read(start, end)
+        if not len(audio):
+            return
+        i = self.segments
+        self.segments += 1
+        key = (self.session_id, i)
+        lang = self._language(audio, key)
+        text = "".join(
+            AIModels.get_transcription(audio, lang, key, self.profile, urgent=True)
+        )
+        latency = time.monotonic() - self._arrived(end)
+        self.latencies.append(latency)
+        self._emit(
+            "live_transcription",
+            i=i,
+            start=start_s,
+            end=end_s,
+            text=text,
+            lang=lang,
+            latency_s=latency,
+        )
+
+    # provisional text of the speech going on, replaced by its transcription
+    def _partial(self):
+        if not self.partials or self.vad.open_start is None:
+            return
+        if time.monotonic() - self._last_partial < LIVE_PARTIAL_S:
+            return
+        start = int(self.vad.open_start * SAMPLE_RATE)
+        audio = self.ring.read(start, self._fed)
+        if self.lang is None and len(audio) < LIVE_LANGUAGE_MIN_S * SAMPLE_RATE:
+            return
+        self._last_partial = time.monotonic()
+        lang = self._language(audio, None)
+        text = "".join(
+            AIModels.get_transcription(
+                audio, lang, None, LIVE_PARTIAL_PROFILE, urgent=True
+            )
+        )
+        self._emit(
+            "live_partial",
+            i=self.segments,
+            start=self.vad.open_start,
+            end=self._fed / SAMPLE_RATE,
+            text=text,
+        )
+
+    # when the sample was received, older arrivals are dropped
+    def _arrived(self, sample: int) -> float:
+        with self._cond:
+            while len(self._arrivals) > 1 and self._arrivals[0][0] < sample:
+                self._arrivals.popleft()
+            return self._arrivals[0][1] if self._arrivals else time.monotonic()
+
+
+# Live sessions of the connections of this process, a connection has at most
+# one going on
+class LiveSessions:
+    def __init__(self, max_sessions: int = LIVE_MAX_SESSIONS):
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._sessions: Dict[int, LiveSession] = {}
+
+        # stats
+        self.started = 0
+        self.rejected = 0
+        self.latencies: Deque[float] = deque(maxlen=1000)
+
+    # a {"live": "start"|"stop", ...} text frame, None for any other frame
+    @staticmethod
+    def command(frame: Any) -> Optional[Dict[str, Any]]:
+        if not isinstance(frame, str):
+            return None
+        try:
+            data = json.loads(frame)
+        except ValueError:
+            return None
+        if isinstance(data, dict) and "live" in data:
+            return data
+        return None
+
+    def start(
+        self,
+        conn: Any,
+        user: str,
+        command: Dict[str, Any],
+        send: Callable[[str, Dict[str, Any]], None],
+    ) -> Optional[LiveSession]:
+        self.stop(conn)
+        session_id = str(command.get("session") or uuid.uuid4().hex)
+        profile = command.get("profile") or LIVE_PROFILE
+        try:
+            AIModels.get_asr_options(profile)
+        except ValueError as e:
+            send(
+                user,
+                {"task_type": "live_error", "task_id": session_id, "error": str(e)},
+            )
+            return None
+        with self._lock:
+            running = sum(1 for s in self._sessions.values() if s.thread.is_alive())
+            if running >= self.max_sessions:
+                self.rejected += 1
+                session = None
+            else:
+                session = LiveSession(
+                    user,
+                    session_id,
+                    send,
+                    lang=command.get("lang"),
+                    profile=profile,
+                    partials=bool(command.get("partials", False)),
+                )
+                self._sessions[id(conn)] = session
+                self.started += 1
+        if session is None:
+            error = f"Too many live sessions, at most {self.max_sessions}"
+            send(
+                user, {"task_type": "live_error", "task_id": session_id, "error": error}
+            )
+            return None
+        session.start()
+        return session
+
+    def feed(self, conn: Any, frame: bytes):
+        with self._lock:
+            session = self._sessions.get(id(conn))
+        if session is not None:
+            session.feed(frame)
+
+    def stop(self, conn: Any):
+        with self._lock:
+            session = self._sessions.pop(id(conn), None)
+        if session is not None:
+            session.stop()
+            self.latencies.extend(session.latencies)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            sessions = list(self._sessions.values())
+            latencies = list(self.latencies)
+        for session in sessions:
+            latencies.extend(session.latencies)
+        return {
+            "started": self.started,
+            "rejected": self.rejected,
+            "running": [
+                {
+                    "user": s.user,
+                    "session": s.session_id,
+                    "audio_s": s.ring.end / SAMPLE_RATE,
+                    "segments": s.segments,
+                }
+                for s in sessions
+            ],
+            "latency_s": (
+                {
+                    "p50": float(np.percentile(latencies, 50)),
+                    "p90": float(np.percentile(latencies, 90)),
+                }
+                if latencies
+                else {}
+            ),
+        }
+
+
+LIVE = LiveSessions()
@@ -0,0 +1,8 @@
+import logging
+
+logging.basicConfig(level=logging.NOTSET)
+
+# shared by the backend modules, those that don't run models can log without
+# importing models and with it torch and whisperx
+logger = logging.getLogger("speech2text")
+logger.setLevel(logging.DEBUG)
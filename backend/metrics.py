@@ -0,0 +1,185 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from collections import defaultdict
+from task import Task
+import threading
+import bisect
+import math
+
+
+PREFIX = "speech2text"
+SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+AUDIO_BUCKETS = (1, 5, 10, 20, 30, 60, 300, 600, 1800, 3600)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def format_labels(labels: Labels, extra: Dict[str, str] = {}) -> str:
+    pairs = [*labels, *extra.items()]
+    if not pairs:
+        return ""
+    escaped = [
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    ]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Iterable[float]):
+        self.name = name
+        self.help = help
+        self.buckets = sorted(buckets)
+        # labels -> (counts per bucket, sum, count)
+        self._series: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(sorted(labels.items()))
+        counts, total = self._series.setdefault(
+            key, ([0] * (len(self.buckets) + 1), [0.0])
+        )
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip([*self.buckets, math.inf], counts):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else repr(float(bound))
+                lines.append(
+                    f"{self.name}_bucket{format_labels(labels, {'le': le})} {cumulative}"
+                )
+            lines.append(f"{self.name}_sum{format_labels(labels)} {total[0]}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {cumulative}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[Labels, float] = defaultdict(float)
+
+    def inc(self, value: float = 1, **labels: str):
+        self._values[tuple(sorted(labels.items()))] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{format_labels(labels)} {value}")
+        return lines
+
+
+def gauge(name: str, help: str, values: Dict[Labels, float]) -> List[str]:
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+    for labels, value in sorted(values.items()):
+        lines.append(f"{name}{format_labels(labels)} {value}")
+    return lines
+
+
+# Timings of every task run by the workers, aggregated by stage
+class TaskMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.wait = Histogram(
+            f"{PREFIX}_task_queue_seconds",
+            "Time from enqueue to start of a task",
+            SECONDS_BUCKETS,
+        )
+        self.run = Histogram(
+            f"{PREFIX}_task_run_seconds", "Time running a task", SECONDS_BUCKETS
+        )
+        self.input = Histogram(
+            f"{PREFIX}_task_input_audio_seconds",
+            "Seconds of audio processed by a task, when known",
+            AUDIO_BUCKETS,
+        )
+        self.tasks = Counter(f"{PREFIX}_tasks_total", "Tasks run by stage and status")
+        self.worker_busy = Counter(
+            f"{PREFIX}_worker_busy_seconds_total", "Time each worker spent in tasks"
+        )
+
+    def observe(self, task: Task, end: float):
+        stage = task.metadata["task_type"]
+        status = "done" if task.done else "failed"
+        if task.cancelled:
+            status = "cancelled"
+        if task.finished_at is not None:
+            end = task.finished_at  # without the notification
+        with self._lock:
+            if task.started_at is not None and task.enqueued_at is not None:
+                self.wait.observe(task.started_at - task.enqueued_at, stage=stage)
+            if task.started_at is not None:
+                self.run.observe(end - task.started_at, stage=stage)
+                self.worker_busy.inc(end - task.started_at, worker=task.worker)
+            if task.input_seconds is not None:
+                self.input.observe(task.input_seconds, stage=stage)
+            self.tasks.inc(stage=stage, status=status)
+
+    def render(self, gauges: Optional[List[List[str]]] = None) -> str:
+        with self._lock:
+            lines = [
+                *self.wait.render(),
+                *self.run.render(),
+                *self.input.render(),
+                *self.tasks.render(),
+                *self.worker_busy.render(),
+            ]
+        for extra in gauges or []:
+            lines.extend(extra)
+        return "\n".join(lines) + "\n"
+
+
+def queue_gauges(stats: Dict[str, Any]) -> List[List[str]]:
+    stages = stats["stages"]
+    return [
+        gauge(
+            f"{PREFIX}_queue_depth",
+            "Ready tasks waiting for a worker",
+            {(("stage", s),): v["depth"] for s, v in stages.items()},
+        ),
+        gauge(
+            f"{PREFIX}_tasks_running",
+            "Tasks being run by a worker",
+            {(("stage", s),): v["running"] for s, v in stages.items()},
+        ),
+        gauge(
+            f"{PREFIX}_users_active",
+            "Users with queued or running tasks",
+            {(): len(stats["users"])},
+        ),
+    ]
+
+
+def model_gauges(stats: Dict[str, Any]) -> List[List[str]]:
+    whisper = stats["whisper"]
+    batchers = stats["batchers"]
+    return [
+        gauge(
+            f"{PREFIX}_whisper_threads",
+            "Threads of the whisper model, intra-op per call and inter-op workers",
+            {
+                (("kind", "cpu_threads"),): whisper["cpu_threads"],
+                (("kind", "num_workers"),): whisper["num_workers"],
+            },
+        ),
+        gauge(
+            f"{PREFIX}_batches_running",
+            "Batches being run by the model of a batcher",
+            {(("batcher", b),): v["running"] for b, v in batchers.items()},
+        ),
+        gauge(
+            f"{PREFIX}_batch_concurrency",
+            "Batches a batcher can run at once",
+            {(("batcher", b),): v["concurrency"] for b, v in batchers.items()},
+        ),
+        gauge(
+            f"{PREFIX}_batch_items_pending",
+            "Items waiting for a batch",
+            {(("batcher", b),): v["pending"] for b, v in batchers.items()},
+        ),
+    ]
+
+
+METRICS = TaskMetrics()
@@ -1,4 +1,5 @@
 from transformers import Wav2Vec2ForCTC
+from transformers.modeling_outputs import CausalLMOutput
 from whisperx.asr import WhisperModel
 from whisperx.audio import SAMPLE_RATE, CHUNK_LENGTH, N_SAMPLES, log_mel_spectrogram
 from whisperx import vad
@@ -12,32 +13,128 @@ from whisperx.alignment import (
     align,
 )
 import faster_whisper
+import ctranslate2
 from faster_whisper.tokenizer import _LANGUAGE_CODES, _TASKS, Tokenizer
 from pyannote.audio.core.model import Model
 import torch
 import tokenizers
 import threading
 import numpy as np
-import logging
-from logging import DEBUG
-from typing import Dict, Any, Tuple, List
+from typing import Dict, Any, Tuple, List, Hashable
+from collections import OrderedDict
+from batching import Batcher, MAX_WAIT_S
+import diarization
+import cancellation
+from registry import ModelRegistry
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import whisperx
+import pandas as pd
+import hashlib
+import time
 import os
+from log import logger
 
-logging.basicConfig(level=logging.NOTSET)
+ENCODER_CACHE_SIZE = int(os.environ.get("ENCODER_CACHE_SIZE", 16))
+# a wav2vec2 alignment model takes from ~0.4GB (base) to ~1.3GB (large)
+ALIGN_MODEL_MEMORY_MB = int(os.environ.get("ALIGN_MODEL_MEMORY_MB", 3072))
+TOKENIZER_CACHE_SIZE = int(os.environ.get("TOKENIZER_CACHE_SIZE", 32))
+ALIGN_MAX_BATCH_SIZE = int(os.environ.get("ALIGN_MAX_BATCH_SIZE", 8))
+# padded seconds of audio per wav2vec2 forward pass, bounds its activations
+ALIGN_MAX_BATCH_S = float(os.environ.get("ALIGN_MAX_BATCH_S", 240))
+# wav2vec2 models need at least one receptive field of input
+ALIGN_MIN_SAMPLES = 400
+# flows that don't pick a profile decode like before the profiles existed
+DEFAULT_ASR_PROFILE = os.environ.get("ASR_PROFILE", "standard")
+STARTUP_WARMUP = os.environ.get("STARTUP_WARMUP", "1") == "1"
+# alignment models loaded and run once at startup, e.g. "en,es"
+WARMUP_LANGUAGES = [
+    lang.strip()
+    for lang in os.environ.get("WARMUP_LANGUAGES", "en").split(",")
+    if lang.strip()
+]
+WARMUP_CLIP_S = 5
+# threads of a single whisper call (intra-op, 0 for the ctranslate2 default)
+# and calls that can run at once on their own threads (inter-op, replicas of
+# the model sharing its weights), e.g. 4 workers x 16 threads on 64 cores
+WHISPER_CPU_THREADS = int(os.environ.get("WHISPER_CPU_THREADS", 0))
+WHISPER_NUM_WORKERS = max(1, int(os.environ.get("WHISPER_NUM_WORKERS", 1)))
+# smaller whisper (e.g. "small") for the first pass of the two pass flows, it
+# drafts every segment before the main model refines it, empty to disable
+WHISPER_DRAFT_MODEL = os.environ.get("WHISPER_DRAFT_MODEL", "")
+WHISPER_DRAFT_NUM_WORKERS = max(1, int(os.environ.get("WHISPER_DRAFT_NUM_WORKERS", 1)))
+DRAFT_ASR_PROFILE = os.environ.get("DRAFT_ASR_PROFILE", "fast")
+# whisper model tiers
+FINAL = "final"
+DRAFT = "draft"
+# recordings longer than this are diarized in overlapping windows whose
+# speakers are then clustered together, bounding the memory of pyannote
+DIARIZATION_LONG_AUDIO_S = float(os.environ.get("DIARIZATION_LONG_AUDIO_S", 1800))
+DIARIZATION_WINDOW_S = float(os.environ.get("DIARIZATION_WINDOW_S", 600))
+DIARIZATION_OVERLAP_S = float(os.environ.get("DIARIZATION_OVERLAP_S", 30))
+DIARIZATION_PARALLEL_WINDOWS = max(
+    1, int(os.environ.get("DIARIZATION_PARALLEL_WINDOWS", 2))
+)
+# cosine distance under which speakers of different windows are the same
+DIARIZATION_CLUSTER_THRESHOLD = float(
+    os.environ.get("DIARIZATION_CLUSTER_THRESHOLD", 0.7)
+)
+
+
+# Stands for the alignment model inside whisperx.align, which then only runs
+# the trellis and backtracking of a segment over the emission computed in batch
+class PrecomputedEmission:
+    def __init__(self, emission: torch.Tensor, model_type: str):
+        self.emission = emission
+        self.model_type = model_type
+
+    def __call__(self, waveform: torch.Tensor, lengths: torch.Tensor = None):
+        emissions = self.emission.unsqueeze(0)
+        if self.model_type == "torchaudio":
+            return emissions, None
+        return CausalLMOutput(logits=emissions)
 
 
-logger = logging.getLogger(__name__)
-logger.setLevel(DEBUG)
+# a few seconds of deterministic noise over a tone, enough to run every model
+def warmup_clip(seconds: float = WARMUP_CLIP_S) -> np.ndarray:
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    noise = np.random.default_rng(0).standard_normal(t.shape)
+    return (0.1 * np.sin(2 * np.pi * 220 * t) + 0.01 * noise).astype(np.float32)
 
 
 class AIModels:
     _lock = threading.Lock()
+    _load_lock = threading.Lock()
+    whisper_model_name = "large-v2"
+    diarization_model_name = "pyannote/speaker-diarization-3.1"
     whisper_model: WhisperModel = None
+    draft_model_name = WHISPER_DRAFT_MODEL or None
+    draft_model: WhisperModel = None
     vad_model: VoiceActivitySegmentation = None
     base_tokenizer: tokenizers.Tokenizer = None
-    tokenizers: Dict[str, Tokenizer] = {}
-    align_models: Dict[str, Tuple[Any, Dict[str, Any]]] = {}
+    # tokenizers share the base tokenizer, they are bounded by count only
+    tokenizers = ModelRegistry(
+        max_entries=TOKENIZER_CACHE_SIZE, size=lambda _: 0, name="tokenizer"
+    )
+    align_models = ModelRegistry(
+        budget_bytes=ALIGN_MODEL_MEMORY_MB * 2**20, name="align_model"
+    )
     diarization_pipeline: DiarizationPipeline = None
+    transcription_batcher: Batcher = None
+    draft_batcher: Batcher = None
+    alignment_batcher: Batcher = None
+    # encoder outputs computed by the language detection, by flow and segment
+    encoder_outputs: "OrderedDict[Hashable, ctranslate2.StorageView]" = OrderedDict()
+
+    # startup
+    ready = threading.Event()
+    # set once the startup is over, also when it failed
+    startup_done = threading.Event()
+    startup_error: str = None
+    startup_seconds: float = None
+    load_seconds: Dict[str, float] = {}
+    warmup_seconds: Dict[str, float] = {}
+    warmup_errors: Dict[str, str] = {}
 
     default_asr_options = faster_whisper.transcribe.TranscriptionOptions(
         **{
@@ -67,6 +164,24 @@ class AIModels:
             "hallucination_silence_threshold": None,
         }
     )
+    # decoding settings a flow can pick, from fastest to most accurate
+    asr_profiles: Dict[str, faster_whisper.transcribe.TranscriptionOptions] = {
+        # greedy, no fallback
+        "fast": default_asr_options._replace(
+            beam_size=1, best_of=1, temperatures=[0.0]
+        ),
+        "balanced": default_asr_options._replace(
+            beam_size=2, best_of=2, temperatures=[0.0, 0.4, 0.8]
+        ),
+        # beam search without fallback, what generate_segment_batched does
+        "standard": default_asr_options._replace(temperatures=[0.0]),
+        "accurate": default_asr_options,
+    }
+    # segments decoded and temperature fallbacks, by profile
+    decoding_stats: Dict[str, Dict[str, Any]] = {}
+    # whether the align model of a language goes through the batcher, see
+    # _pads_exactly
+    align_batching: Dict[str, bool] = {}
     vad_args = {
         "onset": 0.500,
         "offset": 0.363,
@@ -104,31 +219,180 @@ class AIModels:
 
     @classmethod
     def _load_whisper(cls, cache_root: str):
+        cores = os.cpu_count() or 1
+        if WHISPER_CPU_THREADS * WHISPER_NUM_WORKERS > cores:
+            logger.warning(
+                "%d whisper workers x %d threads oversubscribe %d cores",
+                WHISPER_NUM_WORKERS,
+                WHISPER_CPU_THREADS,
+                cores,
+            )
         cls.whisper_model = WhisperModel(
-            "large-v2",
+            cls.whisper_model_name,
             device="cpu",
             compute_type="int8",
+            cpu_threads=WHISPER_CPU_THREADS,
+            num_workers=WHISPER_NUM_WORKERS,
             download_root=cache_root,
         )
 
+    @classmethod
+    def _load_draft_whisper(cls, cache_root: str):
+        cls.draft_model = WhisperModel(
+            cls.draft_model_name,
+            device="cpu",
+            compute_type="int8",
+            cpu_threads=WHISPER_CPU_THREADS,
+            num_workers=WHISPER_DRAFT_NUM_WORKERS,
+            download_root=cache_root,
+        )
+
+    @classmethod
+    def has_draft(cls) -> bool:
+        return cls.draft_model_name is not None
+
+    @classmethod
+    def get_whisper(cls, tier: str = FINAL) -> WhisperModel:
+        model = cls.draft_model if tier == DRAFT else cls.whisper_model
+        if not model:
+            raise ValueError(
+                f"{__class__.__name__} {tier} whisper model has not been initialized"
+            )
+        return model
+
     @classmethod
     def _load_diarization_pipeline(cls, token: str):
         cls.diarization_pipeline = DiarizationPipeline(
-            use_auth_token=token, device="cpu"
+            model_name=cls.diarization_model_name, use_auth_token=token, device="cpu"
         )
 
+    # identifies the models and options a result was produced with
+    @classmethod
+    def fingerprint(
+        cls, lang: str = None, profile: str = None, tier: str = FINAL
+    ) -> str:
+        parts = [
+            getattr(whisperx, "__version__", ""),
+            cls.draft_model_name if tier == DRAFT else cls.whisper_model_name,
+            repr(cls.get_asr_options(profile)),
+            repr(sorted(cls.vad_args.items())),
+            cls.diarization_model_name,
+        ]
+        if lang is not None:
+            parts.append(
+                str(
+                    DEFAULT_ALIGN_MODELS_TORCH.get(lang)
+                    or DEFAULT_ALIGN_MODELS_HF.get(lang)
+                )
+            )
+        return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+    @classmethod
+    def _timed(cls, times: Dict[str, float], name: str, fn):
+        start = time.monotonic()
+        fn()
+        times[name] = time.monotonic() - start
+        logger.info("%s took %.2fs", name, times[name])
+
     @classmethod
     def load_models(cls):
-        with cls._lock:
+        with cls._load_lock:
             token, cache_root = cls._get_env_vars()
+            loaders = {}
             if not cls.base_tokenizer:
-                cls._load_base_tokenizer(token)
+                loaders["base_tokenizer"] = partial(cls._load_base_tokenizer, token)
             if not cls.vad_model:
-                cls._load_vad(token)
+                loaders["vad"] = partial(cls._load_vad, token)
             if not cls.whisper_model:
-                cls._load_whisper(cache_root)
+                loaders["whisper"] = partial(cls._load_whisper, cache_root)
+            if cls.has_draft() and not cls.draft_model:
+                loaders["whisper_draft"] = partial(cls._load_draft_whisper, cache_root)
             if not cls.diarization_pipeline:
-                cls._load_diarization_pipeline(token)
+                loaders["diarization"] = partial(cls._load_diarization_pipeline, token)
+            if not loaders:
+                return
+            # the models are independent, their downloads and reads overlap
+            with ThreadPoolExecutor(len(loaders), "model_loader") as pool:
+                futures = [
+                    pool.submit(cls._timed, cls.load_seconds, name, load)
+                    for name, load in loaders.items()
+                ]
+            for future in futures:
+                future.result()
+
+    @classmethod
+    def _warm_up_alignment(cls, clip: np.ndarray, lang: str):
+        segment = {"start": 0.0, "end": len(clip) / SAMPLE_RATE, "text": "hello"}
+        cls.get_aligment(segment, clip, lang)
+
+    # runs every model once so the first requests don't pay for lazy
+    # initialization (first ctranslate2 call, alignment model download...)
+    @classmethod
+    def warm_up(cls):
+        clip = warmup_clip()
+        steps = {
+            "vad": partial(cls.get_voice_segments, clip),
+            "whisper": lambda: (
+                cls.get_language(clip),
+                cls.get_transcription(clip, "en"),
+            ),
+            "diarization": partial(cls.get_speaker_turns, clip),
+        }
+        if cls.has_draft():
+            steps["whisper_draft"] = lambda: (
+                cls.get_language(clip, tier=DRAFT),
+                cls.get_transcription(clip, "en", tier=DRAFT),
+            )
+        for lang in WARMUP_LANGUAGES:
+            steps[f"align_{lang}"] = partial(cls._warm_up_alignment, clip, lang)
+        with ThreadPoolExecutor(len(steps), "model_warmup") as pool:
+            futures = {
+                name: pool.submit(cls._timed, cls.warmup_seconds, name, step)
+                for name, step in steps.items()
+            }
+        for name, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                # the model is loaded, it is only slower on its first request
+                logger.exception(e)
+                cls.warmup_errors[name] = repr(e)
+
+    @classmethod
+    def _start(cls):
+        start = time.monotonic()
+        try:
+            cls.load_models()
+            if STARTUP_WARMUP:
+                cls.warm_up()
+        except Exception as e:
+            logger.exception(e)
+            cls.startup_error = repr(e)
+            cls.startup_done.set()
+            return
+        cls.startup_seconds = time.monotonic() - start
+        cls.ready.set()
+        cls.startup_done.set()
+        logger.info("Models ready: %s", cls.startup_report())
+
+    # loads and warms the models without blocking the caller, ready is set
+    # once every model can serve requests
+    @classmethod
+    def start(cls) -> threading.Thread:
+        thread = threading.Thread(target=cls._start, name="model_startup", daemon=True)
+        thread.start()
+        return thread
+
+    @classmethod
+    def startup_report(cls) -> Dict[str, Any]:
+        return {
+            "ready": cls.ready.is_set(),
+            "error": cls.startup_error,
+            "startup_s": cls.startup_seconds,
+            "load_s": dict(cls.load_seconds),
+            "warmup_s": dict(cls.warmup_seconds),
+            "warmup_errors": dict(cls.warmup_errors),
+        }
 
     @classmethod
     def get_voice_segments(cls, audio: np.ndarray):
@@ -148,31 +412,243 @@ class AIModels:
         return merge_chunks(segments, CHUNK_LENGTH)
 
     @classmethod
-    def get_transcription(cls, audio: np.ndarray, lang: str):
-        if not cls.whisper_model:
+    def get_features(cls, audio: np.ndarray, tier: str = FINAL):
+        model_n_mels = cls.get_whisper(tier).feat_kwargs.get("feature_size")
+        logger.info("Computing features of audio of shape %s", audio.shape)
+        return log_mel_spectrogram(
+            audio[:N_SAMPLES],
+            n_mels=model_n_mels if model_n_mels is not None else 80,
+            padding=max(0, N_SAMPLES - audio.shape[0]),
+        )
+
+    @classmethod
+    def _decode(
+        cls,
+        encoder_output: np.ndarray,
+        tokenizer: Tokenizer,
+        options: faster_whisper.transcribe.TranscriptionOptions,
+        temperature: float,
+        tier: str = FINAL,
+    ) -> List[Tuple[str, float, float]]:
+        # same decoding as WhisperModel.generate_segment_batched, which always
+        # runs the encoder itself, plus the scores needed for the fallback
+        model = cls.get_whisper(tier)
+        previous_tokens = []
+        if options.initial_prompt is not None:
+            previous_tokens = tokenizer.encode(" " + options.initial_prompt.strip())
+        prompt = model.get_prompt(
+            tokenizer,
+            previous_tokens,
+            without_timestamps=options.without_timestamps,
+            prefix=options.prefix,
+        )
+        if temperature > 0:
+            search = {
+                "beam_size": 1,
+                "num_hypotheses": options.best_of,
+                "sampling_topk": 0,
+                "sampling_temperature": temperature,
+            }
+        else:
+            search = {"beam_size": options.beam_size, "patience": options.patience}
+        result = model.model.generate(
+            faster_whisper.transcribe.get_ctranslate2_storage(encoder_output),
+            [prompt] * len(encoder_output),
+            length_penalty=options.length_penalty,
+            max_length=model.max_length,
+            suppress_blank=options.suppress_blank,
+            suppress_tokens=options.suppress_tokens,
+            return_scores=True,
+            **search,
+        )
+        tokens_batch = [
+            [token for token in x.sequences_ids[0] if token < tokenizer.eot]
+            for x in result
+        ]
+        texts = tokenizer.tokenizer.decode_batch(tokens_batch)
+        decoded = []
+        for x, tokens, text in zip(result, tokens_batch, texts):
+            # as computed by faster_whisper for its fallback
+            seq_len = len(tokens)
+            avg_logprob = (
+                x.scores[0] * seq_len**options.length_penalty / (seq_len + 1)
+            )
+            compression_ratio = faster_whisper.transcribe.get_compression_ratio(text)
+            decoded.append((text, avg_logprob, compression_ratio))
+        return decoded
+
+    @staticmethod
+    def _needs_fallback(
+        options: faster_whisper.transcribe.TranscriptionOptions,
+        avg_logprob: float,
+        compression_ratio: float,
+    ) -> bool:
+        if (
+            options.compression_ratio_threshold is not None
+            and compression_ratio > options.compression_ratio_threshold
+        ):
+            return True
+        return (
+            options.log_prob_threshold is not None
+            and avg_logprob < options.log_prob_threshold
+        )
+
+    @classmethod
+    def _count_decoding(cls, profile: str, segments: int, fallbacks: Dict[float, int]):
+        with cls._lock:
+            stats = cls.decoding_stats.setdefault(
+                profile, {"segments": 0, "fallback_segments": 0, "fallbacks": {}}
+            )
+            stats["segments"] += segments
+            # every segment that falls back goes through the first fallback
+            stats["fallback_segments"] += next(iter(fallbacks.values()), 0)
+            for temperature, count in fallbacks.items():
+                by_temperature = stats["fallbacks"]
+                by_temperature[temperature] = by_temperature.get(temperature, 0) + count
+
+    @classmethod
+    def get_decoding_stats(cls) -> Dict[str, Dict[str, Any]]:
+        with cls._lock:
+            return {
+                profile: {**stats, "fallbacks": dict(stats["fallbacks"])}
+                for profile, stats in cls.decoding_stats.items()
+            }
+
+    # decodes the batch at the first temperature of the profile, segments with
+    # a repetitive or unlikely transcription are decoded again at the next one
+    @classmethod
+    def _generate(
+        cls,
+        encoder_output: np.ndarray,
+        tokenizer: Tokenizer,
+        profile: str,
+        tier: str = FINAL,
+    ) -> List[str]:
+        options = cls.get_asr_options(profile)
+        temperatures = list(options.temperatures) or [0.0]
+        best: List[Tuple[float, str]] = [None] * len(encoder_output)
+        pending = list(range(len(encoder_output)))
+        fallbacks: Dict[float, int] = {}
+        for step, temperature in enumerate(temperatures):
+            if step > 0:
+                fallbacks[temperature] = len(pending)
+            decoded = cls._decode(
+                encoder_output[pending], tokenizer, options, temperature, tier
+            )
+            retry = []
+            for k, (text, avg_logprob, compression_ratio) in zip(pending, decoded):
+                if not cls._needs_fallback(options, avg_logprob, compression_ratio):
+                    best[k] = (np.inf, text)
+                    continue
+                # if every temperature fails the most likely one is kept
+                if best[k] is None or avg_logprob > best[k][0]:
+                    best[k] = (avg_logprob, text)
+                retry.append(k)
+            pending = retry
+            if not pending:
+                break
+        label = profile if tier == FINAL else f"{tier}:{profile}"
+        cls._count_decoding(label, len(encoder_output), fallbacks)
+        if fallbacks:
+            logger.info("Temperature fallbacks for profile %s: %s", profile, fallbacks)
+        return [text for _, text in best]
+
+    @classmethod
+    def _transcribe_batch(
+        cls,
+        key: Tuple[str, str, str],
+        items: List[Tuple[torch.Tensor, ctranslate2.StorageView]],
+    ):
+        lang, profile, tier = key
+        pending = [f for f, e in items if e is None]
+        logger.info(
+            "Transcribing batch of %d segments, %d already encoded",
+            len(items),
+            len(items) - len(pending),
+        )
+        if pending:
+            model = cls.get_whisper(tier)
+            encoded = iter(np.asarray(model.encode(torch.stack(pending))))
+        encoder_output = np.stack(
+            [next(encoded) if e is None else np.asarray(e)[0] for _, e in items]
+        )
+        return cls._generate(encoder_output, cls.get_tokenizer(lang), profile, tier)
+
+    @classmethod
+    def _keep_encoder_output(cls, key: Hashable, encoder_output):
+        with cls._lock:
+            cls.encoder_outputs[key] = encoder_output
+            cls.encoder_outputs.move_to_end(key)
+            while len(cls.encoder_outputs) > ENCODER_CACHE_SIZE:
+                cls.encoder_outputs.popitem(last=False)
+
+    @classmethod
+    def pop_encoder_output(cls, key: Hashable):
+        with cls._lock:
+            return cls.encoder_outputs.pop(key, None)
+
+    @classmethod
+    def get_transcription_batcher(cls, tier: str = FINAL):
+        if tier == DRAFT:
+            if not cls.draft_batcher:
+                with cls._lock:
+                    if not cls.draft_batcher:
+                        cls.draft_batcher = Batcher(
+                            cls._transcribe_batch,
+                            name="draft_batcher",
+                            concurrency=WHISPER_DRAFT_NUM_WORKERS,
+                        )
+            return cls.draft_batcher
+        if not cls.transcription_batcher:
+            with cls._lock:
+                if not cls.transcription_batcher:
+                    # one batch per whisper worker decodes at once
+                    cls.transcription_batcher = Batcher(
+                        cls._transcribe_batch,
+                        name="transcription_batcher",
+                        concurrency=WHISPER_NUM_WORKERS,
+                    )
+        return cls.transcription_batcher
+
+    @classmethod
+    def get_asr_options(
+        cls, profile: str = None
+    ) -> faster_whisper.transcribe.TranscriptionOptions:
+        profile = profile or DEFAULT_ASR_PROFILE
+        if profile not in cls.asr_profiles:
             raise ValueError(
-                f"{__class__.__name__}.whisper_model has not been initialized"
+                f"Unknown decoding profile {profile}, use one of {list(cls.asr_profiles)}"
             )
+        return cls.asr_profiles[profile]
+
+    @classmethod
+    def get_transcription(
+        cls,
+        audio: np.ndarray,
+        lang: str,
+        encoder_key: Hashable = None,
+        profile: str = None,
+        urgent: bool = False,
+        tier: str = FINAL,
+    ):
+        cls.get_whisper(tier)
         if not cls.base_tokenizer:
             raise ValueError(
                 f"{__class__.__name__}.base_tokenizer has not been initialized"
             )
-        if not cls.default_asr_options:
-            raise ValueError(
-                f"{__class__.__name__}.default_asr_options has not been initialized"
-            )
-        model_n_mels = cls.whisper_model.feat_kwargs.get("feature_size")
-        logger.info("Transcribing audio of shape %s", audio.shape)
-        features = log_mel_spectrogram(
-            audio,
-            n_mels=model_n_mels if model_n_mels is not None else 80,
-            padding=N_SAMPLES - audio.shape[0],
-        )
+        profile = profile or DEFAULT_ASR_PROFILE
+        cls.get_asr_options(profile)
+        features = cls.get_features(audio, tier)
         logger.info("Audio features shape %s", features.shape)
-
-        return cls.whisper_model.generate_segment_batched(
-            features.unsqueeze(0), cls.get_tokenizer(lang), cls.default_asr_options
+        # the language detection may have already run the encoder on this audio
+        encoder_output = None
+        if encoder_key is not None:
+            encoder_output = cls.pop_encoder_output(encoder_key)
+        # segments of every flow sharing language and profile are decoded together
+        text = cls.get_transcription_batcher(tier)(
+            (lang, profile, tier), (features, encoder_output), urgent
         )
+        return [text]
 
     @classmethod
     def get_tokenizer(cls, lang: str):
@@ -182,11 +658,9 @@ class AIModels:
             )
         if lang not in _LANGUAGE_CODES:
             raise ValueError("Language is not supported by the AI model")
-        if not lang in cls.tokenizers:
-            cls.tokenizers[lang] = Tokenizer(
-                cls.base_tokenizer, True, "transcribe", lang
-            )
-        return cls.tokenizers[lang]
+        return cls.tokenizers.get(
+            lang, lambda: Tokenizer(cls.base_tokenizer, True, "transcribe", lang)
+        )
 
     @classmethod
     def get_align_model_and_metadata(cls, lang: str):
@@ -197,9 +671,118 @@ class AIModels:
             raise ValueError(
                 f"Language {lang} is not supported by the Aligment model, ask for support"
             )
-        if not lang in cls.align_models:
-            cls.align_models[lang] = load_align_model(language_code=lang, device="cpu")
-        return cls.align_models[lang]
+        return cls.align_models.get(
+            lang, lambda: load_align_model(language_code=lang, device="cpu")
+        )
+
+    # a group norm feature extractor normalizes over the padding too, lengths
+    # and masks only cover the transformer, so padded rows change the emissions
+    @staticmethod
+    def _pads_exactly(model) -> bool:
+        return not any(isinstance(m, torch.nn.GroupNorm) for m in model.modules())
+
+    # forward passes over the waveforms, by index: similar lengths together
+    # keep the padding low, models that can't pad only batch equal lengths
+    @classmethod
+    def _emission_batches(cls, model, waveforms: List[np.ndarray]) -> List[List[int]]:
+        pads = cls._pads_exactly(model)
+        order = sorted(range(len(waveforms)), key=lambda k: len(waveforms[k]))
+        max_samples = max(ALIGN_MAX_BATCH_S * SAMPLE_RATE, ALIGN_MIN_SAMPLES)
+        batches: List[List[int]] = []
+        for k in order:
+            n = len(waveforms[k])
+            batch = batches[-1] if batches else None
+            if (
+                batch is None
+                or (len(batch) + 1) * n > max_samples
+                or (not pads and n != len(waveforms[batch[0]]))
+            ):
+                batches.append([k])
+            else:
+                batch.append(k)
+        return batches
+
+    @classmethod
+    def _emissions(
+        cls, model, metadata: Dict[str, Any], waveforms: List[np.ndarray]
+    ) -> List[torch.Tensor]:
+        lengths = torch.as_tensor([len(w) for w in waveforms])
+        batch = torch.zeros(len(waveforms), int(lengths.max()))
+        for row, waveform in zip(batch, waveforms):
+            row[: len(waveform)] = torch.from_numpy(np.asarray(waveform))
+        with torch.inference_mode():
+            if metadata["type"] == "torchaudio":
+                emissions, frames = model(batch, lengths=lengths)
+            elif metadata["type"] == "huggingface":
+                mask = None
+                # models normalizing with group norm were trained without mask,
+                # they are only given batches of equal lengths
+                if getattr(model.config, "feat_extract_norm", None) == "layer":
+                    mask = (torch.arange(batch.shape[1]) < lengths[:, None]).long()
+                emissions = model(batch, attention_mask=mask).logits
+                frames = model._get_feat_extract_output_lengths(lengths)
+            else:
+                raise NotImplementedError(
+                    f"Align model of type {metadata['type']} not supported."
+                )
+        return [emission[: int(n)] for emission, n in zip(emissions, frames)]
+
+    @classmethod
+    def _align_batch(
+        cls,
+        key: Tuple[str, bool],
+        items: List[Tuple[SingleSegment, np.ndarray, np.ndarray]],
+    ):
+        lang, char_level = key
+        model, metadata = cls.get_align_model_and_metadata(lang)
+        waveforms = [waveform for _, _, waveform in items]
+        emissions: Dict[int, torch.Tensor] = {}
+        for batch in cls._emission_batches(model, waveforms):
+            emissions.update(
+                zip(
+                    batch,
+                    cls._emissions(model, metadata, [waveforms[k] for k in batch]),
+                )
+            )
+        logger.info("Aligning batch of %d segments", len(items))
+
+        results = []
+        for k, (segment, audio, _) in enumerate(items):
+            try:
+                results.append(
+                    align(
+                        [segment],
+                        PrecomputedEmission(emissions[k], metadata["type"]),
+                        metadata,
+                        audio,
+                        "cpu",
+                        return_char_alignments=char_level,
+                    )
+                )
+            except Exception as e:
+                # a segment that can't be aligned doesn't fail the others
+                results.append(e)
+        return results
+
+    @classmethod
+    def _batches_alignment(cls, lang: str, model) -> bool:
+        batched = cls.align_batching.get(lang)
+        if batched is None:
+            batched = cls.align_batching[lang] = cls._pads_exactly(model)
+        return batched
+
+    @classmethod
+    def get_alignment_batcher(cls):
+        if not cls.alignment_batcher:
+            with cls._lock:
+                if not cls.alignment_batcher:
+                    cls.alignment_batcher = Batcher(
+                        cls._align_batch,
+                        max_batch_size=ALIGN_MAX_BATCH_SIZE,
+                        max_wait_s=MAX_WAIT_S,
+                        name="alignment_batcher",
+                    )
+        return cls.alignment_batcher
 
     @classmethod
     def get_aligment(
@@ -209,33 +792,41 @@ class AIModels:
         lang: str,
         char_level: bool = False,
     ):
-        model, metadata = cls.get_align_model_and_metadata(lang)
-        return align(
-            [segment],
-            model,
-            metadata,
-            audio_segment,
-            "cpu",
-            return_char_alignments=char_level,
-        )
+        # unsupported languages fail here and loading doesn't stall the batches
+        model, _ = cls.get_align_model_and_metadata(lang)
+        # same samples whisperx.align would feed the model for this segment
+        waveform = audio_segment[
+            int(segment["start"] * SAMPLE_RATE) : int(segment["end"] * SAMPLE_RATE)
+        ]
+        if len(waveform) < ALIGN_MIN_SAMPLES:
+            waveform = np.pad(waveform, (0, ALIGN_MIN_SAMPLES - len(waveform)))
+        item = (segment, audio_segment, waveform)
+        if cls._batches_alignment(lang, model):
+            # emissions of segments of every flow sharing the language are batched
+            result = cls.get_alignment_batcher()((lang, char_level), item)
+        else:
+            # group norm models only batch equal lengths, which segments
+            # almost never have, so they don't wait for a batch of one
+            (result,) = cls._align_batch((lang, char_level), [item])
+        if isinstance(result, Exception):
+            raise result
+        return result
 
     @classmethod
-    def get_language(cls, audio: np.ndarray):
-        if not cls.whisper_model:
-            raise ValueError(
-                f"{__class__.__name__}.whisper_model has not been initialized"
-            )
+    def get_language(
+        cls, audio: np.ndarray, encoder_key: Hashable = None, tier: str = FINAL
+    ):
+        model = cls.get_whisper(tier)
         if audio.shape[0] < N_SAMPLES:
             logger.warning(
                 "Audio is shorter than 30s, language detection may be inaccurate."
             )
-        segment = log_mel_spectrogram(
-            audio[:N_SAMPLES],
-            n_mels=80,
-            padding=0 if audio.shape[0] >= N_SAMPLES else N_SAMPLES - audio.shape[0],
-        )
-        encoder_output = cls.whisper_model.encode(segment)
-        results = cls.whisper_model.model.detect_language(encoder_output)
+        # same features as get_transcription so the encoder output can be reused
+        segment = cls.get_features(audio, tier)
+        encoder_output = model.encode(segment)
+        if encoder_key is not None:
+            cls._keep_encoder_output(encoder_key, encoder_output)
+        results = model.model.detect_language(encoder_output)
         language_token, language_probability = results[0][0]
         language = language_token[2:-2]
         logger.info(
@@ -244,15 +835,109 @@ class AIModels:
         return language
 
     @classmethod
-    def get_diarization(cls, segments: List[SingleAlignedSegment], audio: np.ndarray):
+    def get_speaker_turns(cls, audio: np.ndarray):
         if not cls.diarization_pipeline:
             raise ValueError(
                 f"{__class__.__name__}.diarization_pipeline has not been initialized"
             )
-        speaker_data = cls.diarization_pipeline(audio)
+        if len(audio) <= DIARIZATION_LONG_AUDIO_S * SAMPLE_RATE:
+            return cls.diarization_pipeline(audio)
+        return cls._get_windowed_speaker_turns(audio)
 
+    # speaker turns (relative to the window) and an embedding per speaker
+    @classmethod
+    def _diarize_window(cls, audio: np.ndarray, flow_id: str = None):
+        cancellation.check(flow_id)
+        waveform = torch.from_numpy(np.ascontiguousarray(audio)[None, :])
+        annotation, embeddings = cls.diarization_pipeline.model(
+            {"waveform": waveform, "sample_rate": SAMPLE_RATE},
+            return_embeddings=True,
+        )
+        turns = [
+            (segment.start, segment.end, label)
+            for segment, _, label in annotation.itertracks(yield_label=True)
+        ]
+        return turns, dict(zip(annotation.labels(), embeddings))
+
+    # Only the windows being diarized are copied out of the (memory mapped)
+    # audio, so memory no longer grows with the recording. Speakers are told
+    # apart inside each window and matched across windows by their embeddings.
+    @classmethod
+    def _get_windowed_speaker_turns(cls, audio: np.ndarray) -> pd.DataFrame:
+        bounds = diarization.windows(
+            len(audio),
+            int(DIARIZATION_WINDOW_S * SAMPLE_RATE),
+            int(DIARIZATION_OVERLAP_S * SAMPLE_RATE),
+        )
+        logger.info(
+            f"Diarizing {len(audio) / SAMPLE_RATE:.0f}s of audio in {len(bounds)} windows"
+        )
+        diarize = partial(cls._diarize_window, flow_id=cancellation.current())
+        with ThreadPoolExecutor(DIARIZATION_PARALLEL_WINDOWS, "diarization") as pool:
+            results = list(pool.map(diarize, (audio[s:e] for s, e in bounds)))
+
+        keys, embeddings, speakers = [], [], {}
+        for k, (_, window_embeddings) in enumerate(results):
+            for local, embedding in window_embeddings.items():
+                if diarization.embeddable(embedding):
+                    keys.append((k, local))
+                    embeddings.append(embedding)
+                else:
+                    # too little speech to embed (NaN) or a zero padded slot,
+                    # kept as a speaker of its own
+                    speakers[(k, local)] = f"UNMATCHED_{k:02d}_{local}"
+        clusters = diarization.cluster_speakers(
+            np.array(embeddings),
+            [k for k, _ in keys],
+            DIARIZATION_CLUSTER_THRESHOLD,
+        )
+        speakers.update(
+            {key: f"SPEAKER_{cluster:02d}" for key, cluster in zip(keys, clusters)}
+        )
+        turns = diarization.stitch(
+            [window_turns for window_turns, _ in results],
+            [(s / SAMPLE_RATE, e / SAMPLE_RATE) for s, e in bounds],
+            speakers,
+        )
+        return pd.DataFrame(turns, columns=["start", "end", "speaker"])
+
+    @classmethod
+    def assign_speakers(cls, segments: List[SingleAlignedSegment], speaker_data):
         return assign_word_speakers(speaker_data, {"segments": segments})
 
+    @classmethod
+    def get_diarization(cls, segments: List[SingleAlignedSegment], audio: np.ndarray):
+        return cls.assign_speakers(segments, cls.get_speaker_turns(audio))
+
+    @classmethod
+    def stats(cls) -> Dict[str, Any]:
+        return {
+            "startup": cls.startup_report(),
+            "whisper": {
+                "cpu_threads": WHISPER_CPU_THREADS,
+                "num_workers": WHISPER_NUM_WORKERS,
+                "cpu_count": os.cpu_count(),
+                "model": cls.whisper_model_name,
+                "draft_model": cls.draft_model_name,
+            },
+            "batchers": {
+                "transcription": cls.get_transcription_batcher().stats(),
+                **(
+                    {"draft": cls.get_transcription_batcher(DRAFT).stats()}
+                    if cls.has_draft()
+                    else {}
+                ),
+                "alignment": cls.get_alignment_batcher().stats(),
+            },
+            "alignment_mode": {
+                lang: "batched" if batched else "per_segment"
+                for lang, batched in cls.align_batching.items()
+            },
+            "decoding": cls.get_decoding_stats(),
+            "align_models": cls.align_models.stats(),
+            "tokenizers": cls.tokenizers.stats(),
+        }
+
     def __init__(self):
         self.load_models()
 
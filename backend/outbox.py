@@ -0,0 +1,424 @@
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from collections import deque
+from itertools import islice
+from log import logger
+from storage import DATA
+from cache import hash_bytes
+import threading
+import json
+import time
+import os
+
+try:
+    import msgpack
+except ImportError:  # binary frames are optional, json is always available
+    msgpack = None
+
+
+OUTBOX_RETENTION_S = float(os.environ.get("OUTBOX_RETENTION_S", 900))
+OUTBOX_MAX_MESSAGES = int(os.environ.get("OUTBOX_MAX_MESSAGES", 5000))
+OUTBOX_COALESCE_MS = float(os.environ.get("OUTBOX_COALESCE_MS", 50))
+OUTBOX_MAX_FRAME_MESSAGES = int(os.environ.get("OUTBOX_MAX_FRAME_MESSAGES", 64))
+# a connection this many messages behind is closed, the client reconnects and
+# resumes from its last acknowledgement instead of holding up the mailbox
+OUTBOX_MAX_LAG = int(os.environ.get("OUTBOX_MAX_LAG", 1000))
+# close code telling the client to come back later
+TRY_AGAIN_LATER = 1013
+
+
+def encode_frame(messages: List[Dict[str, Any]], encoding: str = "json"):
+    if len(messages) == 1:
+        payload = messages[0]
+    else:
+        payload = {
+            "task_type": "batch",
+            "seq": messages[-1]["seq"],
+            "messages": messages,
+        }
+    if encoding == "msgpack" and msgpack is not None:
+        return msgpack.packb(payload, use_bin_type=True)
+    return json.dumps(payload, separators=(",", ":"))
+
+
+# a websocket of the user, every one gets all the messages
+class _Subscriber:
+    def __init__(self, conn: Any, encoding: str, sent: int, head: int, position: int):
+        self.conn = conn
+        self.encoding = encoding
+        self.sent = sent  # last sequence number sent on this connection
+        self.head = head  # last one posted before it attached, the rest is replay
+        self.position = position  # of the next message to send, see _Mailbox
+        self.active = True  # cleared on detach, stops its sender
+
+
+class _Mailbox:
+    def __init__(self, user: str, path: str):
+        self.user = user
+        self.path = path
+        self.seq = 0  # last sequence number given to a message
+        self.acked = 0  # last sequence number confirmed by the client
+        # (seq, wall time posted, message), oldest first
+        self.messages: Deque[Tuple[int, float, Dict[str, Any]]] = deque()
+        # messages ever appended, the position of a message counts from the
+        # first one so it doesn't change when older ones are dropped
+        self.appended = 0
+        self.lines = 0  # lines in the file, compacted when mostly stale
+        self.subscribers: List[_Subscriber] = []
+        # lines not in the file yet, written by _flush outside the outbox lock
+        self.unwritten: List[str] = []
+        self.compact = False  # the file is rewritten on the next flush
+        self.io_lock = threading.Lock()  # one writer of the file at a time
+        self.touched = time.time()  # last post, ack or connection change
+        # guards the rest of the mailbox, its senders wait on it
+        self.cond = threading.Condition()
+
+    @property
+    def first(self) -> int:
+        return self.appended - len(self.messages)
+
+    def append(self, entry: Tuple[int, float, Dict[str, Any]]):
+        self.messages.append(entry)
+        self.appended += 1
+
+    def pending(self, position: int) -> int:
+        return self.appended - max(position, self.first)
+
+    # the first messages from the position on, walked from the closest end
+    def unsent(self, position: int, limit: int) -> List[Dict[str, Any]]:
+        start = max(position, self.first) - self.first
+        count = len(self.messages) - start
+        if count <= 0:
+            return []
+        if start <= count:
+            window = list(islice(self.messages, start, start + limit))
+        else:
+            window = list(islice(reversed(self.messages), count))[::-1][:limit]
+        return [message for _, _, message in window]
+
+
+# Messages for the users, kept apart from the workers: a worker only appends
+# the result to the mailbox of the user, a sender thread (a greenlet under
+# gevent) per connection coalesces what is pending into frames and does the
+# network I/O, so a slow client only holds up its own sender. Messages are
+# numbered per user and kept on disk until the client acknowledges them or
+# they expire, so a client reconnecting with the last sequence number it saw
+# gets everything it missed. Every mailbox has its own lock, a result only
+# wakes the senders of its user and they only read what they haven't sent.
+# The outbox lock guards the table of mailboxes and is taken before the one
+# of a mailbox, never after. The disk writes of a mailbox are batched and done
+# outside both, mailboxes left empty and unused for retention_s are dropped
+# from memory, their file keeps the sequence numbers.
+class Outbox:
+    def __init__(
+        self,
+        root: str,
+        retention_s: float = OUTBOX_RETENTION_S,
+        max_messages: int = OUTBOX_MAX_MESSAGES,
+        coalesce_s: float = OUTBOX_COALESCE_MS / 1000,
+        max_frame_messages: int = OUTBOX_MAX_FRAME_MESSAGES,
+        max_lag: int = OUTBOX_MAX_LAG,
+    ):
+        self.root = root
+        self.retention_s = retention_s
+        self.max_messages = max_messages
+        self.coalesce_s = coalesce_s
+        self.max_frame_messages = max(1, max_frame_messages)
+        self.max_lag = max_lag
+        self._lock = threading.Lock()
+        self._boxes: Dict[str, _Mailbox] = {}
+        self._swept = time.time()
+
+        # stats
+        self.posted = 0
+        self.frames = 0
+        self.frame_messages = 0
+        self.replayed = 0
+        self.expired = 0
+        self.dropped = 0
+        self.evicted = 0
+
+    def _box(self, user: str) -> _Mailbox:
+        box = self._boxes.get(user)
+        if box is None:
+            path = os.path.join(self.root, f"{hash_bytes(user)[:32]}.jsonl")
+            box = _Mailbox(user, path)
+            self._load(box)
+            self._boxes[user] = box
+        box.touched = time.time()
+        return box
+
+    def _load(self, box: _Mailbox):
+        try:
+            with open(box.path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # torn write of the last line
+            box.seq = max(box.seq, entry.get("seq", 0))
+            box.acked = max(box.acked, entry.get("ack", 0))
+            if "message" in entry:
+                box.append((entry["seq"], entry["at"], entry["message"]))
+        box.lines = len(lines)
+        self._trim(box)
+        logger.info(
+            "Loaded %d pending messages of user %s", len(box.messages), box.user
+        )
+
+    @staticmethod
+    def _line(entry: Dict[str, Any]) -> str:
+        return json.dumps(entry, separators=(",", ":")) + "\n"
+
+    # writes the lines queued on the mailbox without holding its lock, the
+    # thread holding the file also writes the ones queued meanwhile
+    def _flush(self, box: _Mailbox):
+        with box.io_lock:
+            with box.cond:
+                lines, box.unwritten = box.unwritten, []
+                snapshot = None
+                if box.compact:
+                    # the queued lines are in the snapshot
+                    box.compact = False
+                    snapshot = (box.seq, box.acked, list(box.messages))
+                    box.lines = len(box.messages) + 1
+                else:
+                    box.lines += len(lines)
+            if snapshot is None and not lines:
+                return
+            try:
+                os.makedirs(self.root, exist_ok=True)
+                if snapshot is not None:
+                    self._compact(box.path, *snapshot)
+                else:
+                    with open(box.path, "a") as f:
+                        f.write("".join(lines))
+            except Exception as e:
+                # still delivered from memory, only lost on a restart
+                logger.exception(e)
+
+    def _compact(
+        self,
+        path: str,
+        seq: int,
+        acked: int,
+        messages: List[Tuple[int, float, Dict[str, Any]]],
+    ):
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            f.write(json.dumps({"seq": seq, "ack": acked}) + "\n")
+            for seq, at, message in messages:
+                f.write(self._line({"seq": seq, "at": at, "message": message}))
+        os.replace(tmp, path)
+
+    def _trim(self, box: _Mailbox):
+        expire_before = time.time() - self.retention_s
+        while box.messages and (
+            box.messages[0][0] <= box.acked
+            or box.messages[0][1] < expire_before
+            or len(box.messages) > self.max_messages
+        ):
+            if box.messages[0][0] > box.acked:
+                self.expired += 1
+            box.messages.popleft()
+        if box.lines + len(box.unwritten) > 2 * len(box.messages) + 64:
+            box.compact = True
+
+    # drops the mailboxes nobody used for retention_s, their messages are
+    # acknowledged or expired by then. Called under the outbox lock.
+    def _sweep(self):
+        now = time.time()
+        if now - self._swept < self.retention_s / 10:
+            return
+        self._swept = now
+        for user, box in list(self._boxes.items()):
+            with box.cond:
+                if box.subscribers or now - box.touched < self.retention_s:
+                    continue
+                self._trim(box)
+                if box.messages or box.unwritten or box.compact or box.io_lock.locked():
+                    continue
+            self._boxes.pop(user)
+            self.evicted += 1
+
+    def post(self, user: str, message: Dict[str, Any]) -> Optional[int]:
+        at = time.time()
+        with self._lock:
+            box = self._box(user)
+            with box.cond:
+                seq = box.seq + 1
+                message = {**message, "seq": seq}
+                try:
+                    line = self._line({"seq": seq, "at": at, "message": message})
+                except Exception as e:
+                    # not serializable, the client would never get it
+                    logger.exception(e)
+                    return None
+                box.seq = seq
+                box.unwritten.append(line)
+                box.append((seq, at, message))
+                self._trim(box)
+                box.cond.notify_all()
+            self.posted += 1
+            self._sweep()
+        self._flush(box)
+        return seq
+
+    def _ack(self, box: _Mailbox, seq: int) -> bool:
+        seq = min(seq, box.seq)
+        if seq <= box.acked:
+            return False
+        box.acked = seq
+        box.unwritten.append(self._line({"ack": seq}))
+        self._trim(box)
+        return True
+
+    def ack(self, user: str, seq: int):
+        with self._lock:
+            box = self._box(user)
+            with box.cond:
+                if not self._ack(box, seq):
+                    return
+        self._flush(box)
+
+    # handles a frame sent by the client, only acknowledgements for now
+    def receive(self, user: str, frame: Any):
+        try:
+            data = json.loads(frame)
+            if isinstance(data, dict) and "ack" in data:
+                self.ack(user, int(data["ack"]))
+        except (TypeError, ValueError):
+            logger.warning("Ignoring frame %r from user %s", frame, user)
+
+    def attach(
+        self,
+        user: str,
+        conn: Any,
+        last_seq: Optional[int] = None,
+        encoding: str = "json",
+    ) -> threading.Thread:
+        with self._lock:
+            box = self._box(user)
+            with box.cond:
+                if last_seq is not None and last_seq <= box.seq:
+                    self._ack(box, last_seq)
+                # else the client knows nothing or has numbers from a lost
+                # outbox. What is left after the trim is not acknowledged.
+                subscriber = _Subscriber(conn, encoding, box.acked, box.seq, box.first)
+                box.subscribers.append(subscriber)
+                replayed = len(box.messages)
+            self.replayed += replayed
+            thread = threading.Thread(
+                target=self._send_loop,
+                args=[box, subscriber],
+                name=f"outbox_{user}",
+                daemon=True,
+            )
+        self._flush(box)
+        thread.start()
+        return thread
+
+    def detach(self, user: str, conn: Any):
+        with self._lock:
+            box = self._boxes.get(user)
+        if box is None:
+            return
+        with box.cond:
+            box.touched = time.time()
+            for subscriber in box.subscribers:
+                if subscriber.conn is conn:
+                    subscriber.active = False
+                    box.subscribers.remove(subscriber)
+                    box.cond.notify_all()
+                    return
+
+    def connected(self, user: str) -> bool:
+        with self._lock:
+            box = self._boxes.get(user)
+        if box is None:
+            return False
+        with box.cond:
+            return bool(box.subscribers)
+
+    def _next_frame(self, box: _Mailbox, subscriber: _Subscriber):
+        limit = self.max_frame_messages
+        with box.cond:
+            while subscriber.active and not box.pending(subscriber.position):
+                box.cond.wait()
+            # give the results arriving together a chance to share a frame
+            deadline = time.monotonic() + self.coalesce_s
+            while subscriber.active:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if box.pending(subscriber.position) >= limit:
+                    break
+                box.cond.wait(remaining)
+            if not subscriber.active:
+                return None
+            # the replay on attach does not count as lag
+            if box.seq - max(subscriber.sent, subscriber.head) > self.max_lag:
+                return []
+            return box.unsent(subscriber.position, limit)
+
+    def _send_loop(self, box: _Mailbox, subscriber: _Subscriber):
+        conn = subscriber.conn
+        while True:
+            messages = self._next_frame(box, subscriber)
+            if messages is None:
+                return
+            if not messages:
+                logger.warning("Dropping a lagging connection of user %s", box.user)
+                with self._lock:
+                    self.dropped += 1
+                self.detach(box.user, conn)
+                try:
+                    conn.close(reason=TRY_AGAIN_LATER, message="Too far behind")
+                except Exception as e:
+                    logger.exception(e)
+                return
+            try:
+                conn.send(encode_frame(messages, subscriber.encoding))
+            except Exception as e:
+                logger.exception(e)
+                self.detach(box.user, conn)
+                return
+            with box.cond:
+                subscriber.sent = max(subscriber.sent, messages[-1]["seq"])
+                # messages dropped meanwhile were older, the position holds
+                subscriber.position = max(subscriber.position, box.first) + len(
+                    messages
+                )
+            with self._lock:
+                self.frames += 1
+                self.frame_messages += len(messages)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            boxes = list(self._boxes.values())
+            totals = {
+                "posted": self.posted,
+                "frames": self.frames,
+                "messages_per_frame": (
+                    self.frame_messages / self.frames if self.frames else 0.0
+                ),
+                "replayed": self.replayed,
+                "expired": self.expired,
+                "dropped": self.dropped,
+                "evicted": self.evicted,
+            }
+        users = {}
+        for box in boxes:
+            with box.cond:
+                users[box.user] = {
+                    "connections": len(box.subscribers),
+                    "seq": box.seq,
+                    "acked": box.acked,
+                    "pending": len(box.messages),
+                }
+        return {**totals, "users": users}
+
+
+OUTBOX = Outbox(os.environ.get("OUTBOX_PATH", os.path.join(DATA, ".outbox")))
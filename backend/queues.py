@@ -1,54 +1,155 @@
-from queue import Queue, Empty
 from typing import Callable, Dict, Tuple, Any
 from functools import partial
-from models import logger
-import json
+from models import WHISPER_NUM_WORKERS
+from log import logger
 from collections import defaultdict
 from task import Task
+from batching import MAX_BATCH_SIZE
+from dispatcher import Dispatcher
+from sqlqueue import SqliteQueue, NODE_ID
+from storage import DATA
+from metrics import METRICS
+from cancellation import FlowCancelled, running
+from outbox import OUTBOX
 import threading
+import time
+import os
 
 
-QUEUES: Dict[str, Queue] = defaultdict(Queue)
+def parse_assignments(value: str, cast: Callable[[str], Any] = int) -> Dict[str, Any]:
+    assignments = {}
+    for entry in value.split(","):
+        if not entry.strip():
+            continue
+        key, item = entry.split("=")
+        assignments[key.strip()] = cast(item)
+    return assignments
 
 
-def dequeue(q: Queue):
-    task = q.get(block=False)
-    if not isinstance(task, Task):
-        raise ValueError(f"A non Task object was found on dequeue")
-    return task
+# transcriptions wait on the batcher, the pool must be able to hold a full
+# batch for every whisper worker
+WORKERS = int(
+    os.environ.get(
+        "WORKERS", max(os.cpu_count() or 1, MAX_BATCH_SIZE * WHISPER_NUM_WORKERS)
+    )
+)
+# max number of tasks of a stage running at once, e.g. "diarize_speakers=1,align_words=4"
+STAGE_LIMITS = parse_assignments(os.environ.get("STAGE_LIMITS", "diarize_speakers=1"))
+# share of the workers each user gets when several compete, e.g. "alice=2,bob=0.5"
+USER_WEIGHTS = parse_assignments(os.environ.get("USER_WEIGHTS", ""), float)
+SHORTEST_JOB_FIRST = os.environ.get("SHORTEST_JOB_FIRST", "1") == "1"
 
+# "memory" runs every task in this process, "sqlite" shares the queue with the
+# other processes/nodes using the same QUEUE_DB, see SqliteQueue
+QUEUE_BACKEND = os.environ.get("QUEUE_BACKEND", "memory")
+QUEUE_DB = os.environ.get("QUEUE_DB", os.path.join(DATA, ".queue", "queue.db"))
 
-def process_queues(connections: Dict[str, Any]):
-    logger.info("Spinning up working thread")
+if QUEUE_BACKEND == "sqlite":
+    QUEUES = SqliteQueue(
+        QUEUE_DB,
+        STAGE_LIMITS,
+        USER_WEIGHTS,
+        SHORTEST_JOB_FIRST,
+        deliver=OUTBOX.post,
+    )
+    if "OUTBOX_PATH" not in os.environ:
+        # the mailboxes belong to the node holding the websockets
+        OUTBOX.root = os.path.join(OUTBOX.root, NODE_ID)
+elif QUEUE_BACKEND == "memory":
+    QUEUES = Dispatcher(STAGE_LIMITS, USER_WEIGHTS, SHORTEST_JOB_FIRST)
+else:
+    raise ValueError(f"Unknown QUEUE_BACKEND {QUEUE_BACKEND}")
+
+
+def message(task: Task, result: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        **result,
+        "task_type": task.metadata.get("message_type") or task.metadata["task_type"],
+        "task_id": task.metadata["flow_id"],
+    }
+
+
+# the message waits in the outbox of the user, the worker does no network I/O,
+# unless the websocket of the user is held by another node
+def send(user: str, message: Dict[str, Any]):
+    logger.info("Sending %s to the user %s", message["task_type"], user)
+    if not QUEUES.forward(user, message):
+        OUTBOX.post(user, message)
+
+
+def notify(task: Task, result: Dict[str, Any]):
+    send(task.metadata["user"], message(task, result))
+
+
+def run_task(task: Task):
+    try:
+        with running(task.metadata["flow_id"]):
+            result = task()
+        # nobody waits for the results of a cancelled flow
+        if task.metadata.get("notify", True) and not task.cancelled:
+            notify(task, result)
+    except FlowCancelled as e:
+        task.cancelled = True
+        task.error = "cancelled"
+        logger.info(f"Task {task.id} stopped: {e}")
+    except Exception as e:
+        logger.error(f"Error on task {task.id}: {str(e)}")
+        logger.exception(e)
+        task.fail(repr(e))
+    finally:
+        METRICS.observe(task, time.monotonic())
+
+
+def work():
+    logger.info("Spinning up worker %s", threading.current_thread().name)
     while True:
+        task = QUEUES.get()  # blocks until a task can run
+        try:
+            run_task(task)
+        finally:
+            QUEUES.finish(task)
+
+
+# fails every task waiting in this process, their flows end instead of
+# waiting for workers that will never start
+def fail_queued(error: str) -> int:
+    failed = 0
+    while True:
+        task = QUEUES.get(block=False)
+        if task is None:
+            return failed
+        try:
+            task.fail(error)
+            failed += 1
+        finally:
+            QUEUES.finish(task)
+
 
-        for u, q in list(QUEUES.items()):
-            try:
-                # TODO fix race condition
-                task = dequeue(q)  # may fail if currently empty and added new tasks
-                result = task()
-                jsonResult = json.dumps(
-                    {
-                        **result,
-                        "task_type": task.metadata["task_type"],
-                        "task_id": task.metadata["flow_id"],
-                    }
+# returns right away without starting any worker when the models failed to
+# load, done is set once the startup is over whether ready is set or not
+def process_queues(
+    workers: int = WORKERS,
+    ready: threading.Event = None,
+    done: threading.Event = None,
+):
+    if ready is not None:
+        # tasks dispatched meanwhile wait in the queues
+        logger.info("Waiting for the models before starting the workers")
+        (done or ready).wait()
+        if not ready.is_set():
+            # the shared queue is left to the nodes that could load them
+            if QUEUE_BACKEND == "memory":
+                failed = fail_queued("The models failed to load")
+                logger.error(
+                    "No workers, the models failed to load: %d tasks failed", failed
                 )
-                try:
-                    user = task.metadata["user"]
-                    task_type = task.metadata["task_type"]
-                    if not user in connections:
-                        raise ConnectionError(
-                            f"Error notifying user {user} about task {task_type}, connection not stablished",
-                        )
-                    conn = connections[user]
-                    logger.info("Sending %s to the user %s", jsonResult, user)
-                    conn.send(jsonResult)
-                except Exception as e:
-                    logger.exception(e)
-            except Empty:
-                logger.info(f"Removing queue for user {u} due to lack of task")
-                QUEUES.pop(u)
-            except Exception as e:
-                logger.error(f"Error on task {task.id}: {str(e)}")
-                logger.exception(e)
+            return
+    logger.info("Spinning up %d workers, stage limits %s", workers, STAGE_LIMITS)
+    threads = [
+        threading.Thread(target=work, name=f"worker_{i}", daemon=True)
+        for i in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
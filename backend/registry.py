@@ -0,0 +1,123 @@
+from concurrent.futures import Future
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+# bytes held by the tensors of a model, torch modules are found by duck typing
+# inside the tuples and dicts returned by the loaders
+def model_nbytes(value: Any) -> int:
+    if isinstance(value, (tuple, list)):
+        return sum(model_nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(model_nbytes(v) for v in value.values())
+    if hasattr(value, "parameters") and hasattr(value, "buffers"):
+        tensors = [*value.parameters(), *value.buffers()]
+        return sum(t.numel() * t.element_size() for t in tensors)
+    return 0
+
+
+# Models loaded on demand (one per language...) kept while they fit in the
+# byte budget and the entry limit, the least recently used ones are released
+# first. Concurrent requests for a model that is not loaded yet wait for a
+# single load.
+class ModelRegistry:
+    def __init__(
+        self,
+        budget_bytes: Optional[int] = None,
+        max_entries: Optional[int] = None,
+        size: Callable[[Any], int] = model_nbytes,
+        name: str = "models",
+    ):
+        self.budget_bytes = budget_bytes
+        self.max_entries = max_entries
+        self.size = size
+        self.name = name
+
+        self._lock = threading.Lock()
+        self._models: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+        self._loading: Dict[Hashable, Future] = {}
+        self.used_bytes = 0
+
+        # stats
+        self.hits = 0
+        self.loads = 0
+        self.failed_loads = 0
+        self.evictions = 0
+        self.load_seconds = 0.0
+
+    def get(self, key: Hashable, load: Callable[[], Any]) -> Any:
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is not None:
+                self._models.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            future = self._loading.get(key)
+            loader = future is None
+            if loader:
+                future = Future()
+                self._loading[key] = future
+        if not loader:
+            return future.result()
+
+        start = time.monotonic()
+        try:
+            value = load()
+            nbytes = self.size(value)
+        except BaseException as e:
+            with self._lock:
+                self._loading.pop(key)
+                self.failed_loads += 1
+            future.set_exception(e)
+            raise
+        elapsed = time.monotonic() - start
+
+        with self._lock:
+            self._loading.pop(key)
+            self._models[key] = (value, nbytes)
+            self.used_bytes += nbytes
+            self.loads += 1
+            self.load_seconds += elapsed
+            self._evict()
+        logger.info("Loaded %s %s (%d bytes) in %.2fs", self.name, key, nbytes, elapsed)
+        future.set_result(value)
+        return value
+
+    def _over_limits(self) -> bool:
+        if self.max_entries is not None and len(self._models) > self.max_entries:
+            return True
+        return self.budget_bytes is not None and self.used_bytes > self.budget_bytes
+
+    def _evict(self):
+        # the model just loaded always stays, even if it alone is over budget
+        while len(self._models) > 1 and self._over_limits():
+            key, (_, nbytes) = self._models.popitem(last=False)
+            self.used_bytes -= nbytes
+            self.evictions += 1
+            # tasks still holding the model keep it alive until they are done
+            logger.info("Evicted %s %s (%d bytes)", self.name, key, nbytes)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._models
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "entries": list(self._models),
+                "loading": list(self._loading),
+                "used_bytes": self.used_bytes,
+                "budget_bytes": self.budget_bytes,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "loads": self.loads,
+                "failed_loads": self.failed_loads,
+                "evictions": self.evictions,
+                "load_seconds": self.load_seconds,
+            }
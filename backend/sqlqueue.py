@@ -0,0 +1,756 @@
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from contextlib import contextmanager
+from collections import defaultdict
+from dispatcher import UserQueue
+from task import Task
+from log import logger
+import threading
+import sqlite3
+import pickle
+import socket
+import json
+import time
+import os
+
+try:
+    from gevent import monkey, get_hub
+except ImportError:  # only the gunicorn server runs under gevent
+    monkey = None
+
+
+NODE_ID = os.environ.get("NODE_ID", f"{socket.gethostname()}-{os.getpid()}")
+QUEUE_LEASE_S = float(os.environ.get("QUEUE_LEASE_S", 30))
+# how often the node looks for work of other nodes, results and notifications,
+# only with reads unless there is something to take
+QUEUE_POLL_S = float(os.environ.get("QUEUE_POLL_S", 0.05))
+QUEUE_MAX_ATTEMPTS = int(os.environ.get("QUEUE_MAX_ATTEMPTS", 3))
+# a node not seen for this long is gone, with the flows it was running
+NODE_TIMEOUT_S = float(os.environ.get("NODE_TIMEOUT_S", 4 * QUEUE_LEASE_S))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    node TEXT NOT NULL,
+    user TEXT NOT NULL,
+    flow_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    portable INTEGER NOT NULL,
+    payload BLOB,
+    duration REAL NOT NULL,
+    critical_path REAL NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL,
+    lease_owner TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    enqueued_at REAL NOT NULL,
+    run_s REAL,
+    result BLOB,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, lease_until);
+CREATE INDEX IF NOT EXISTS tasks_node ON tasks (node, state);
+CREATE TABLE IF NOT EXISTS users (user TEXT PRIMARY KEY, vtime REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS nodes (node TEXT PRIMARY KEY, seen_at REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS connections (user TEXT PRIMARY KEY, node TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS notifications (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    node TEXT NOT NULL,
+    user TEXT NOT NULL,
+    message TEXT NOT NULL
+);
+"""
+
+
+# A task claimed from another node: the stage function and its arguments are
+# unpickled from the queue, the result goes back to the node running the flow
+class RemoteTask:
+    def __init__(
+        self,
+        row_id: int,
+        owner: str,
+        call: Callable[..., Dict[str, Any]],
+        metadata: Dict[str, Any],
+        enqueued_at: float,
+    ):
+        self.row_id = row_id
+        self.owner = owner
+        self.id = (metadata["flow_id"], metadata["task_type"])
+        self.on_call = call
+        self.metadata = metadata
+        self.input_seconds: float = metadata.get("input_seconds")
+
+        self.started = False
+        self.done = False
+        self.cancelled = False
+        self.result: Dict[Any, Any] = None
+        self.error: str = None
+        self.worker: str = None
+        # wall clock of the node that enqueued it, in this node's monotonic time
+        self.enqueued_at = time.monotonic() - max(0.0, time.time() - enqueued_at)
+        self.started_at: float = None
+        self.finished_at: float = None
+
+    def __call__(self):
+        self.started = True
+        self.started_at = time.monotonic()
+        self.worker = threading.current_thread().name
+        logger.info(f"Started remote task {self.id} of node {self.owner}")
+        self.result = self.on_call(**self.metadata)
+        self.finished_at = time.monotonic()
+        self.done = True
+        logger.info(f"Finished remote task {self.id}, returned: {self.result}")
+        return self.result
+
+    # reported to the owner, which fails the task of its flow
+    def fail(self, error: str):
+        self.error = error
+        self.finished_at = time.monotonic()
+
+
+# Dispatcher look alike backed by a SQLite database shared by several
+# processes or nodes. Every node keeps the flows it was asked to run and puts
+# their ready tasks in the database, any node's worker claims them with a
+# lease that its node renews while it is alive. Tasks that can't be pickled
+# (streaming stages emit into their flow) only run on their own node. Results
+# of tasks run elsewhere are collected by the owner, which completes the task
+# and enqueues what depends on it.
+# Idle workers don't poll: a single background thread per node reads the
+# database every poll_s and wakes one worker when there is something to
+# claim, a worker that got a task wakes the next one. Write transactions are
+# only opened to change something, so idle nodes don't fight over the lock.
+# sqlite3 blocks its thread while it waits for the lock or the disk, under
+# gevent (gunicorn.conf.py) that thread is the hub serving every connection,
+# so the queries run in the hub's pool of native threads instead, and no
+# lock of the queue is held while they wait.
+# Artifacts and uploads are read from DATA, so it must be shared as well. The
+# database must be on storage with working file locks, nodes trust each other
+# with the pickles they exchange.
+class SqliteQueue:
+    COST_SMOOTHING = 0.2
+
+    def __init__(
+        self,
+        path: str,
+        stage_limits: Dict[str, int] = {},
+        weights: Dict[str, float] = {},
+        shortest_job_first: bool = True,
+        default_weight: float = 1.0,
+        node: str = NODE_ID,
+        lease_s: float = QUEUE_LEASE_S,
+        poll_s: float = QUEUE_POLL_S,
+        max_attempts: int = QUEUE_MAX_ATTEMPTS,
+        deliver: Callable[[str, Dict[str, Any]], Any] = None,
+    ):
+        self.path = path
+        self.stage_limits = dict(stage_limits)
+        self.weights = dict(weights)
+        self.default_weight = default_weight
+        self.shortest_job_first = shortest_job_first
+        self.node = node
+        self.lease_s = lease_s
+        self.poll_s = poll_s
+        self.max_attempts = max_attempts
+        # posts the notifications other nodes forward to this one
+        self.deliver = deliver
+
+        self._db = threading.local()
+        self._lock = threading.RLock()
+        self._cond = threading.Condition(self._lock)
+        # notified when a put registered the row it inserted
+        self._registered = threading.Condition(self._lock)
+        self._inserting = 0  # puts between their insert and its registration
+        self._local: Dict[int, Task] = {}  # row -> task of a flow of this node
+        self._leased: Dict[Task, int] = {}  # task -> row, claimed by this node
+        self._unfinished: Dict[str, int] = defaultdict(int)
+        self._started = False
+        self._idle = 0  # workers waiting in get
+        self._stage_costs: Dict[str, float] = {}  # seconds a task takes
+        # claimed task -> (user, estimate charged to its virtual time)
+        self._charged: Dict[Any, Tuple[str, float]] = {}
+
+        # stats
+        self.claimed_local = 0
+        self.claimed_remote = 0
+        self.collected = 0
+        self.forwarded = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        db = getattr(self._db, "conn", None)
+        if db is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(SCHEMA)
+            columns = {row[1] for row in db.execute("PRAGMA table_info(tasks)")}
+            if "priority" not in columns:
+                # queues created before the stage priorities
+                try:
+                    db.execute(
+                        "ALTER TABLE tasks ADD COLUMN priority INTEGER NOT NULL DEFAULT 0"
+                    )
+                except sqlite3.OperationalError:
+                    pass  # added by another node meanwhile
+            self._db.conn = db
+        return db
+
+    # runs the sqlite work off the gevent hub, fn must not touch _cond
+    def _run(self, fn: Callable[..., Any], *args) -> Any:
+        if monkey is None or not monkey.is_module_patched("threading"):
+            return fn(*args)
+        return get_hub().threadpool.apply(fn, args)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _start(self):
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+        self._run(self._heartbeat)
+        threading.Thread(
+            target=self._background, name="queue_background", daemon=True
+        ).start()
+
+    def __getitem__(self, user: str) -> UserQueue:
+        return UserQueue(self, user)
+
+    def put(self, user: str, task: Task):
+        self._start()
+        metadata = {k: v for k, v in task.metadata.items() if k != "queue"}
+        try:
+            payload = pickle.dumps((task.on_call, metadata))
+        except Exception:
+            payload = None  # bound to this process, e.g. a streaming stage
+        task.enqueued_at = time.monotonic()
+        with self._cond:
+            self._inserting += 1
+        row_id = None
+        try:
+            row_id = self._run(self._insert, user, task, payload)
+        finally:
+            with self._cond:
+                self._inserting -= 1
+                if row_id is not None:
+                    self._local[row_id] = task
+                    self._unfinished[user] += 1
+                    self._cond.notify()
+                self._registered.notify_all()
+
+    # task of a row of this node, called under _cond. The row may have been
+    # claimed or collected before the put that inserted it registered it.
+    def _local_task(self, row_id: int) -> Optional[Task]:
+        while row_id not in self._local and self._inserting:
+            self._registered.wait()
+        return self._local.get(row_id)
+
+    def _insert(self, user: str, task: Task, payload: Optional[bytes]) -> int:
+        with self._transaction() as db:
+            # users start at the virtual time of the active ones, they don't
+            # get credit for the time they were away
+            floor = db.execute(
+                "SELECT MIN(u.vtime) FROM users u WHERE EXISTS (SELECT 1 FROM tasks t"
+                " WHERE t.user = u.user AND t.state IN ('ready', 'leased'))"
+            ).fetchone()[0]
+            db.execute(
+                "INSERT INTO users (user, vtime) VALUES (?, ?) ON CONFLICT (user)"
+                " DO UPDATE SET vtime = MAX(vtime, excluded.vtime)",
+                (user, floor or 0.0),
+            )
+            cursor = db.execute(
+                "INSERT INTO tasks (node, user, flow_id, stage, portable, payload,"
+                " duration, critical_path, priority, state, enqueued_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'ready', ?)",
+                (
+                    self.node,
+                    user,
+                    task.metadata["flow_id"],
+                    task.metadata["task_type"],
+                    payload is not None,
+                    payload,
+                    task.metadata.get("duration", 0.0) or 0.0,
+                    task.metadata.get("critical_path", 0.0) or 0.0,
+                    task.metadata.get("priority", 0),
+                    time.time(),
+                ),
+            )
+        return cursor.lastrowid
+
+    def task_done(self, user: str):
+        with self._cond:
+            if self._unfinished.get(user, 0) <= 0:
+                raise ValueError(f"task_done() called too many times for {user}")
+            self._unfinished[user] -= 1
+            if not self._unfinished[user]:
+                self._unfinished.pop(user)
+
+    # drops the ready tasks of a flow of this node, returns how many. Tasks
+    # already claimed by other nodes run to the end, their result is ignored.
+    def cancel(self, user: str, flow_id: str) -> int:
+        rows = self._run(self._delete_ready, flow_id)
+        for (row_id,) in rows:
+            with self._cond:
+                task = self._local_task(row_id)
+                self._local.pop(row_id, None)
+            if task is not None:
+                self.task_done(user)
+        return len(rows)
+
+    def _delete_ready(self, flow_id: str) -> List[tuple]:
+        with self._transaction() as db:
+            rows = db.execute(
+                "SELECT id FROM tasks WHERE node = ? AND flow_id = ? AND state = 'ready'",
+                (self.node, flow_id),
+            ).fetchall()
+            db.execute(
+                "DELETE FROM tasks WHERE node = ? AND flow_id = ? AND state = 'ready'",
+                (self.node, flow_id),
+            )
+        return rows
+
+    # best claimable row for this node, read only
+    def _candidate(self, db: sqlite3.Connection, now: float) -> Optional[tuple]:
+        running = dict(
+            db.execute(
+                "SELECT stage, COUNT(*) FROM tasks WHERE state = 'leased'"
+                " AND lease_until >= ? GROUP BY stage",
+                (now,),
+            ).fetchall()
+        )
+        full = [
+            stage
+            for stage, limit in self.stage_limits.items()
+            if running.get(stage, 0) >= limit
+        ]
+        # the user's drafts before its other tasks, refinements after, see
+        # Stage.priority
+        order = "u.vtime, t.priority DESC, "
+        if self.shortest_job_first:
+            order += "t.duration, "
+        return db.execute(
+            "SELECT t.id, t.node, t.user, t.stage, t.payload, t.enqueued_at"
+            " FROM tasks t JOIN users u ON u.user = t.user"
+            " WHERE (t.state = 'ready' OR (t.state = 'leased' AND t.lease_until < ?))"
+            " AND (t.portable OR t.node = ?)"
+            f" AND t.stage NOT IN ({', '.join('?' * len(full))})"
+            f" ORDER BY {order}t.critical_path DESC, t.id LIMIT 1",
+            (now, self.node, *full),
+        ).fetchone()
+
+    # leases the best claimable row, charging the user the estimated cost of
+    # its stage
+    def _lease(self, costs: Dict[str, float]) -> Optional[tuple]:
+        now = time.time()
+        row = self._candidate(self._connect(), now)
+        if row is None:
+            return None
+        with self._transaction() as db:
+            # taken by another worker since the read, the caller tries again
+            row = self._candidate(db, now)
+            if row is None:
+                return None
+            row_id, _, user, stage, _, _ = row
+            db.execute(
+                "UPDATE tasks SET state = 'leased', lease_owner = ?, lease_until = ?,"
+                " attempts = attempts + 1 WHERE id = ?",
+                (self.node, now + self.lease_s, row_id),
+            )
+            weight = self.weights.get(user, self.default_weight)
+            db.execute(
+                "UPDATE users SET vtime = vtime + ? WHERE user = ?",
+                (costs.get(stage, 1.0) / weight, user),
+            )
+        return row
+
+    def _delete(self, row_ids: List[int]):
+        with self._transaction() as db:
+            db.executemany("DELETE FROM tasks WHERE id = ?", [(i,) for i in row_ids])
+
+    def _claim(self) -> Optional[Any]:
+        with self._cond:
+            costs = dict(self._stage_costs)
+        row = self._run(self._lease, costs)
+        if row is None:
+            return None
+        row_id, owner, user, stage, payload, enqueued_at = row
+        estimate = costs.get(stage, 1.0)
+        with self._cond:
+            task = self._local_task(row_id) if owner == self.node else None
+        if task is not None:
+            self.claimed_local += 1
+        elif payload is None:
+            # left by an earlier process with the same node id
+            self._run(self._delete, [row_id])
+            return None
+        else:
+            call, metadata = pickle.loads(payload)
+            task = RemoteTask(row_id, owner, call, metadata, enqueued_at)
+            self.claimed_remote += 1
+        with self._cond:
+            self._leased[task] = row_id
+            self._charged[task] = (user, estimate)
+        return task
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> Optional[Any]:
+        self._start()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            task = self._claim()
+            if task is not None:
+                # there may be more, the next idle worker has a look
+                with self._cond:
+                    self._cond.notify()
+                return task
+            if not block:
+                return None
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    return None
+            # woken by a put of this node or by the poller
+            with self._cond:
+                self._idle += 1
+                try:
+                    self._cond.wait(wait)
+                finally:
+                    self._idle -= 1
+
+    # the estimate charged on claim is replaced by the run time of the task,
+    # returns the user and the correction of its virtual time
+    def _correction(self, task: Any, run_s: Optional[float]) -> Tuple[str, float]:
+        with self._cond:
+            user, estimate = self._charged.pop(task, (None, 0.0))
+            if user is None:
+                return None, 0.0
+            stage = task.metadata["task_type"]
+            if run_s is not None:
+                cost = self._stage_costs.get(stage)
+                self._stage_costs[stage] = (
+                    run_s
+                    if cost is None
+                    else cost + self.COST_SMOOTHING * (run_s - cost)
+                )
+        weight = self.weights.get(user, self.default_weight)
+        return user, ((run_s or 0.0) - estimate) / weight
+
+    def _charge(self, db: sqlite3.Connection, user: Optional[str], correction: float):
+        if user is not None:
+            db.execute(
+                "UPDATE users SET vtime = vtime + ? WHERE user = ?", (correction, user)
+            )
+
+    # must be called by the worker once it is done with a task returned by get
+    def finish(self, task: Any):
+        with self._cond:
+            row_id = self._leased.pop(task)
+        run_s = None
+        if task.started_at is not None and task.finished_at is not None:
+            run_s = task.finished_at - task.started_at
+        user, correction = self._correction(task, run_s)
+        if isinstance(task, Task):
+            with self._cond:
+                self._local.pop(row_id, None)
+                if not task.done:
+                    # failed tasks never reach their task_done call
+                    self.task_done(task.metadata["user"])
+            self._run(self._finish_local, row_id, user, correction)
+            return
+
+        # the owner completes the task of its flow when it collects the result
+        state, result, error = "failed", None, task.error
+        if task.done:
+            try:
+                state, result = "done", pickle.dumps(task.result)
+            except Exception as e:
+                error = f"Result of {task.id} can't be sent back: {e!r}"
+        self._run(
+            self._store_result,
+            task.row_id,
+            state,
+            result,
+            error,
+            run_s,
+            user,
+            correction,
+        )
+
+    def _finish_local(self, row_id: int, user: Optional[str], correction: float):
+        with self._transaction() as db:
+            db.execute("DELETE FROM tasks WHERE id = ?", (row_id,))
+            self._charge(db, user, correction)
+
+    def _store_result(
+        self,
+        row_id: int,
+        state: str,
+        result: Optional[bytes],
+        error: Optional[str],
+        run_s: Optional[float],
+        user: Optional[str],
+        correction: float,
+    ):
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE tasks SET state = ?, result = ?, error = ?, run_s = ?,"
+                " lease_until = NULL WHERE id = ? AND lease_owner = ?"
+                " AND state = 'leased'",
+                (state, result, error, run_s, row_id, self.node),
+            )
+            self._charge(db, user, correction)
+
+    # results of the tasks of this node run elsewhere, removed from the queue
+    def _take_results(self) -> List[tuple]:
+        rows = (
+            self._connect()
+            .execute(
+                "SELECT id, state, result, error, run_s, lease_owner FROM tasks"
+                " WHERE node = ? AND state IN ('done', 'failed')",
+                (self.node,),
+            )
+            .fetchall()
+        )
+        if rows:
+            self._delete([row[0] for row in rows])
+        return rows
+
+    def _collect(self):
+        rows = self._run(self._take_results)
+        for row_id, state, result, error, run_s, worker in rows:
+            with self._cond:
+                task = self._local_task(row_id)
+                self._local.pop(row_id, None)
+            if task is None:
+                continue
+            self.collected += 1
+            now = time.monotonic()
+            task.started = True
+            task.started_at = now - (run_s or 0.0)
+            task.worker = worker
+            if state == "done":
+                try:
+                    task.complete(pickle.loads(result))
+                except Exception as e:
+                    logger.error(f"Error completing task {task.id}: {e!r}")
+                    logger.exception(e)
+                continue
+            logger.error(f"Task {task.id} failed on node {worker}: {error}")
+            try:
+                task.fail(error)
+            finally:
+                self.task_done(task.metadata["user"])
+
+    def _heartbeat(self):
+        now = time.time()
+        with self._transaction() as db:
+            db.execute(
+                "INSERT INTO nodes (node, seen_at) VALUES (?, ?) ON CONFLICT (node)"
+                " DO UPDATE SET seen_at = excluded.seen_at",
+                (self.node, now),
+            )
+            db.execute(
+                "UPDATE tasks SET lease_until = ? WHERE state = 'leased'"
+                " AND lease_owner = ?",
+                (now + self.lease_s, self.node),
+            )
+            # leases of dead workers are taken over, up to max_attempts runs
+            db.execute(
+                "UPDATE tasks SET state = 'failed', error = 'lease expired'"
+                " WHERE state = 'leased' AND lease_until < ? AND attempts >= ?",
+                (now, self.max_attempts),
+            )
+            # the flows of dead nodes are lost, so are their queued tasks
+            dead = [
+                node
+                for (node,) in db.execute(
+                    "SELECT node FROM nodes WHERE seen_at < ?",
+                    (now - NODE_TIMEOUT_S,),
+                )
+            ]
+            for node in dead:
+                logger.warning("Node %s is gone, dropping its tasks", node)
+                db.execute("DELETE FROM tasks WHERE node = ?", (node,))
+                db.execute("DELETE FROM connections WHERE node = ?", (node,))
+                db.execute("DELETE FROM notifications WHERE node = ?", (node,))
+                db.execute("DELETE FROM nodes WHERE node = ?", (node,))
+
+    def _take_notifications(self) -> List[tuple]:
+        rows = (
+            self._connect()
+            .execute(
+                "SELECT id, user, message FROM notifications WHERE node = ?"
+                " ORDER BY id",
+                (self.node,),
+            )
+            .fetchall()
+        )
+        if rows:
+            # only this node deletes its notifications
+            with self._transaction() as db:
+                db.execute(
+                    "DELETE FROM notifications WHERE node = ? AND id <= ?",
+                    (self.node, rows[-1][0]),
+                )
+        return rows
+
+    def _pull_notifications(self):
+        for _, user, message in self._run(self._take_notifications):
+            if self.deliver is not None:
+                self.deliver(user, json.loads(message))
+
+    def _background(self):
+        last_heartbeat = time.monotonic()
+        while True:
+            time.sleep(self.poll_s)
+            try:
+                if time.monotonic() - last_heartbeat > self.lease_s / 3:
+                    self._run(self._heartbeat)
+                    last_heartbeat = time.monotonic()
+                self._collect()
+                self._pull_notifications()
+                self._wake()
+            except Exception as e:
+                logger.exception(e)
+
+    # wakes one idle worker when there is something it may claim, it wakes
+    # the next one if it got a task
+    def _wake(self):
+        with self._cond:
+            if not self._idle:
+                return
+        if self._run(self._claimable):
+            with self._cond:
+                self._cond.notify()
+
+    def _claimable(self) -> bool:
+        row = (
+            self._connect()
+            .execute(
+                "SELECT 1 FROM tasks WHERE (state = 'ready'"
+                " OR (state = 'leased' AND lease_until < ?))"
+                " AND (portable OR node = ?) LIMIT 1",
+                (time.time(), self.node),
+            )
+            .fetchone()
+        )
+        return row is not None
+
+    # sends the message to the node holding the websocket of the user, or to
+    # the node running the flow when the user is not connected
+    def forward(self, user: str, message: Dict[str, Any]) -> bool:
+        self._start()
+        if not self._run(self._notify, user, message):
+            return False
+        self.forwarded += 1
+        return True
+
+    def _notify(self, user: str, message: Dict[str, Any]) -> bool:
+        db = self._connect()
+        row = db.execute(
+            "SELECT node FROM connections WHERE user = ?", (user,)
+        ).fetchone()
+        if row is None:
+            row = db.execute(
+                "SELECT node FROM tasks WHERE flow_id = ? LIMIT 1",
+                (message.get("task_id"),),
+            ).fetchone()
+        if row is None or row[0] == self.node:
+            return False
+        with self._transaction() as db:
+            db.execute(
+                "INSERT INTO notifications (node, user, message) VALUES (?, ?, ?)",
+                (row[0], user, json.dumps(message)),
+            )
+        return True
+
+    def connected(self, user: str):
+        self._start()
+        self._run(self._connection, user)
+
+    def _connection(self, user: str):
+        with self._transaction() as db:
+            db.execute(
+                "INSERT INTO connections (user, node) VALUES (?, ?) ON CONFLICT (user)"
+                " DO UPDATE SET node = excluded.node",
+                (user, self.node),
+            )
+
+    def disconnected(self, user: str):
+        self._run(self._disconnection, user)
+
+    def _disconnection(self, user: str):
+        with self._transaction() as db:
+            db.execute(
+                "DELETE FROM connections WHERE user = ? AND node = ?", (user, self.node)
+            )
+
+    def depth(self, user: Optional[str] = None) -> int:
+        return self._run(self._depth, user)
+
+    def _depth(self, user: Optional[str]) -> int:
+        db = self._connect()
+        if user is not None:
+            query = "SELECT COUNT(*) FROM tasks WHERE state = 'ready' AND user = ?"
+            return db.execute(query, (user,)).fetchone()[0]
+        query = "SELECT COUNT(*) FROM tasks WHERE state = 'ready'"
+        return db.execute(query).fetchone()[0]
+
+    def unfinished(self, user: str) -> int:
+        with self._cond:
+            return self._unfinished.get(user, 0)
+
+    def _snapshot(self) -> Tuple[List[tuple], Dict[str, float], Dict[str, float]]:
+        db = self._connect()
+        counts = db.execute(
+            "SELECT user, stage, state, COUNT(*) FROM tasks"
+            " WHERE state IN ('ready', 'leased') GROUP BY user, stage, state"
+        ).fetchall()
+        vtimes = dict(db.execute("SELECT user, vtime FROM users").fetchall())
+        nodes = dict(db.execute("SELECT node, seen_at FROM nodes").fetchall())
+        return counts, vtimes, nodes
+
+    def stats(self) -> Dict[str, Any]:
+        counts, vtimes, nodes = self._run(self._snapshot)
+        users: Dict[str, Dict[str, Any]] = {}
+        stages: Dict[str, Dict[str, Any]] = {}
+        for user, stage, state, count in counts:
+            key = "depth" if state == "ready" else "running"
+            for entry in (
+                users.setdefault(
+                    user,
+                    {
+                        "depth": 0,
+                        "running": 0,
+                        "weight": self.weights.get(user, self.default_weight),
+                        "virtual_time": vtimes.get(user, 0.0),
+                    },
+                ),
+                stages.setdefault(
+                    stage,
+                    {"depth": 0, "running": 0, "limit": self.stage_limits.get(stage)},
+                ),
+            ):
+                entry[key] += count
+        now = time.time()
+        return {
+            "backend": "sqlite",
+            "node": self.node,
+            "nodes": {node: {"seen_s_ago": now - seen} for node, seen in nodes.items()},
+            "depth": sum(stage["depth"] for stage in stages.values()),
+            "users": users,
+            "stages": stages,
+            "claimed_local": self.claimed_local,
+            "claimed_remote": self.claimed_remote,
+            "collected": self.collected,
+            "forwarded": self.forwarded,
+        }
@@ -0,0 +1,263 @@
+import os
+import numpy as np
+from pathlib import Path
+from whisperx.audio import SAMPLE_RATE
+from collections import OrderedDict
+from typing import Dict, List, Set, Tuple
+import threading
+
+
+DATA = "/uploads"
+
+
+def getFilePath(flow_id: str, task_type: str, *args, ext="npy"):
+    name = task_type
+    last = "_".join([str(arg) for arg in args])
+    if last:
+        name = ".".join([name, last])
+    if ext:
+        name = ".".join([name, ext])
+
+    path = Path(os.path.join(DATA, flow_id, name))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+# Arrays handed from one stage to the next. They are kept in RAM while they
+# fit in the byte budget, the least recently used ones are spilled to the
+# flow folder when they don't. Durable artifacts are also written right away
+# so they survive a restart.
+class ArtifactStore:
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[Tuple[str, str], np.ndarray]" = OrderedDict()
+        self._on_disk: Set[Tuple[str, str]] = set()
+        self._spilling: Dict[Tuple[str, str], np.ndarray] = {}
+        self.used_bytes = 0
+
+        # stats
+        self.hits = 0
+        self.misses = 0
+        self.spills = 0
+        self.spilled_bytes = 0
+
+    def path(self, flow_id: str, name: str) -> Path:
+        return getFilePath(flow_id, name)
+
+    # written next to the file and renamed over it under the lock, a reader
+    # (or a recovered flow) never sees a torn or outdated array
+    @staticmethod
+    def _write(path: Path, value: np.ndarray) -> Path:
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, value)
+        return tmp
+
+    def put(self, flow_id: str, name: str, value: np.ndarray, durable: bool = False):
+        key = (flow_id, name)
+        fits = value.nbytes <= self.budget_bytes
+        to_disk = durable or not fits
+        path = self.path(flow_id, name)
+        tmp = self._write(path, value) if to_disk else None
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self.used_bytes -= old.nbytes
+            # a spill of the old value still being written is dropped
+            self._spilling.pop(key, None)
+            if to_disk:
+                os.replace(tmp, path)
+                self._on_disk.add(key)
+            else:
+                # the copy on disk, spilled or left by an earlier run, is stale
+                path.unlink(missing_ok=True)
+                self._on_disk.discard(key)
+            if not fits:
+                return
+            self._memory[key] = value
+            self.used_bytes += value.nbytes
+            victims = self._evict()
+        self._spill(victims)
+
+    def _evict(self) -> List[Tuple[Tuple[str, str], np.ndarray]]:
+        victims = []
+        while self.used_bytes > self.budget_bytes and len(self._memory) > 1:
+            key, value = self._memory.popitem(last=False)
+            self.used_bytes -= value.nbytes
+            if key not in self._on_disk:
+                self._spilling[key] = value
+                victims.append((key, value))
+        return victims
+
+    def _spill(self, victims: List[Tuple[Tuple[str, str], np.ndarray]]):
+        for key, value in victims:
+            path = self.path(*key)
+            tmp = self._write(path, value)
+            with self._lock:
+                if self._spilling.get(key) is not value:
+                    tmp.unlink()  # put again or released while it was written
+                    continue
+                os.replace(tmp, path)
+                self._on_disk.add(key)
+                self._spilling.pop(key)
+                self.spills += 1
+                self.spilled_bytes += value.nbytes
+
+    def get(self, flow_id: str, name: str) -> np.ndarray:
+        key = (flow_id, name)
+        with self._lock:
+            value = self._memory.get(key)
+            if value is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return value
+            value = self._spilling.get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+            self.misses += 1
+        # not promoted back, the page cache keeps the hot parts of the mapping
+        return np.load(self.path(flow_id, name), mmap_mode="r")
+
+    # for arrays written while they are produced, readers map what has been
+    # committed so far
+    def stream(self, flow_id: str, name: str, dtype=np.float32) -> "NpyStreamWriter":
+        key = (flow_id, name)
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self.used_bytes -= old.nbytes
+            self._spilling.pop(key, None)
+            self._on_disk.add(key)
+        return NpyStreamWriter(self.path(flow_id, name), dtype)
+
+    def release(self, flow_id: str):
+        with self._lock:
+            for key in [k for k in self._memory if k[0] == flow_id]:
+                self.used_bytes -= self._memory.pop(key).nbytes
+            for key in [k for k in self._spilling if k[0] == flow_id]:
+                self._spilling.pop(key)
+            self._on_disk = {k for k in self._on_disk if k[0] != flow_id}
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "spills": self.spills,
+                "spilled_bytes": self.spilled_bytes,
+                "memory_bytes": self.used_bytes,
+                "budget_bytes": self.budget_bytes,
+                "artifacts_in_memory": len(self._memory),
+            }
+
+
+# Appends a 1d array to a .npy file block by block. The header has a fixed
+# size and is rewritten on every commit, so np.load sees the samples written
+# up to the last commit while the rest is still being produced.
+class NpyStreamWriter:
+    HEADER_SIZE = 128
+
+    def __init__(self, path: Path, dtype=np.float32):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.length = 0
+        self._file = open(path, "wb")
+        self._write_header()
+
+    def _write_header(self):
+        self._file.seek(0)
+        np.lib.format.write_array_header_1_0(
+            self._file,
+            {
+                "descr": np.lib.format.dtype_to_descr(self.dtype),
+                "fortran_order": False,
+                "shape": (self.length,),
+            },
+        )
+        # padded by numpy to a multiple of 64 bytes, always 128 for 1d arrays
+        if self._file.tell() != self.HEADER_SIZE:
+            raise ValueError(f"Unexpected npy header size {self._file.tell()}")
+        self._file.seek(0, os.SEEK_END)
+
+    def write(self, block: np.ndarray):
+        self._file.write(np.ascontiguousarray(block, dtype=self.dtype).tobytes())
+        self.length += len(block)
+
+    def commit(self):
+        self._file.flush()
+        self._write_header()
+        self._file.flush()
+
+    def close(self):
+        self.commit()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+ARTIFACTS = ArtifactStore(int(os.environ.get("ARTIFACT_MEMORY_MB", 1024)) * 2**20)
+# other nodes read the artifacts from DATA when the queue is shared, and the
+# flows recovered from their journal (FLOW_JOURNAL, on by default) only skip
+# the stages whose outputs are on disk
+DURABLE_ARTIFACTS = (
+    os.environ.get(
+        "DURABLE_ARTIFACTS",
+        (
+            "1"
+            if os.environ.get("QUEUE_BACKEND") == "sqlite"
+            or os.environ.get("FLOW_JOURNAL", "1") == "1"
+            else "0"
+        ),
+    )
+    == "1"
+)
+
+
+# The decoded audio of a flow is stored once, voice segments are stored as
+# an index of sample offsets into it and read back as zero-copy views
+class SegmentStore:
+    AUDIO = "convert_to_numpy"
+    INDEX = "detect_voice_segments.index"
+
+    def __init__(self, flow_id: str, artifacts: ArtifactStore = ARTIFACTS):
+        self.flow_id = flow_id
+        self.artifacts = artifacts
+        self._audio: np.ndarray = None
+        self._index: np.ndarray = None
+
+    def write_audio(self, audio: np.ndarray):
+        self.artifacts.put(self.flow_id, self.AUDIO, audio, DURABLE_ARTIFACTS)
+        self._audio = None
+
+    def write_index(self, timestamps: List[Tuple[float, float]]):
+        index = np.array(
+            [(int(s * SAMPLE_RATE), int(e * SAMPLE_RATE)) for s, e in timestamps],
+            dtype=np.int64,
+        ).reshape(-1, 2)
+        self.artifacts.put(self.flow_id, self.INDEX, index, DURABLE_ARTIFACTS)
+        self._index = index
+
+    @property
+    def audio(self) -> np.ndarray:
+        if self._audio is None:
+            self._audio = self.artifacts.get(self.flow_id, self.AUDIO)
+        return self._audio
+
+    @property
+    def index(self) -> np.ndarray:
+        if self._index is None:
+            self._index = self.artifacts.get(self.flow_id, self.INDEX)
+        return self._index
+
+    def __len__(self):
+        return len(self.index)
+
+    def segment(self, i: int) -> np.ndarray:
+        start, end = self.index[i]
+        return self.audio[start:end]
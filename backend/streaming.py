@@ -0,0 +1,122 @@
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from whisperx.audio import SAMPLE_RATE
+import numpy as np
+import subprocess
+import os
+
+
+STREAM_BLOCK_S = float(os.environ.get("STREAM_BLOCK_S", 10))
+VAD_WINDOW_S = float(os.environ.get("VAD_WINDOW_S", 120))
+VAD_MARGIN_S = float(os.environ.get("VAD_MARGIN_S", 5))
+
+
+# Same decoding as whisperx.load_audio, but the pcm is read from ffmpeg in
+# blocks while it is being produced instead of after it exits
+def decode_stream(
+    path: str, block_s: float = STREAM_BLOCK_S, sr: int = SAMPLE_RATE
+) -> Iterator[np.ndarray]:
+    cmd = [
+        "ffmpeg",
+        "-nostdin",
+        "-loglevel",
+        "error",
+        "-threads",
+        "0",
+        "-i",
+        str(path),
+        "-f",
+        "s16le",
+        "-ac",
+        "1",
+        "-acodec",
+        "pcm_s16le",
+        "-ar",
+        str(sr),
+        "-",
+    ]
+    block_bytes = int(block_s * sr) * 2
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        while True:
+            data = process.stdout.read(block_bytes)
+            if not data:
+                break
+            if len(data) % 2:
+                data += process.stdout.read(1)
+            yield np.frombuffer(data, np.int16).flatten().astype(np.float32) / 32768.0
+        if process.wait() != 0:
+            raise RuntimeError(
+                f"Failed to load audio: {process.stderr.read().decode()}"
+            )
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        process.stderr.close()
+
+
+# Runs the voice activity detection over a sliding window of the stream. A
+# chunk is final once it ends at least margin_s before the end of the window,
+# the audio up to the last final chunk is dropped so memory is bounded by the
+# window and not by the length of the file.
+class StreamingVAD:
+    def __init__(
+        self,
+        detect: Callable[[np.ndarray], List[Dict[str, float]]],
+        window_s: float = VAD_WINDOW_S,
+        margin_s: float = VAD_MARGIN_S,
+        sr: int = SAMPLE_RATE,
+    ):
+        if margin_s >= window_s:
+            raise ValueError("The vad margin must be shorter than the window")
+        self.detect = detect
+        self.window = int(window_s * sr)
+        self.margin = int(margin_s * sr)
+        self.sr = sr
+        self.offset = 0  # absolute sample where the buffer starts
+        # absolute second where the chunk still open (speech going on) starts
+        self.open_start: Optional[float] = None
+        self._blocks: List[np.ndarray] = []
+        self._buffered = 0
+
+    def feed(self, block: np.ndarray) -> List[Tuple[float, float]]:
+        self._blocks.append(block)
+        self._buffered += len(block)
+        if self._buffered < self.window:
+            return []
+        return self._detect(final=False)
+
+    # drops the buffered audio, the next block starts at the absolute sample
+    def reset(self, offset: int):
+        self.offset = offset
+        self.open_start = None
+        self._blocks = []
+        self._buffered = 0
+
+    def flush(self) -> List[Tuple[float, float]]:
+        if not self._buffered:
+            return []
+        return self._detect(final=True)
+
+    def _detect(self, final: bool) -> List[Tuple[float, float]]:
+        buffer = np.concatenate(self._blocks)
+        chunks = self.detect(buffer) if len(buffer) else []
+        limit = len(buffer) if final else len(buffer) - self.margin
+
+        closed: List[Tuple[float, float]] = []
+        keep_from = limit
+        self.open_start = None
+        for chunk in chunks:
+            end = int(chunk["end"] * self.sr)
+            if end > limit:
+                keep_from = min(keep_from, int(chunk["start"] * self.sr))
+                self.open_start = (self.offset + keep_from) / self.sr
+                break
+            start = self.offset + int(chunk["start"] * self.sr)
+            closed.append((start / self.sr, (self.offset + end) / self.sr))
+
+        rest = buffer[keep_from:]
+        self._blocks = [rest] if len(rest) else []
+        self._buffered = len(rest)
+        self.offset += keep_from
+        return closed
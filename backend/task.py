@@ -2,6 +2,9 @@ from typing import List, Callable, Tuple, Dict, Any, Union
 from functools import partial
 from queue import Queue
 from collections import defaultdict
+from cancellation import FlowCancelled
+import threading
+import time
 import logging
 
 logging.basicConfig(level=logging.NOTSET)
@@ -18,19 +21,35 @@ class Task:
         queue: Queue,
         dependencies: List["Task"] = [],
         metadata: Dict[str, Any] = {},
+        on_done: Callable[["Task"], None] = None,
+        on_failed: Callable[["Task"], None] = None,
+        name: str = None,  # defaults to the name of the called function
         **kvargs,
     ):
-        self.id = (flow_id, Task.get_on_call_name(on_call))
+        self.id = (flow_id, name or Task.get_on_call_name(on_call))
         if isinstance(on_call, partial):
             self.on_call = on_call
         else:
             self.on_call = partial(on_call)
         self.queue = queue
+        self.on_done = on_done
+        self.on_failed = on_failed
 
         # state
+        self._lock = threading.Lock()
+        self.enqueued: bool = False
         self.started: bool = False
         self.done: bool = False
         self.result: Dict[Any, Any] = None
+        self.enqueued_at: float = None
+        self.started_at: float = None
+        self.finished_at: float = None
+        self.worker: str = None
+        self.error: str = None
+        # result of a run before a restart, the task completes without running
+        self.recovered: Dict[Any, Any] = None
+        # its flow was cancelled, it won't run nor enqueue its dependants
+        self.cancelled: bool = False
 
         # dependency management
         self.dependants: Dict[Tuple[str, str], List["Task"]] = defaultdict(list)
@@ -47,6 +66,8 @@ class Task:
             "task_type": self.id[1],
             "queue": self.queue,
         }
+        # seconds of audio the task works on, when the flow knows it
+        self.input_seconds: float = self.metadata.get("input_seconds")
 
     @property
     def ready(self):
@@ -68,30 +89,62 @@ class Task:
     def __call__(
         self,
     ):
+        if self.cancelled:
+            raise FlowCancelled(f"Task {self.id} was cancelled before starting")
         self.started = True
+        self.started_at = time.monotonic()
+        self.worker = threading.current_thread().name
         logger.info(
             f"Started task {self.id} execution with arguments {self.on_call.args} {self.on_call.keywords} {self.metadata}"
         )
-        self.result = self.on_call(**self.metadata)
+        self.complete(self.on_call(**self.metadata))
+        return self.result
+
+    # marks the task as done with its result and enqueues what depends on it,
+    # also used for tasks that were run by another node
+    def complete(self, result: Dict[Any, Any], release: bool = True):
+        self.result = result
+        self.finished_at = time.monotonic()
         self.done = True
-        self.queue.task_done()
         logger.info(f"Finished task {self.id} execution, returned: {self.result}")
-
-        for deps in self.dependants.values():
-            for dep in deps:
-                dep.enqueue()
-
-        return self.result
+        if self.on_done:
+            self.on_done(self)
+
+        if not self.cancelled:
+            for deps in self.dependants.values():
+                for dep in deps:
+                    dep.enqueue()
+        if release:
+            # marked as done only after the dependants are in the queue
+            self.queue.task_done()
+
+    # the task raised or its run was lost, its dependants never run, the
+    # worker releases it from the queue
+    def fail(self, error: str):
+        self.error = error
+        self.finished_at = time.monotonic()
+        logger.info(f"Failed task {self.id}: {error}")
+        if self.on_failed:
+            self.on_failed(self)
 
     def _update_on_call(self, kwargs: Dict[Any, Union[Any, List[Any]]]):
         self.on_call = partial(self.on_call, **kwargs)
 
     def enqueue(self):
-        if not self.ready:
-            logger.debug(
-                f"Failed to enqueue task {self.id}, not all dependencies are done"
-            )
-            return False
+        # dependencies may finish concurrently on different workers
+        with self._lock:
+            if self.enqueued:
+                logger.debug(f"Task {self.id} is already enqueued")
+                return False
+            if self.cancelled:
+                logger.debug(f"Task {self.id} was cancelled, not enqueuing it")
+                return False
+            if not self.ready:
+                logger.debug(
+                    f"Failed to enqueue task {self.id}, not all dependencies are done"
+                )
+                return False
+            self.enqueued = True
 
         kwargs = defaultdict(list)
         for deps in self.dependencies.values():
@@ -102,6 +155,12 @@ class Task:
         if self.metadata["unpack_single"]:
             kwargs = {k: v[0] if len(v) == 1 else v for k, v in kwargs.items()}
         self._update_on_call(kwargs)
+        if self.recovered is not None:
+            # never went through the queue, nothing to release there
+            logger.debug(f"Restoring the result of task {self.id}")
+            self.started = True
+            self.complete(self.recovered, release=False)
+            return True
         self.queue.put(self)
         logger.debug(
             f"Succesfully enqueued task {self.id} to run with arguments {self.on_call.args} {self.on_call.keywords} {self.metadata}"
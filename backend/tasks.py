@@ -1,85 +1,73 @@
 import os
 from whisperx import load_audio
-from whisperx.audio import SAMPLE_RATE
 from whisperx.types import SingleSegment, SingleAlignedSegment
 import numpy as np
 from queues import *
-from models import AIModels
-from task import Task, partial, List
-from itertools import cycle
-from pathlib import Path
+from models import AIModels, FINAL, DRAFT, DRAFT_ASR_PROFILE
+from task import List, Any, Dict, Callable, Tuple
+from flow import Flow, FlowRun
+from storage import getFilePath, SegmentStore, ARTIFACTS
+from cache import RESULTS, hash_bytes, hash_file
+from streaming import decode_stream, StreamingVAD
+import cancellation
 
 
-DATA = "/uploads"
-
-
-def getFilePath(flow_id: str, task_type: str, *args, ext="npy"):
-    name = task_type
-    last = "_".join([str(arg) for arg in args])
-    if last:
-        name = ".".join([name, last])
-    if ext:
-        name = ".".join([name, ext])
-
-    path = Path(os.path.join(DATA, flow_id, name))
-    path.parent.mkdir(parents=True, exist_ok=True)
-    return path
+# runs alongside the transcription, only needs the decoded audio
+def diarize_speakers(flow_id: str, **metadata):
+    audio = SegmentStore(flow_id).audio
+    speaker_data = AIModels.get_speaker_turns(audio)
+    response = {"speaker_data": speaker_data}
+    return response
 
 
-def diarize(aligned: List[SingleAlignedSegment], flow_id: str, **metadata):
-    inpath = getFilePath(flow_id, convert_to_numpy.__name__)
-    audio = np.load(inpath)
-    diarization = AIModels.get_diarization(aligned, audio)
+def diarize(
+    aligned: List[SingleAlignedSegment],
+    speaker_data: List[Any],
+    flow_id: str,
+    **metadata,
+):
+    diarization = AIModels.assign_speakers(aligned, speaker_data[0])
     response = {"diarization": diarization}
     return response
 
 
+def shift_timestamps(segment: Dict[str, Any], offset: float) -> Dict[str, Any]:
+    shifted = {**segment}
+    for key in ("start", "end"):
+        if shifted.get(key) is not None:
+            shifted[key] = shifted[key] + offset
+    for key in ("words", "chars"):
+        if key in shifted:
+            shifted[key] = [shift_timestamps(item, offset) for item in shifted[key]]
+    return shifted
+
+
 def align_words(
-    segment: SingleSegment, lang: str, i: int, total: int, flow_id: str, **metadata
+    transcription: SingleSegment, lang: str, i: int, flow_id: str, **metadata
 ):
-    inpath = getFilePath(flow_id, detect_voice_segments.__name__, i, total)
-    audio = np.load(inpath)
-    aligned = AIModels.get_aligment(segment, audio, lang)
+    store = SegmentStore(flow_id)
+    start = transcription["start"]
+    key = hash_bytes(
+        align_words.__name__,
+        AIModels.fingerprint(lang),
+        transcription["text"],
+        store.segment(i),
+    )
+    cached = RESULTS.get(key)
+    if cached is not None:
+        # cached with timestamps relative to the segment start
+        return {"aligned": shift_timestamps(cached, start)}
+
+    # segment timestamps are relative to the whole audio
+    aligned = AIModels.get_aligment(transcription, store.audio, lang)
     result_len = len(aligned["segments"])
     if result_len != 1:
         raise ValueError(f"Expected segments to have a single segment got {result_len}")
-    response = {
-        "aligned": aligned["segments"][0]
-    }  # timestamps may be shifted because of segmented audio
+    RESULTS.put(key, shift_timestamps(aligned["segments"][0], -start))
+    response = {"aligned": aligned["segments"][0]}
     return response
 
 
-# needed to lauch diarize with align_words as dependencies
-def collect_transcriptions(
-    lang: List[str],
-    transcription: List[SingleSegment],
-    i: List[int],
-    total: List[int],
-    flow_id: str,  # injected through metadata
-    **metadata,
-):
-    tasks: List[Task] = []
-    for segment, _lang, _i, _total in zip(transcription, cycle(lang), i, total):
-        tasks.append(
-            Task(
-                flow_id,
-                partial(align_words, segment, _lang, _i, _total),
-                metadata["queue"],
-                metadata=metadata,
-            )
-        )
-    Task(
-        flow_id,
-        partial(diarize),
-        metadata["queue"],
-        tasks,
-        metadata,
-    )
-    for task in tasks:
-        task.enqueue()
-    return {}
-
-
 def transcribe_segment(
     start_time_s: float,
     end_time_s: float,
@@ -88,11 +76,27 @@ def transcribe_segment(
     total: int,
     lang: str,
     flow_id: str,
+    profile: str = None,
+    tier: str = FINAL,
     **metadata,
 ):
-    inpath = getFilePath(flow_id, detect_voice_segments.__name__, i, total)
-    audio = np.load(inpath)
-    text = "".join(AIModels.get_transcription(audio, lang))
+    audio = SegmentStore(flow_id).segment(i)
+    key = hash_bytes(
+        transcribe_segment.__name__,
+        AIModels.fingerprint(profile=profile, tier=tier),
+        lang,
+        audio,
+    )
+    encoder_key = (flow_id, i) if tier == FINAL else (flow_id, i, tier)
+    cached = RESULTS.get(key)
+    if cached is not None:
+        AIModels.pop_encoder_output(encoder_key)
+        text = cached["text"]
+    else:
+        text = "".join(
+            AIModels.get_transcription(audio, lang, encoder_key, profile, tier=tier)
+        )
+        RESULTS.put(key, {"text": text})
     result = {
         "text": text,
         "start": start_time_s,
@@ -107,15 +111,54 @@ def transcribe_segment(
     return response
 
 
-def detect_language(
+# first pass of the two pass flows, the draft model transcribes the segment
+# right away and transcribe_segment replaces its text later
+def transcribe_draft(
+    start_time_s: float,
+    end_time_s: float,
+    total_time: float,
     i: int,
     total: int,
+    lang: str,
     flow_id: str,
     **metadata,
 ):
-    inpath = getFilePath(flow_id, detect_voice_segments.__name__, i, total)
-    audio = np.load(inpath)
-    lang = AIModels.get_language(audio)
+    response = transcribe_segment(
+        start_time_s,
+        end_time_s,
+        total_time,
+        i,
+        total,
+        lang,
+        flow_id,
+        profile=DRAFT_ASR_PROFILE,
+        tier=DRAFT,
+    )
+    return {**response, "draft": True}
+
+
+# the language of the two pass flows comes from the draft model, so the first
+# draft does not wait for the main model
+def detect_draft_language(
+    flow_id: str,
+    **metadata,
+):
+    audio = SegmentStore(flow_id).segment(0)
+    lang = AIModels.get_language(audio, (flow_id, 0, DRAFT), DRAFT)
+    response = {
+        "lang": lang,
+    }
+    return response
+
+
+# runs on the first voice segment as soon as it is found
+def detect_language(
+    flow_id: str,
+    **metadata,
+):
+    audio = SegmentStore(flow_id).segment(0)
+    # the encoder output is kept for the transcription of the same segment
+    lang = AIModels.get_language(audio, (flow_id, 0))
     response = {
         "lang": lang,
     }
@@ -126,86 +169,266 @@ def detect_voice_segments(
     flow_id: str,
     **metadata,
 ):
-    inpath = getFilePath(flow_id, convert_to_numpy.__name__)
-    audio = np.load(inpath)
-    chunks = AIModels.get_voice_segments(audio)
+    store = SegmentStore(flow_id)
+    chunks = AIModels.get_voice_segments(store.audio)
     timestamps = [(chunk["start"], chunk["end"]) for chunk in chunks]
-    split_audio = [
-        audio[int(s * SAMPLE_RATE) : int(e * SAMPLE_RATE)] for s, e in timestamps
-    ]
-    total = len(split_audio)
-    out_paths = [
-        getFilePath(flow_id, detect_voice_segments.__name__, i, total)
-        for i in range(total)
-    ]
+    store.write_index(timestamps)
     total_time = sum([e - s for s, e in timestamps])
 
-    tasks: List[Task] = []
-    for i, op, sa, (s, e) in zip(range(total), out_paths, split_audio, timestamps):
-        np.save(op, sa)
-        if i == 0:
-            tasks.append(
-                Task(
-                    flow_id,
-                    partial(detect_language, i, total),
-                    metadata["queue"],
-                    metadata=metadata,
-                )
-            )
-        tasks.append(
-            Task(
-                flow_id,
-                partial(
-                    transcribe_segment,
-                    s,
-                    e,
-                    total_time,
-                    i,
-                    total,
-                ),
-                metadata["queue"],
-                [tasks[0]],
-                metadata,
+    response = {
+        "segments_timestamps": timestamps,
+        "total_useful_time": total_time,
+    }
+
+    return response
+
+
+# decodes and segments the audio at the same time, every voice segment is
+# emitted as soon as it is closed so its transcription can start while the
+# rest of the file is still being decoded
+def stream_voice_segments(
+    flow_id: str,
+    emit: Callable[[Dict[str, Any]], None],
+    **metadata,
+):
+    store = SegmentStore(flow_id)
+    in_path = getFilePath(flow_id, "upload", ext="")
+    vad = StreamingVAD(AIModels.get_voice_segments)
+    timestamps: List[Tuple[float, float]] = []
+
+    def publish(closed: List[Tuple[float, float]]):
+        if not closed:
+            return
+        # the samples of a segment must be readable before its tasks exist
+        writer.commit()
+        first = len(timestamps)
+        timestamps.extend(closed)
+        store.write_index(timestamps)
+        for i, (s, e) in enumerate(closed, first):
+            emit(
+                {
+                    "start_time_s": s,
+                    "end_time_s": e,
+                    "total_time": None,  # unknown until the end of the stream
+                    "i": i,
+                    "total": None,
+                }
             )
-        )
 
-    if len(tasks):
-        Task(
-            flow_id,
-            partial(collect_transcriptions),
-            metadata["queue"],
-            tasks,
-            metadata,
-            unpack_single=False,
-        )
-        tasks[0].enqueue()
+    with ARTIFACTS.stream(flow_id, SegmentStore.AUDIO) as writer:
+        for block in decode_stream(in_path):
+            cancellation.check(flow_id)
+            writer.write(block)
+            publish(vad.feed(block))
+        publish(vad.flush())
 
+    total_time = sum([e - s for s, e in timestamps])
     response = {
         "segments_timestamps": timestamps,
         "total_useful_time": total_time,
     }
-
     return response
 
 
+def segments_of(voice_segments: Dict[str, Any]):
+    timestamps = voice_segments["segments_timestamps"]
+    return [
+        {
+            "start_time_s": s,
+            "end_time_s": e,
+            "total_time": voice_segments["total_useful_time"],
+            "i": i,
+            "total": len(timestamps),
+        }
+        for i, (s, e) in enumerate(timestamps)
+    ]
+
+
+def segment_seconds(item: Dict[str, Any]) -> float:
+    return item["end_time_s"] - item["start_time_s"]
+
+
 def convert_to_numpy(
     flow_id: str,
     **metadata,
 ):
     in_path = getFilePath(flow_id, "upload", ext="")
-    out_path = getFilePath(flow_id, convert_to_numpy.__name__)
     audio = load_audio(in_path)
-    np.save(out_path, audio)
-    task = Task(
-        flow_id,
-        partial(
-            detect_voice_segments,
-        ),
-        metadata["queue"],
-        metadata=metadata,
-    )
-    task.enqueue()
+    SegmentStore(flow_id).write_audio(audio)
 
     response = {}
 
     return response
+
+
+# an earlier run of the same upload with the same models and options is
+# replayed and the rest of the flow skipped. Hashing a large upload takes a
+# while, it is done by a worker instead of the request.
+def replay_cached_flow(
+    flow_id: str,
+    user: str,
+    profile: str = None,
+    two_pass: bool = False,
+    **metadata,
+):
+    content_hash = hash_file(getFilePath(flow_id, "upload", ext=""))
+    cached = RESULTS.get(flow_cache_key(content_hash, profile, two_pass))
+    if cached is not None:
+        logger.info("Replaying %d cached results of flow %s", len(cached), flow_id)
+        for message in cached:
+            send(user, {**message, "task_id": flow_id})
+    return {"content_hash": content_hash, "replayed": cached is not None}
+
+
+# two pass flows replay the drafts of the draft model as well
+def flow_cache_key(
+    content_hash: str, profile: str = None, two_pass: bool = False
+) -> str:
+    parts = [AIModels.fingerprint(profile=profile), content_hash]
+    if two_pass:
+        parts.append(AIModels.fingerprint(profile=DRAFT_ASR_PROFILE, tier=DRAFT))
+    return hash_bytes("flow", *parts)
+
+
+# the messages sent to the user, in the order they were produced
+def flow_messages(run: FlowRun) -> List[Dict[str, Any]]:
+    tasks = [
+        task
+        for stage, tasks in run.tasks.items()
+        if run.flow.stages[stage].notify
+        for task in tasks
+    ]
+    tasks.sort(key=lambda task: task.finished_at)
+    return [message(task, task.result) for task in tasks]
+
+
+def finish_flow(run: FlowRun):
+    ARTIFACTS.release(run.flow_id)
+    if run.cancelled or run.failed or run.metadata.get("replayed"):
+        return  # partial or replayed results, nothing to cache
+    content_hash = run.metadata.get("content_hash")
+    if content_hash is not None:
+        key = flow_cache_key(
+            content_hash,
+            run.metadata.get("profile"),
+            run.metadata.get("two_pass", False),
+        )
+        RESULTS.put(key, flow_messages(run))
+
+
+# Stages from the voice segments to the diarization, the same whichever way
+# the segments are found. With two_pass every segment gets a draft first, the
+# drafts go before the other tasks of the user and transcribe_segment refines
+# them when nothing more urgent of the user is waiting.
+def transcription_stages(flow: Flow, segments: str, two_pass: bool) -> Flow:
+    if two_pass:
+        flow.stage(
+            detect_draft_language,
+            first_of=segments,
+            cost=1,
+            name=detect_language.__name__,
+        )
+        flow.stage(
+            transcribe_draft,
+            each=segments,
+            after=[detect_language],
+            cost=1,
+            size=segment_seconds,
+            priority=1,
+            message_type=transcribe_segment.__name__,
+        )
+    else:
+        flow.stage(detect_language, first_of=segments, cost=2)
+    return (
+        flow.stage(
+            transcribe_segment,
+            each=segments,
+            # the refined text always reaches the client after its draft
+            after=[detect_language] + ([transcribe_draft] if two_pass else []),
+            cost=5,
+            size=segment_seconds,
+            priority=-1 if two_pass else 0,
+        )
+        .stage(
+            align_words,
+            each=segments,
+            after=[transcribe_segment, detect_language],
+            cost=1,
+            size=segment_seconds,
+        )
+        .stage(diarize, after=[align_words, diarize_speakers], cost=0.5)
+        .compile()
+    )
+
+
+# costs are rough seconds per task on cpu, they are refined with the observed
+# durations and used to run the tasks on the critical path first
+def transcription_flow(name: str, two_pass: bool = False) -> Flow:
+    flow = (
+        Flow(name, on_finish=finish_flow)
+        .stage(
+            replay_cached_flow,
+            notify=False,
+            # finish_flow caches the results under their content_hash
+            annotate=lambda r: r,
+            ends_flow=lambda r: r["replayed"],
+            cost=1,
+        )
+        .stage(
+            convert_to_numpy,
+            after=[replay_cached_flow],
+            cost=5,
+            outputs=[SegmentStore.AUDIO],
+        )
+        .stage(diarize_speakers, after=[convert_to_numpy], notify=False, cost=60)
+        .stage(
+            detect_voice_segments,
+            after=[convert_to_numpy],
+            fan_out=segments_of,
+            # lets the dispatcher serve shorter flows first
+            annotate=lambda r: {"duration": r["total_useful_time"]},
+            cost=5,
+            outputs=[SegmentStore.INDEX],
+        )
+    )
+    return transcription_stages(flow, detect_voice_segments.__name__, two_pass)
+
+
+# decoding and segmentation are a single streaming stage, keeping the name of
+# the segmentation so the clients see the same messages. Diarization needs
+# the whole audio so it waits for the end of the stream.
+def streaming_transcription_flow(name: str, two_pass: bool = False) -> Flow:
+    flow = (
+        Flow(name, on_finish=finish_flow)
+        .stage(
+            replay_cached_flow,
+            notify=False,
+            # finish_flow caches the results under their content_hash
+            annotate=lambda r: r,
+            ends_flow=lambda r: r["replayed"],
+            cost=1,
+        )
+        .stage(
+            stream_voice_segments,
+            after=[replay_cached_flow],
+            name=detect_voice_segments.__name__,
+            streams=True,
+            cost=10,
+            outputs=[SegmentStore.AUDIO, SegmentStore.INDEX],
+        )
+        .stage(
+            diarize_speakers,
+            after=[detect_voice_segments.__name__],
+            notify=False,
+            cost=60,
+        )
+    )
+    return transcription_stages(flow, detect_voice_segments.__name__, two_pass)
+
+
+TRANSCRIPTION_FLOW = transcription_flow("transcription")
+STREAMING_TRANSCRIPTION_FLOW = streaming_transcription_flow("streaming_transcription")
+TWO_PASS_TRANSCRIPTION_FLOW = transcription_flow("two_pass_transcription", True)
+TWO_PASS_STREAMING_TRANSCRIPTION_FLOW = streaming_transcription_flow(
+    "two_pass_streaming_transcription", True
+)
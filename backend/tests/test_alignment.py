@@ -0,0 +1,58 @@
+import pytest
+import numpy as np
+
+torch = pytest.importorskip("torch")
+torchaudio = pytest.importorskip("torchaudio")
+pytest.importorskip("whisperx")
+from models import AIModels  # noqa: E402
+
+
+# random weights, small enough to run on every test
+def wav2vec2(mode: str):
+    model = torchaudio.models.wav2vec2_model(
+        extractor_mode=mode,
+        extractor_conv_layer_config=[(32, 10, 5)] + [(32, 3, 2)] * 4 + [(32, 2, 2)] * 2,
+        extractor_conv_bias=False,
+        encoder_embed_dim=32,
+        encoder_projection_dropout=0.0,
+        encoder_pos_conv_kernel=16,
+        encoder_pos_conv_groups=4,
+        encoder_num_layers=2,
+        encoder_num_heads=2,
+        encoder_attention_dropout=0.0,
+        encoder_ff_interm_features=64,
+        encoder_ff_interm_dropout=0.0,
+        encoder_dropout=0.0,
+        encoder_layer_norm_first=mode == "layer_norm",
+        encoder_layer_drop=0.0,
+        aux_num_out=10,
+    )
+    return model.eval()
+
+
+@pytest.mark.parametrize("mode", ["group_norm", "layer_norm"])
+def test_batched_emissions_match_unbatched(mode):
+    torch.manual_seed(0)
+    model = wav2vec2(mode)
+    metadata = {"type": "torchaudio"}
+    rng = np.random.default_rng(0)
+    waveforms = [
+        rng.standard_normal(n).astype(np.float32) for n in (16000, 9000, 16000, 12000)
+    ]
+
+    batches = AIModels._emission_batches(model, waveforms)
+    if mode == "group_norm":
+        assert sorted(map(sorted, batches)) == [[0, 2], [1], [3]]
+    else:
+        assert len(batches) == 1
+    for batch in batches:
+        emissions = AIModels._emissions(model, metadata, [waveforms[k] for k in batch])
+        for k, emission in zip(batch, emissions):
+            (alone,) = AIModels._emissions(model, metadata, [waveforms[k]])
+            torch.testing.assert_close(emission, alone, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("mode", ["group_norm", "layer_norm"])
+def test_only_models_that_pad_go_through_the_batcher(mode, monkeypatch):
+    monkeypatch.setattr(AIModels, "align_batching", {})
+    assert AIModels._batches_alignment("xx", wav2vec2(mode)) == (mode == "layer_norm")
@@ -0,0 +1,37 @@
+import os
+
+from cache import ResultCache, hash_bytes
+
+
+def age(cache: ResultCache, key: str, seconds_ago: float):
+    at = os.path.getmtime(cache._path(key)) - seconds_ago
+    os.utime(cache._path(key), (at, at))
+
+
+def test_least_recently_used_results_are_evicted(tmp_path):
+    value = "x" * 100
+    cache = ResultCache(str(tmp_path), max_bytes=350)
+    for n, key in enumerate(["a", "b", "c"]):
+        cache.put(key, value)
+        age(cache, key, 30 - n)
+    assert cache.get("a") == value  # a is recent again
+
+    cache.put("d", value)
+    assert cache.get("b") is None
+    assert [cache.get(key) for key in ("a", "c", "d")] == [value] * 3
+    assert cache.stats()["evictions"] == 1
+    assert cache.used_bytes == 3 * len('"' + value + '"')
+
+
+def test_entries_on_disk_count_after_a_restart(tmp_path):
+    ResultCache(str(tmp_path), max_bytes=1000).put("a", [1, 2, 3])
+
+    cache = ResultCache(str(tmp_path), max_bytes=1000)
+    stats = cache.stats()
+    assert stats["entries"] == 1 and stats["used_bytes"] == len("[1, 2, 3]")
+    assert cache.get("a") == [1, 2, 3]
+
+
+def test_keys_depend_on_every_part_and_its_boundaries():
+    assert hash_bytes("ab", "c") != hash_bytes("a", "bc")
+    assert hash_bytes("a", "b") == hash_bytes("a", "b")
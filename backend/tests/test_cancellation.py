@@ -0,0 +1,111 @@
+import threading
+
+import pytest
+
+import cancellation
+from batching import Batcher
+from cancellation import FlowCancelled
+from dispatcher import Dispatcher
+from flow import Flow, FLOWS, finished_progress
+from queues import run_task
+import storage
+
+started = threading.Event()
+
+
+def first(**metadata):
+    return {"value": 1}
+
+
+def last(value: int, **metadata):
+    return {"value": value + 1}
+
+
+# a long stage checking for cancellation between its blocks
+def blocks(flow_id: str, **metadata):
+    started.set()
+    while True:
+        cancellation.check(flow_id)
+        threading.Event().wait(0.01)
+
+
+def test_cancelled_flow_drops_its_queued_tasks(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "DATA", str(tmp_path))
+    finished = []
+    flow = Flow("test_cancel_queued", on_finish=finished.append)
+    flow.stage(first).stage(last, after=[first])
+    queue = Dispatcher()
+    run = flow.run("flow_c1", queue["user"], metadata={"user": "user", "notify": False})
+    run.start()
+
+    assert run.cancel("requested")
+    assert not run.cancel("again")
+    assert run.cancelled and not run.failed and finished == [run]
+    assert queue.get(block=False) is None and queue.unfinished("user") == 0
+    assert "flow_c1" not in FLOWS and finished_progress("flow_c1")["cancelled"]
+    assert not run.journal.path.exists()
+
+
+def test_running_stage_stops_at_its_next_check(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "DATA", str(tmp_path))
+    started.clear()
+    flow = Flow("test_cancel_running").stage(blocks).stage(last, after=[blocks])
+    queue = Dispatcher()
+    run = flow.run("flow_c2", queue["user"], metadata={"user": "user", "notify": False})
+    run.start()
+    task = queue.get(block=False)
+    worker = threading.Thread(target=run_task, args=[task])
+    worker.start()
+    assert started.wait(5)
+
+    run.cancel("requested")
+    worker.join(5)
+    queue.finish(task)
+
+    assert not worker.is_alive()
+    assert task.cancelled and task.error == "cancelled"
+    assert not run.tasks["last"][0].enqueued
+    assert queue.unfinished("user") == 0
+
+
+def test_item_waiting_for_its_batch_is_taken_back(monkeypatch):
+    monkeypatch.setattr("batching.CANCEL_POLL_S", 0.01)
+    batches = []
+    batcher = Batcher(
+        lambda key, items: batches.append(items) or items,
+        max_batch_size=2,
+        max_wait_s=0.5,
+    )
+    cancellation.forget("flow_c3")
+
+    raised = []
+
+    def wait():
+        with cancellation.running("flow_c3"):
+            with pytest.raises(FlowCancelled):
+                batcher("key", "cancelled")
+            raised.append(True)
+
+    waiting = threading.Thread(target=wait)
+    waiting.start()
+    while not batcher.stats()["pending"]:
+        pass
+    cancellation.cancel("flow_c3")
+    waiting.join(5)
+    assert raised == [True]
+
+    # the batch the item was waiting for runs without it
+    assert batcher("key", "kept") == "kept"
+    assert batches == [["kept"]]
+
+
+def test_check_raises_only_for_cancelled_flows():
+    cancellation.forget("flow_c4")
+    cancellation.check("flow_c4")
+    cancellation.cancel("flow_c4")
+    with pytest.raises(FlowCancelled):
+        cancellation.check("flow_c4")
+    with cancellation.running("flow_c4"):
+        assert cancellation.is_cancelled()
+    cancellation.forget("flow_c4")
+    assert not cancellation.is_cancelled("flow_c4")
@@ -0,0 +1,24 @@
+import warnings
+
+import numpy as np
+
+import diarization
+
+
+def test_zero_and_nan_embeddings_stay_apart():
+    embeddings = np.array(
+        [
+            [1.0, 0.0, 0.0],
+            [0.0, 0.0, 0.0],
+            [0.99, 0.1, 0.0],
+            [0.0, 0.0, 0.0],
+            [np.nan, np.nan, np.nan],
+        ]
+    )
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        clusters = diarization.cluster_speakers(embeddings, [0, 0, 1, 1, 2], 0.5)
+    # the two speakers with an embedding are matched across windows, the
+    # padded and NaN ones are never merged with anything
+    assert clusters[0] == clusters[2]
+    assert len({clusters[0], clusters[1], clusters[3], clusters[4]}) == 4
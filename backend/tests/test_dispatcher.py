@@ -0,0 +1,30 @@
+from dispatcher import Dispatcher
+from task import Task
+
+
+def stage(**metadata):
+    return {}
+
+
+def task(queue: Dispatcher, user: str, name: str, priority: int) -> Task:
+    return Task(
+        f"{user}_flow",
+        stage,
+        queue[user],
+        metadata={"user": user, "priority": priority},
+        name=name,
+    )
+
+
+def test_priority_stays_inside_the_share_of_the_user():
+    queue = Dispatcher()
+    queue.put("a", task(queue, "a", "a_refine", 0))
+    queue.put("b", task(queue, "b", "b_transcribe", 0))
+    # a got its turn, the drafts it queues meanwhile wait for b
+    running = queue.get(block=False)
+    assert running.id[1] == "a_refine"
+    for i in range(2):
+        queue.put("a", task(queue, "a", f"a_draft_{i}", 1))
+
+    order = [queue.get(block=False).id[1] for _ in range(3)]
+    assert order == ["b_transcribe", "a_draft_0", "a_draft_1"]
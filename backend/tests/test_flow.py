@@ -0,0 +1,128 @@
+from dispatcher import Dispatcher
+from flow import Flow, FLOWS, finished_progress, recover_flows
+from queues import run_task
+import storage
+
+
+def first(**metadata):
+    return {"value": 1}
+
+
+def broken(value: int, **metadata):
+    raise RuntimeError("stage failed")
+
+
+def last(value: int, **metadata):
+    return {"value": value + 1}
+
+
+produced = []
+
+
+def produce(flow_id: str, **metadata):
+    produced.append(flow_id)
+    storage.getFilePath(flow_id, "out").touch()
+    return {"value": 1}
+
+
+def skip(**metadata):
+    return {"value": 1, "skip": True}
+
+
+def drain(queue: Dispatcher):
+    while True:
+        task = queue.get(block=False)
+        if task is None:
+            return
+        try:
+            run_task(task)
+        finally:
+            queue.finish(task)
+
+
+def test_failed_stage_ends_the_flow(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "DATA", str(tmp_path))
+    finished = []
+    flow = Flow("test_failing", on_finish=finished.append)
+    flow.stage(first).stage(broken, after=[first]).stage(last, after=[broken])
+    queue = Dispatcher()
+    run = flow.run("flow_1", queue["user"], metadata={"user": "user", "notify": False})
+
+    assert run.start()
+    assert run.journal.path.exists()
+    drain(queue)
+
+    assert run.finished and run.failed and not run.cancelled
+    assert finished == [run]
+    assert "flow_1" not in FLOWS
+    assert finished_progress("flow_1")["failed"]
+    assert not run.journal.path.exists()
+    # the dependant of the failed stage never ran
+    (dependant,) = run.tasks["last"]
+    assert dependant.cancelled and not dependant.started
+    assert run.tasks["broken"][0].error == "RuntimeError('stage failed')"
+    assert queue.unfinished("user") == 0 and queue.depth() == 0
+
+
+def test_stage_can_end_the_flow(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "DATA", str(tmp_path))
+    finished = []
+    flow = Flow("test_ending", on_finish=finished.append)
+    flow.stage(skip, annotate=lambda r: r, ends_flow=lambda r: r["skip"])
+    flow.stage(last, after=[skip]).stage(broken, after=[last])
+    queue = Dispatcher()
+    run = flow.run("flow_2", queue["user"], metadata={"user": "user", "notify": False})
+
+    assert run.start()
+    drain(queue)
+
+    assert run.finished and not run.failed and not run.cancelled
+    assert finished == [run] and run.metadata["skip"]
+    assert run.dropped == {"last", "broken"}
+    assert "last" not in run.tasks
+    assert queue.unfinished("user") == 0 and queue.depth() == 0
+
+
+# runs the first stage and loses the process before the second one, the
+# journal ends with a torn record
+def interrupt(name: str, flow_id: str):
+    flow = Flow(name).stage(produce, outputs=["out"]).stage(last, after=[produce])
+    queue = Dispatcher()
+    run = flow.run(flow_id, queue["user"], metadata={"user": "user", "notify": False})
+    run.start()
+    task = queue.get(block=False)
+    run_task(task)
+    queue.finish(task)
+    FLOWS.pop(flow_id)
+    with open(run.journal.path, "ab") as f:
+        f.write(b"\x80\x04torn")
+
+
+def test_interrupted_flow_resumes_after_its_finished_stages(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "DATA", str(tmp_path))
+    produced.clear()
+    interrupt("test_recovery", "flow_3")
+
+    queue = Dispatcher()
+    (run,) = recover_flows(queue)
+    drain(queue)
+
+    assert produced == ["flow_3"]
+    assert run.finished and not run.failed
+    assert run.tasks["last"][0].result == {"value": 2}
+    assert not run.journal.path.exists()
+    assert recover_flows(queue) == []
+
+
+def test_stage_runs_again_when_its_outputs_are_gone(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "DATA", str(tmp_path))
+    produced.clear()
+    interrupt("test_lost_outputs", "flow_4")
+    storage.getFilePath("flow_4", "out").unlink()
+
+    queue = Dispatcher()
+    (run,) = recover_flows(queue)
+    drain(queue)
+
+    assert produced == ["flow_4", "flow_4"]
+    assert run.finished and run.tasks["last"][0].result == {"value": 2}
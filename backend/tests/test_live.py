@@ -0,0 +1,34 @@
+import numpy as np
+
+from live import RingBuffer, LiveSessions
+
+
+def test_ring_buffer_keeps_the_last_samples():
+    ring = RingBuffer(8)
+    ring.write(np.arange(5, dtype=np.float32))
+    ring.write(np.arange(5, 11, dtype=np.float32))
+
+    assert (ring.start, ring.end) == (3, 11)
+    # wraps around the end of the storage
+    np.testing.assert_array_equal(ring.read(4, 10), np.arange(4, 10))
+    # the overwritten samples are skipped
+    np.testing.assert_array_equal(ring.read(0, 5), [3, 4])
+    assert len(ring.read(11, 20)) == 0
+
+
+def test_ring_buffer_write_larger_than_capacity():
+    ring = RingBuffer(4)
+    ring.write(np.arange(10, dtype=np.float32))
+
+    assert (ring.start, ring.end) == (6, 10)
+    np.testing.assert_array_equal(ring.read(0, 10), [6, 7, 8, 9])
+
+
+def test_only_live_text_frames_are_commands():
+    assert LiveSessions.command('{"live": "start", "lang": "en"}') == {
+        "live": "start",
+        "lang": "en",
+    }
+    assert LiveSessions.command('{"ack": 3}') is None
+    assert LiveSessions.command("not json") is None
+    assert LiveSessions.command(b"\x00\x01") is None
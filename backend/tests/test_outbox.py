@@ -0,0 +1,145 @@
+import json
+import queue
+import threading
+
+from outbox import Outbox
+
+
+# a websocket that hands the frames it is sent to the test
+class Conn:
+    def __init__(self):
+        self.frames = queue.Queue()
+        self.closed = None
+
+    def send(self, frame):
+        self.frames.put(json.loads(frame))
+
+    def close(self, reason=None, message=None):
+        self.closed = reason
+
+    def messages(self, count: int):
+        received = []
+        while len(received) < count:
+            frame = self.frames.get(timeout=5)
+            received += frame["messages"] if frame.get("task_type") == "batch" else [frame]
+        return received
+
+
+def outbox(tmp_path, **options) -> Outbox:
+    return Outbox(str(tmp_path), coalesce_s=0.01, **options)
+
+
+def test_messages_are_numbered_per_user(tmp_path):
+    box = outbox(tmp_path)
+    assert [box.post("a", {"n": n}) for n in range(3)] == [1, 2, 3]
+    assert box.post("b", {"n": 0}) == 1
+
+
+def test_reconnecting_client_gets_what_it_did_not_acknowledge(tmp_path):
+    box = outbox(tmp_path)
+    for n in range(5):
+        box.post("a", {"n": n})
+    box.ack("a", 2)
+
+    conn = Conn()
+    box.attach("a", conn)
+    assert [m["seq"] for m in conn.messages(3)] == [3, 4, 5]
+    box.detach("a", conn)
+
+    # the sequence number the client saw acknowledges what came before
+    conn = Conn()
+    box.attach("a", conn, last_seq=4)
+    assert [m["seq"] for m in conn.messages(1)] == [5]
+    box.detach("a", conn)
+
+
+def test_pending_messages_survive_a_restart(tmp_path):
+    box = outbox(tmp_path)
+    for n in range(4):
+        box.post("a", {"n": n})
+    box.ack("a", 1)
+
+    box = outbox(tmp_path)
+    assert box.post("a", {"n": 4}) == 5
+    conn = Conn()
+    box.attach("a", conn)
+    assert [m["n"] for m in conn.messages(4)] == [1, 2, 3, 4]
+    box.detach("a", conn)
+
+
+def test_messages_posted_together_share_a_frame(tmp_path):
+    box = outbox(tmp_path, max_frame_messages=4)
+    box.coalesce_s = 0.5
+    conn = Conn()
+    box.attach("a", conn)
+    for n in range(6):
+        box.post("a", {"n": n})
+
+    first = conn.frames.get(timeout=5)
+    assert [m["n"] for m in first["messages"]] == [0, 1, 2, 3]
+    assert [m["n"] for m in conn.messages(2)] == [4, 5]
+    box.detach("a", conn)
+    assert box.stats()["frames"] == 2
+
+
+def test_a_post_only_wakes_the_senders_of_its_user(tmp_path):
+    box = outbox(tmp_path)
+    a, b = Conn(), Conn()
+    box.attach("a", a)
+    box.attach("b", b)
+    waits = []
+    wait = box._boxes["b"].cond.wait
+    box._boxes["b"].cond.wait = lambda *args: waits.append(args) or wait(*args)
+
+    for n in range(10):
+        box.post("a", {"n": n})
+    assert len(a.messages(10)) == 10
+    assert waits == []
+    box.detach("a", a)
+    box.detach("b", b)
+
+
+def test_oldest_messages_expire_when_the_mailbox_is_full(tmp_path):
+    box = outbox(tmp_path, max_messages=3)
+    for n in range(5):
+        box.post("a", {"n": n})
+    conn = Conn()
+    box.attach("a", conn)
+    assert [m["seq"] for m in conn.messages(3)] == [3, 4, 5]
+    box.detach("a", conn)
+    assert box.stats()["expired"] == 2
+
+
+def test_lagging_connection_is_closed(tmp_path):
+    box = outbox(tmp_path, max_lag=2)
+    conn = Conn()
+    # holds the sender on its first frame until the rest is posted
+    sending, posted = threading.Event(), threading.Event()
+    send = conn.send
+    conn.send = lambda frame: sending.set() or posted.wait(5) and send(frame)
+    box.attach("a", conn)
+    box.post("a", {"n": 0})
+    assert sending.wait(5)
+    for n in range(1, 5):
+        box.post("a", {"n": n})
+    posted.set()
+
+    conn.messages(1)
+    for _ in range(100):
+        if conn.closed:
+            break
+        threading.Event().wait(0.05)
+    assert conn.closed == 1013
+    assert not box.connected("a")
+
+
+def test_idle_empty_mailboxes_are_evicted(tmp_path):
+    box = outbox(tmp_path, retention_s=0.0)
+    box.post("a", {"n": 0})
+    box.ack("a", 1)
+    box._swept = 0
+    box.post("b", {"n": 0})
+    assert "a" not in box._boxes
+    assert box.stats()["evicted"] == 1
+    # its file keeps the numbering
+    assert box.post("a", {"n": 1}) == 2
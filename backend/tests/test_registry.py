@@ -0,0 +1,66 @@
+import threading
+
+import pytest
+
+from registry import ModelRegistry
+
+
+def test_concurrent_requests_share_a_single_load():
+    registry = ModelRegistry(size=lambda value: 1)
+    release = threading.Event()
+    loads = []
+
+    def load():
+        loads.append(1)
+        release.wait(5)
+        return "model"
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(registry.get("en", load)))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    while registry.stats()["loading"] != ["en"]:
+        pass
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert results == ["model"] * 4 and loads == [1]
+    assert registry.stats()["loads"] == 1
+
+
+def test_failed_load_is_retried_by_the_next_request():
+    registry = ModelRegistry(size=lambda value: 1)
+
+    def broken():
+        raise RuntimeError("no such model")
+
+    with pytest.raises(RuntimeError):
+        registry.get("xx", broken)
+    assert registry.get("xx", lambda: "model") == "model"
+    assert registry.stats()["failed_loads"] == 1
+
+
+def test_least_recently_used_models_are_evicted_over_budget():
+    registry = ModelRegistry(budget_bytes=10, size=len)
+    registry.get("a", lambda: "a" * 4)
+    registry.get("b", lambda: "b" * 4)
+    registry.get("a", lambda: "unused")  # a is recent again
+    registry.get("c", lambda: "c" * 4)
+
+    assert "b" not in registry and "a" in registry and "c" in registry
+    assert registry.used_bytes == 8 and registry.evictions == 1
+
+
+def test_model_over_budget_alone_still_loads():
+    registry = ModelRegistry(budget_bytes=10, max_entries=2, size=len)
+    registry.get("a", lambda: "a")
+    registry.get("b", lambda: "b")
+    registry.get("c", lambda: "c")
+    assert registry.stats()["entries"] == ["b", "c"]
+
+    assert registry.get("big", lambda: "x" * 20) == "x" * 20
+    assert registry.stats()["entries"] == ["big"]
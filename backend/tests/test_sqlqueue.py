@@ -0,0 +1,79 @@
+import time
+
+from sqlqueue import SqliteQueue, RemoteTask
+from task import Task
+
+
+def double(value: int = 1, **metadata):
+    return {"value": 2 * value}
+
+
+def node(tmp_path, name: str, **options) -> SqliteQueue:
+    # the background thread stays asleep, the tests collect themselves
+    return SqliteQueue(str(tmp_path / "queue.db"), node=name, poll_s=60, **options)
+
+
+def task(queue: SqliteQueue, flow_id: str = "flow") -> Task:
+    return Task(flow_id, double, queue["user"], metadata={"user": "user"})
+
+
+def test_task_run_by_another_node_completes_on_its_own(tmp_path):
+    owner, worker = node(tmp_path, "owner"), node(tmp_path, "worker")
+    queued = task(owner)
+    assert queued.enqueue()
+
+    claimed = worker.get(block=False)
+    assert isinstance(claimed, RemoteTask) and claimed.owner == "owner"
+    claimed()
+    worker.finish(claimed)
+    assert not queued.done
+
+    owner._collect()
+    assert queued.done and queued.result == {"value": 2}
+    assert owner.unfinished("user") == 0 and owner.depth() == 0
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    owner = node(tmp_path, "owner")
+    lost, other = node(tmp_path, "lost", lease_s=0.05), node(tmp_path, "other")
+    queued = task(owner)
+    queued.enqueue()
+
+    stuck = lost.get(block=False)
+    assert other.get(block=False) is None  # leased
+    time.sleep(0.1)
+    retried = other.get(block=False)
+    assert retried.row_id == stuck.row_id
+
+    # the node that lost the lease has no say on the result anymore
+    stuck.fail("too late")
+    lost.finish(stuck)
+    retried()
+    other.finish(retried)
+    owner._collect()
+    assert queued.done and queued.error is None
+
+
+def test_task_fails_after_max_attempts(tmp_path):
+    owner = node(tmp_path, "owner", max_attempts=1)
+    lost = node(tmp_path, "lost", lease_s=0.05)
+    queued = task(owner)
+    queued.enqueue()
+
+    lost.get(block=False)
+    time.sleep(0.1)
+    owner._heartbeat()
+    assert owner.get(block=False) is None
+
+    owner._collect()
+    assert queued.error == "lease expired" and not queued.done
+    assert owner.unfinished("user") == 0
+
+
+def test_cancel_drops_the_ready_tasks_of_the_flow(tmp_path):
+    owner = node(tmp_path, "owner")
+    for flow_id in ("a", "a", "b"):
+        task(owner, flow_id).enqueue()
+
+    assert owner.cancel("user", "a") == 2
+    assert owner.depth() == 1 and owner.unfinished("user") == 1
@@ -0,0 +1,26 @@
+import numpy as np
+
+import storage
+from storage import ArtifactStore
+
+
+def test_spilled_copy_is_removed_when_put_again(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "DATA", str(tmp_path))
+    store = ArtifactStore(budget_bytes=1000)
+    store.put("flow", "a", np.zeros(100, dtype=np.float32))  # 400 bytes
+    store.put("flow", "b", np.zeros(200, dtype=np.float32))  # spills a
+    assert store.path("flow", "a").exists()
+
+    store.put("flow", "a", np.ones(10, dtype=np.float32))
+    assert not store.path("flow", "a").exists()
+    np.testing.assert_array_equal(store.get("flow", "a"), np.ones(10))
+
+
+def test_durable_artifacts_are_written_whole(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, "DATA", str(tmp_path))
+    store = ArtifactStore(budget_bytes=1 << 20)
+    store.put("flow", "a", np.arange(5), durable=True)
+    store.put("flow", "a", np.arange(7), durable=True)
+
+    np.testing.assert_array_equal(np.load(store.path("flow", "a")), np.arange(7))
+    assert [p.name for p in (tmp_path / "flow").iterdir()] == ["a.npy"]
@@ -0,0 +1,48 @@
+import numpy as np
+
+from streaming import StreamingVAD
+
+SR = 10
+
+
+# voice wherever the signal is not zero, seconds relative to the audio given
+def detect(audio: np.ndarray):
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], audio != 0, [0]]).astype(int)))
+    return [{"start": s / SR, "end": e / SR} for s, e in zip(edges[::2], edges[1::2])]
+
+
+def speech(length: int, *spans):
+    audio = np.zeros(length, dtype=np.float32)
+    for start, end in spans:
+        audio[start:end] = 1.0
+    return audio
+
+
+def stream(vad: StreamingVAD, audio: np.ndarray, block: int):
+    segments, buffered = [], []
+    for i in range(0, len(audio), block):
+        segments += vad.feed(audio[i : i + block])
+        buffered.append(vad._buffered)
+    return segments + vad.flush(), max(buffered)
+
+
+def test_segments_match_the_whole_file_vad():
+    audio = speech(400, (30, 50), (95, 130), (250, 260), (390, 400))
+    vad = StreamingVAD(detect, window_s=10, margin_s=2, sr=SR)
+
+    segments, buffered = stream(vad, audio, 25)
+
+    expected = [(c["start"], c["end"]) for c in detect(audio)]
+    assert segments == expected
+    # the audio before the last closed segment is dropped
+    assert buffered < 100 + 25
+
+
+def test_segment_still_open_at_the_window_end_is_kept_whole():
+    audio = speech(300, (80, 160))
+    vad = StreamingVAD(detect, window_s=10, margin_s=2, sr=SR)
+
+    assert vad.feed(audio[:100]) == []
+    assert vad.open_start == 8.0
+    assert vad.feed(audio[100:]) == [(8.0, 16.0)]
+    assert vad.open_start is None and vad.flush() == []
@@ -0,0 +1,17 @@
+# Worker only node for QUEUE_BACKEND=sqlite: claims the tasks every node puts
+# in the shared queue and runs them, flows are started by the app nodes
+#
+#   QUEUE_BACKEND=sqlite QUEUE_DB=/uploads/.queue/queue.db python3 worker.py
+from queues import process_queues, QUEUE_BACKEND
+from models import AIModels
+
+# the queued tasks call the stage functions defined there
+import tasks
+
+if __name__ == "__main__":
+    if QUEUE_BACKEND != "sqlite":
+        raise SystemExit("worker.py needs a shared queue, set QUEUE_BACKEND=sqlite")
+    AIModels.start()
+    process_queues(ready=AIModels.ready, done=AIModels.startup_done)
+    # only returns when the models failed to load
+    raise SystemExit(f"Model startup failed: {AIModels.startup_error}")
@@ -1,7 +1,13 @@
 import { NextResponse } from "next/server";
 import { writeFile, mkdir } from "fs/promises";
 import path, { dirname } from "path";
-import { FILE_KEY, FILE_NAME_KEY, TASK_KEY, USER_KEY } from "@/lib/constants";
+import {
+  FILE_KEY,
+  FILE_NAME_KEY,
+  PROFILE_KEY,
+  TASK_KEY,
+  USER_KEY,
+} from "@/lib/constants";
 import axios from "axios";
 
 const uploadDir = path.join(process.cwd(), "uploads");
@@ -13,6 +19,8 @@ export async function POST(req: Request) {
     const file = formData.get(FILE_KEY) as File | null;
     const user = formData.get(USER_KEY) as string | null;
     const task = formData.get(TASK_KEY) as string | null;
+    // optional decoding profile: fast, balanced or accurate
+    const profile = formData.get(PROFILE_KEY) as string | null;
 
     if (!file || !task) {
       return NextResponse.json(
@@ -38,6 +46,7 @@ export async function POST(req: Request) {
         params: {
           user: user,
           task: task,
+          ...(profile ? { profile } : {}),
         },
       }
     );
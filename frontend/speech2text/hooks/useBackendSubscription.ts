@@ -1,6 +1,7 @@
 "use client";
 import {
   alignmentResponse,
+  backendFrame,
   backendResponse,
   diarizationResponse,
   languageDetectionResponse,
@@ -8,10 +9,8 @@ import {
   transcriptionResponse,
   voiceSegmentsDetectionResponse,
 } from "@/types/backend";
-import { useEffect, useMemo, useState } from "react";
+import { useCallback, useEffect, useRef } from "react";
 import useWebSocket, { ReadyState } from "react-use-websocket";
-import { usePrevious } from "./usePrevious";
-import { json } from "stream/consumers";
 
 interface Props {
   user: string;
@@ -23,72 +22,82 @@ interface Props {
   onDiarization?: (r: diarizationResponse) => void | Promise<void>;
 }
 
-export function useBackendSubscription({
-  user,
-  onLanguageFound,
-  onPreProcess,
-  onSegmentation,
-  onTranscription,
-  onAlignment,
-  onDiarization,
-}: Props) {
-  //const window = useWindow();
-  const connectionString = useMemo(() => {
-    const host = "localhost:8000";
-    return `ws://${host}/ws?user=${user}`; //TODO: should be url sanitized
-  }, [user /*window*/]);
-  const { lastMessage, readyState } = useWebSocket(connectionString, {
-    shouldReconnect: () => true,
-    reconnectInterval: 10_000,
-    reconnectAttempts: Infinity,
-  });
-  const lastJsonMessage = useMemo(() => {
-    if (lastMessage?.data)
-      return JSON.parse(lastMessage.data) as backendResponse;
-    return null;
-  }, [lastMessage]);
-  const prev = usePrevious(lastJsonMessage);
+const lastSeqKey = (user: string) => `speech2text:last_seq:${user}`;
+
+export function useBackendSubscription(props: Props) {
+  const { user } = props;
+  // the callbacks change on every render, the socket handler reads the latest
+  const handlers = useRef(props);
+  handlers.current = props;
+
+  // last message received, the backend replays the ones after it on reconnect
+  const lastSeq = useRef<number | null>(null);
   useEffect(() => {
-    if (prev === lastJsonMessage) return;
-    console.log("Last JSON message:", lastJsonMessage);
-    switch (lastJsonMessage?.task_type) {
+    const stored = localStorage.getItem(lastSeqKey(user));
+    lastSeq.current = stored === null ? null : Number(stored);
+  }, [user]);
+
+  const getUrl = useCallback(() => {
+    const host = "localhost:8000";
+    const params = new URLSearchParams({ user });
+    if (lastSeq.current !== null)
+      params.set("last_seq", String(lastSeq.current));
+    return `ws://${host}/ws?${params}`;
+  }, [user]);
+
+  const dispatch = useCallback((message: backendResponse) => {
+    const {
+      onLanguageFound,
+      onPreProcess,
+      onSegmentation,
+      onTranscription,
+      onAlignment,
+      onDiarization,
+    } = handlers.current;
+    switch (message.task_type) {
       case "convert_to_numpy":
-        if (onPreProcess) onPreProcess(lastJsonMessage as toNumpyResponse);
+        if (onPreProcess) onPreProcess(message as toNumpyResponse);
         break;
       case "detect_language":
         if (onLanguageFound)
-          onLanguageFound(lastJsonMessage as languageDetectionResponse);
+          onLanguageFound(message as languageDetectionResponse);
         break;
       case "detect_voice_segments":
         if (onSegmentation)
-          onSegmentation(lastJsonMessage as voiceSegmentsDetectionResponse);
+          onSegmentation(message as voiceSegmentsDetectionResponse);
         break;
       case "transcribe_segment":
-        if (onTranscription)
-          onTranscription(lastJsonMessage as transcriptionResponse);
+        if (onTranscription) onTranscription(message as transcriptionResponse);
         break;
       case "diarize":
-        if (onDiarization)
-          onDiarization(lastJsonMessage as diarizationResponse);
+        if (onDiarization) onDiarization(message as diarizationResponse);
         break;
       case "align_words":
-        if (onAlignment) onAlignment(lastJsonMessage as alignmentResponse);
+        if (onAlignment) onAlignment(message as alignmentResponse);
         break;
       case "collect_transcriptions":
         break; // no callback
       default:
         break;
     }
-  }, [
-    lastJsonMessage,
-    onAlignment,
-    onDiarization,
-    onLanguageFound,
-    onPreProcess,
-    onSegmentation,
-    onTranscription,
-    prev,
-  ]);
+  }, []);
+
+  const { readyState, sendJsonMessage } = useWebSocket(getUrl, {
+    shouldReconnect: () => true,
+    reconnectInterval: 10_000,
+    reconnectAttempts: Infinity,
+    // every frame is handled, several can arrive between two renders
+    onMessage: (event) => {
+      const frame = JSON.parse(event.data) as backendFrame;
+      console.log("Backend frame:", frame);
+      const messages = frame.task_type === "batch" ? frame.messages : [frame];
+      for (const message of messages) dispatch(message);
+      if (frame.seq === undefined) return;
+      lastSeq.current = frame.seq;
+      localStorage.setItem(lastSeqKey(user), String(frame.seq));
+      sendJsonMessage({ ack: frame.seq }, false);
+    },
+  });
 
   useEffect(() => {
     if (readyState == ReadyState.OPEN)
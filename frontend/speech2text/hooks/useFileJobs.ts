@@ -54,6 +54,10 @@ export function useFileJobs(
   );
   const removeJob = useCallback(
     (id: string) => {
+      // stops the work left on the backend, 404 once the job is finished
+      axios
+        .post("/api/cancel", null, { params: { [TASK_KEY]: id } })
+        .catch(() => {});
       setJobs((prev) =>
         prev.map((j) => {
           return j.id === id
@@ -126,6 +130,17 @@ export function useFileJobs(
     [setJobs]
   );
 
+  const setTotalTime = useCallback(
+    (id: string, total_time: number) => {
+      setJobs((prev) =>
+        prev.map((j) => {
+          return j.id === id ? { ...j, total_time } : j;
+        })
+      );
+    },
+    [setJobs]
+  );
+
   const setResult = useCallback(
     (jid: string, rid: string, segment: segment | diarizedSegment) => {
       setJobs((prev) => {
@@ -240,9 +255,10 @@ export function useFileJobs(
   const onSegmentation = useCallback(
     (task: voiceSegmentsDetectionResponse) => {
       setStatus(task.task_id, "fragmenting", 100);
+      setTotalTime(task.task_id, task.total_useful_time);
       progressJob(task.task_id, "detecting_language");
     },
-    [progressJob, setStatus]
+    [progressJob, setStatus, setTotalTime]
   );
   const onLanguageFound = useCallback(
     (task: languageDetectionResponse) => {
@@ -254,7 +270,8 @@ export function useFileJobs(
   const onTranscription = useCallback(
     (task: transcriptionResponse) => {
       console.log("On transcribe segment callback", task);
-      setResult(task.task_id, task.transcription.text, task.transcription);
+      // keyed by segment, a refined transcription replaces its draft
+      setResult(task.task_id, String(task.i), task.transcription);
     },
     [setResult]
   );
@@ -298,17 +315,18 @@ export function useFileJobs(
       if (job.removed || job.done || job.error) continue;
       if (job.result) {
         let sub_total = 0;
-        let total = 0;
+        let total = job.total_time ?? 0;
         for (const result of Object.values(job.result)) {
-          total = result.total_time;
+          // streamed segments don't know the total until decoding ends
+          total = result.total_time ?? total;
           sub_total += result.end - result.start;
         }
         console.log("Progress is", sub_total, "of", total);
-        if (total - sub_total < 0.1) {
+        if (total && total - sub_total < 0.1) {
           doneJob(job.id);
           continue;
         }
-        setStatus(job.id, "transcribing", (sub_total / total) * 100);
+        if (total) setStatus(job.id, "transcribing", (sub_total / total) * 100);
       }
       if (job.sent) continue;
       runJob(job.id);
@@ -2,3 +2,4 @@ export const FILE_KEY = "file" as const;
 export const FILE_NAME_KEY = "file_name" as const;
 export const USER_KEY = "user" as const;
 export const TASK_KEY = "task" as const;
+export const PROFILE_KEY = "profile" as const;
@@ -9,6 +9,10 @@ const nextConfig: NextConfig = {
         //destination: "http://backend:8000/dispatch",
         destination: "http://localhost:8000/dispatch",
       },
+      {
+        source: "/api/cancel",
+        destination: "http://localhost:8000/cancel",
+      },
     ];
   },
 };
@@ -2,7 +2,7 @@ export interface segment {
   start: number;
   end: number;
   text: string;
-  total_time: number;
+  total_time: number | null;
 }
 
 export interface wordSegment {
@@ -39,6 +39,8 @@ type task_type =
 type baseTaskResponse = {
   task_id: string;
   task_type: task_type;
+  // position in the outbox of the user, acknowledged back to the backend
+  seq?: number;
 };
 
 export type diarizationResponse = baseTaskResponse & {
@@ -60,6 +62,8 @@ export type transcriptionResponse = baseTaskResponse & {
   transcription: segment;
   i: number;
   total: number;
+  // quick text of a two pass flow, replaced by the refined one of the same i
+  draft?: boolean;
 };
 
 export type languageDetectionResponse = baseTaskResponse & {
@@ -77,3 +81,12 @@ export type backendResponse =
   | languageDetectionResponse
   | voiceSegmentsDetectionResponse
   | toNumpyResponse;
+
+// results sent close together arrive in a single frame
+export type batchResponse = {
+  task_type: "batch";
+  seq: number;
+  messages: backendResponse[];
+};
+
+export type backendFrame = backendResponse | batchResponse;
@@ -19,6 +19,7 @@ export type FileJob = {
   fileSize: string;
   color: string; // hsl string
   result?: Record<string, segment | diarizedSegment>;
+  total_time?: number; // useful audio seconds, once segmentation is done
   status: {
     [key in backend_status]: number;
   };